@@ -0,0 +1,85 @@
+"""Compares helpers.html_to_discord with the replace-chain converter it replaced, on announcement-style HTML.
+
+Run from the repository root: python bench/html_to_discord.py [repeats]
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import helpers
+
+# the previous implementation, kept here as the baseline
+notag = re.compile(r'<.*?>')
+hdreplacements = {
+	'<b>': '**',
+	'</b>': '**',
+	'<strong>': '**',
+	'</strong>': '**',
+	'<i>': '*',
+	'</i>': '*',
+	'<em>': '*',
+	'</em>': '*',
+	'<u>': '__',
+	'</u>': '__',
+	'<br>': '\n',
+	'<br/>': '\n',
+	'<br />': '\n',
+	'\n ': '\n'
+}
+
+def legacy_html_to_discord(html: str) -> str:
+	for html_tag, discord_md in hdreplacements.items():
+		html = html.replace(html_tag, discord_md)
+	return re.sub(notag, '', html)
+
+# shaped like the news API's announcement bodies: <br> separated lines, styled spans, links, lists and entities
+maintenance = (
+	'<span style="color:#ff4e4e;"><b>Maintenance Notice</b></span><br><br>'
+	'Thank you for playing <i>Umamusume: Pretty Derby</i>!<br>'
+	'We will be performing scheduled maintenance at the following time.<br><br>'
+	'<b>■ Date &amp; Time</b><br>'
+	'Thursday, June 26 10:00 PM &ndash; 11:59 PM (UTC)<br><br>'
+	'<b>■ Details</b><br>'
+	'<ul><li>Bug fixes</li><li>Preparations for upcoming events</li><li>Server stability improvements</li></ul>'
+	'<br>The game will be unavailable during maintenance.<br>'
+	'For details, please check the <a href="https://umamusume.com/news/">official site</a>.<br><br>'
+	'We apologize for any inconvenience and appreciate your understanding.'
+)
+banner = (
+	'<div style="text-align:center;"><img src="https://example.com/banner.png"></div>'
+	'<strong>New Support Cards &amp; Trainees Available!</strong><br />\n'
+	' The following gacha will be available from <u>Jun 27 5:00 AM</u> to <u>Jul 6 4:59 AM</u> (UTC).<br />\n'
+	'<br />\n'
+	'<b>★3 Special Week (Summer)</b><br />\n'
+	'<b>SSR [Dreams Do Come True] Kitasan Black</b><br />\n'
+	'<br />\n'
+	'<ol><li>Rate-up &quot;pick-up&quot; rates apply to each featured card</li>'
+	'<li>Exchange points<ul><li>200 points per featured item</li><li>Points expire after the gacha ends</li></ul></li></ol>'
+	'&#9733; See the in-game <em>Details</em> screen for rates. &lt;Limited&gt;<br />\n'
+	'<a href="https://umamusume.com/gacha/">umamusume.com/gacha</a>'
+)
+campaign = ''.join(
+	f'<p><b>Day {day}</b>: Log in to receive <span class="item">Carats &times;{day * 50}</span> '
+	f'and a <i>Support Card Ticket</i>.<br/>Rewards are sent to your present box &amp; expire after 30 days.</p>\n'
+	for day in range(1, 15)
+)
+samples = {'maintenance': maintenance, 'banner': banner, 'campaign': campaign}
+
+def main():
+	repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	uncached = helpers.html_to_discord.__wrapped__
+	print(f'{"sample":<12} {"bytes":>6} {"legacy µs":>10} {"new µs":>10} {"memo µs":>10}')
+	for name, html in samples.items():
+		legacy = min(timeit.repeat(lambda: legacy_html_to_discord(html), number=repeats, repeat=5)) / repeats
+		new = min(timeit.repeat(lambda: uncached(html), number=repeats, repeat=5)) / repeats
+		helpers.html_to_discord(html)
+		memo = min(timeit.repeat(lambda: helpers.html_to_discord(html), number=repeats, repeat=5)) / repeats
+		print(f'{name:<12} {len(html):>6} {legacy * 1e6:>10.2f} {new * 1e6:>10.2f} {memo * 1e6:>10.2f}')
+	if '-v' in sys.argv:
+		for name, html in samples.items():
+			print(f'\n--- {name} (legacy)\n{legacy_html_to_discord(html)}\n--- {name} (new)\n{helpers.html_to_discord(html)}')
+
+if __name__ == '__main__':
+	main()
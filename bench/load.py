@@ -0,0 +1,518 @@
+"""Synthetic load benchmark for the cogs: no Discord connection and no network.
+
+Loads the real Leaderboard, Converse, Uma and Randfun cogs into a bot whose guilds, members, channels, voice
+states and messages are in-memory fakes, runs them in a scratch directory, and drives them with open-loop
+workloads (voice churn, message floods, commands, news polls and leaderboard flushes) at fixed rates.
+Reports per-workload throughput and p50/p99 handler latency, event loop blocking, and bytes written under
+store/, and compares the run with a saved baseline.
+
+Run from the repository root:
+	python bench/load.py                        # default workload, compared with bench/baseline.json if present
+	python bench/load.py --guilds 50 --members 10000 --voice-rate 500 --message-rate 200 --duration 30
+	python bench/load.py --save-baseline        # record this run as the baseline
+Exits with status 1 if a metric regressed by more than --tolerance against a baseline of the same workload.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import discord
+from discord.ext import commands
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import dispatch
+import sharding
+from html_to_discord import samples
+
+cogs = ['leaderboard', 'converse', 'uma', 'randfun']
+words = ('the', 'race', 'tonight', 'who', 'is', 'in', 'vc', 'gacha', 'pulls', 'were', 'bad', 'again', 'lol', 'good',
+		'morning', 'anyone', 'up', 'for', 'ranked', 'training', 'new', 'banner', 'looks', 'great', 'skip', 'this', 'one')
+command_mix = ('!leaderboard', '!leaderboard total', '!leaderboard top 2', '!leaderboard current 3', '!coinflip', '!wheel', '!uma 3')
+
+class FakeUser:
+	def __init__(self, id: int, name: str, bot: bool = False):
+		self.id = id
+		self.name = name
+		self.display_name = name
+		self.global_name = name
+		self.bot = bot
+		self.mention = f'<@{id}>'
+
+	def __eq__(self, other) -> bool:
+		return getattr(other, 'id', None) == self.id
+
+	def __hash__(self) -> int:
+		return hash(self.id)
+
+class FakePermissions:
+	manage_channels = True
+	administrator = False
+
+class FakeVoiceState:
+	def __init__(self, channel):
+		self.channel = channel
+
+class FakeMember(FakeUser):
+	def __init__(self, id: int, name: str, guild):
+		super().__init__(id, name)
+		self.guild = guild
+		self.voice = None
+		self.guild_permissions = FakePermissions()
+
+class FakeMessage:
+	# read (but not used) by commands.Context
+	_state = None
+
+	def __init__(self, id: int, content: str, author, channel, mentions: list | None = None):
+		self.id = id
+		self.content = content
+		self.author = author
+		self.channel = channel
+		self.guild = channel.guild
+		self.mentions = mentions or []
+		self.mention_everyone = False
+		self.attachments = []
+		self.embeds = []
+		self.type = discord.MessageType.default
+		self.webhook_id = None
+
+	async def edit(self, **kwargs):
+		return self
+
+class FakeChannel:
+	def __init__(self, id: int, name: str, guild, stats: dict):
+		self.id = id
+		self.name = name
+		self.guild = guild
+		self.mention = f'<#{id}>'
+		self.stats = stats
+
+	@property
+	def members(self) -> list:
+		"""Everyone in the guild, as for a text channel everyone can read"""
+		return list(self.guild.members.values())
+
+	async def send(self, content: str | None = None, **kwargs) -> FakeMessage:
+		self.stats['sends'] += 1
+		return FakeMessage(0, content or '', None, self)
+
+class FakeVoiceChannel(FakeChannel):
+	def __init__(self, id: int, name: str, guild, stats: dict):
+		super().__init__(id, name, guild, stats)
+		# member ID -> member
+		self.voice_members = {}
+
+	@property
+	def members(self) -> list:
+		"""Only the members connected, as for a real voice channel"""
+		return list(self.voice_members.values())
+
+class FakeGuild:
+	def __init__(self, id: int, name: str):
+		self.id = id
+		self.name = name
+		self.members = {}
+		self.text_channels = []
+		self.voice_channels = []
+
+	def get_member(self, member_id: int) -> FakeMember | None:
+		return self.members.get(member_id)
+
+class FakeWeb:
+	"""Stands in for webclient.WebClient: serves the news API with a new announcement on every call"""
+	def __init__(self):
+		self.announce_id = 1000
+		self.bodies = list(samples.values())
+
+	async def request_json(self, method: str, url: str, **kwargs):
+		self.announce_id += 1
+		entries = [{'announce_id': self.announce_id - i, 'title': f'Announcement {self.announce_id - i}', 'image': None,
+				'message': self.bodies[(self.announce_id - i) % len(self.bodies)], 'post_at': '2025-06-26 10:00'} for i in range(10)]
+		return {'response_code': 1, 'information_list': entries}
+
+	async def close(self):
+		pass
+
+class FakeContext(commands.Context):
+	async def send(self, content: str | None = None, **kwargs):
+		return await self.channel.send(content, **kwargs)
+
+class LoadBot(commands.Bot):
+	"""commands.Bot with the attributes main.py sets up, serving fake guilds instead of a gateway connection"""
+	def __init__(self, config: dict):
+		intents = discord.Intents.default()
+		intents.message_content = True
+		intents.members = True
+		super().__init__(command_prefix='!', intents=intents, help_command=None)
+		self.config = config
+		self.layout = sharding.ShardLayout()
+		self.reloading = False
+		self.handover = {}
+		self.web = FakeWeb()
+		self.dispatcher = dispatch.Dispatcher(max_queue=config.get('dispatch_max_queue', 1000))
+		self.bot_user = FakeUser(1, 'bot', bot=True)
+		self.fake_guilds = {}
+		self.fake_channels = {}
+		self.command_errors = 0
+		self.logger = logging.getLogger(__name__)
+		self.error_kinds = set()
+
+	@property
+	def user(self) -> FakeUser:
+		return self.bot_user
+
+	@property
+	def guilds(self) -> list[FakeGuild]:
+		return list(self.fake_guilds.values())
+
+	def get_guild(self, id: int) -> FakeGuild | None:
+		return self.fake_guilds.get(id)
+
+	def get_channel(self, id: int) -> FakeChannel | None:
+		return self.fake_channels.get(id)
+
+	def get_user(self, id: int) -> None:
+		return
+
+	async def fetch_user(self, id: int) -> FakeUser:
+		return FakeUser(id, f'user{id}')
+
+	async def wait_until_ready(self):
+		return
+
+	async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
+		self.command_errors += 1
+		error = getattr(error, 'original', error)
+		if (ctx.command, type(error)) not in self.error_kinds:
+			self.error_kinds.add((ctx.command, type(error)))
+			self.logger.warning(f'{ctx.message.content} failed: {error!r}')
+
+def build_world(bot: LoadBot, guild_count: int, member_count: int, voice_channels: int, stats: dict):
+	ids = iter(range(10**6, 10**9))
+	for g in range(guild_count):
+		guild = FakeGuild(next(ids), f'guild{g}')
+		for name in ('general', 'memes'):
+			channel = FakeChannel(next(ids), name, guild, stats)
+			guild.text_channels.append(channel)
+			bot.fake_channels[channel.id] = channel
+		for v in range(voice_channels):
+			channel = FakeVoiceChannel(next(ids), f'voice{v}', guild, stats)
+			guild.voice_channels.append(channel)
+			bot.fake_channels[channel.id] = channel
+		bot.fake_guilds[guild.id] = guild
+	guilds = bot.guilds
+	for m in range(member_count):
+		guild = guilds[m % guild_count]
+		member = FakeMember(next(ids), f'member{m}', guild)
+		guild.members[member.id] = member
+
+def seed_store(guilds: list[FakeGuild]):
+	"""Every guild subscribed to news, so each poll fans out to all of them"""
+	state = {str(guild.id): {'news_channel': str(guild.text_channels[0].id), 'last_news_id': '0'} for guild in guilds}
+	with open('store/uma.json', 'w') as f:
+		json.dump(state, f)
+
+def percentile(samples: list[float], q: float) -> float:
+	if not samples:
+		return 0.0
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def written_bytes() -> int | None:
+	"""Bytes this process has passed to write() so far (Linux only)"""
+	try:
+		with open('/proc/self/io') as f:
+			for line in f:
+				if line.startswith('wchar:'):
+					return int(line.split()[1])
+	except OSError:
+		return
+
+def store_size() -> int:
+	total = 0
+	for directory, _, files in os.walk('store'):
+		for name in files:
+			total += os.path.getsize(os.path.join(directory, name))
+	return total
+
+class Recorder:
+	def __init__(self):
+		# workload -> latencies in seconds
+		self.latencies = {}
+		self.counts = {}
+
+	async def timed(self, name: str, coro):
+		started = time.perf_counter()
+		try:
+			await coro
+		finally:
+			self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+			self.counts[name] = self.counts.get(name, 0) + 1
+
+	def timed_sync(self, name: str, function):
+		def wrapper(*args, **kwargs):
+			started = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+				self.counts[name] = self.counts.get(name, 0) + 1
+		return wrapper
+
+async def drive(rate: float, duration: float, event):
+	"""Call `event` `rate` times a second for `duration` seconds, catching up after slow handlers (open loop)"""
+	if rate <= 0:
+		return
+	started = time.monotonic()
+	done = 0
+	while (elapsed := time.monotonic() - started) < duration:
+		due = int(elapsed * rate) + 1
+		while done < due:
+			await event()
+			done += 1
+		elapsed = time.monotonic() - started
+		await asyncio.sleep(max(0.0, min(done / rate, duration) - elapsed))
+
+async def watch_loop(lags: list[float], stop: asyncio.Event, interval: float = 0.005):
+	"""Sample how late the event loop wakes a sleeping task"""
+	while not stop.is_set():
+		started = time.perf_counter()
+		await asyncio.sleep(interval)
+		lags.append(max(0.0, time.perf_counter() - started - interval))
+
+async def run(args) -> dict:
+	config = {
+		'dev_user_id': 0, 'timezone': 'UTC', 'leaderboard_backend': args.backend, 'leaderboard_flush_interval': 3600,
+		'conversation_log_interval': args.log_interval, 'conversation_response_interval': args.response_interval,
+		'conversation_response_chance': 0.1, 'uma_poll_interval': 60, 'voice_batch_window': 1.0,
+	}
+	bot = LoadBot(config)
+	# sets up the client (its loop, for one) without logging in
+	async with bot:
+		return await exercise(bot, args)
+
+async def exercise(bot: LoadBot, args) -> dict:
+	rng = random.Random(args.seed)
+	stats = {'sends': 0}
+	build_world(bot, args.guilds, args.members, args.voice_channels, stats)
+	guilds = bot.guilds
+	seed_store(guilds)
+	for name in cogs:
+		await bot.load_extension(f'cogs.{name}')
+		if not args.verbose:
+			# the cogs log at INFO whatever the root level is
+			logging.getLogger(f'cogs.{name}').setLevel(logging.WARNING)
+	recorder = Recorder()
+	leaderboard = bot.get_cog('Leaderboard')
+	leaderboard.apply_voice_events = recorder.timed_sync('voice batch', leaderboard.apply_voice_events)
+	for listener in bot.extra_events.get('on_ready', ()):
+		await listener()
+	voice_listeners = bot.extra_events.get('on_voice_state_update', ())
+	message_listeners = bot.extra_events.get('on_message', ())
+	members = [member for guild in guilds for member in guild.members.values()]
+	message_ids = iter(range(1, 10**12))
+
+	async def voice_event():
+		member = rng.choice(members)
+		before = member.voice
+		if before is None:
+			after = FakeVoiceState(rng.choice(member.guild.voice_channels))
+		elif rng.random() < 0.7:
+			after = None
+		else:
+			after = FakeVoiceState(rng.choice(member.guild.voice_channels))
+		if before is not None:
+			before.channel.voice_members.pop(member.id, None)
+		if after is not None:
+			after.channel.voice_members[member.id] = member
+		member.voice = after
+		for listener in voice_listeners:
+			await recorder.timed('voice', listener(member, before or FakeVoiceState(None), after or FakeVoiceState(None)))
+
+	async def message_event():
+		member = rng.choice(members)
+		channel = rng.choice(member.guild.text_channels)
+		mentions = [bot.user] if rng.random() < 0.02 else []
+		content = ' '.join(rng.choices(words, k=rng.randint(2, 15)))
+		message = FakeMessage(next(message_ids), content, member, channel, mentions)
+		for listener in message_listeners:
+			await recorder.timed('message', listener(message))
+
+	async def command_event():
+		member = rng.choice(members)
+		message = FakeMessage(next(message_ids), rng.choice(command_mix), member, member.guild.text_channels[0])
+		ctx = await bot.get_context(message, cls=FakeContext)
+		await recorder.timed('command', bot.invoke(ctx))
+
+	async def news_poll():
+		await recorder.timed('news poll', bot.get_cog('Uma').poll_news())
+
+	async def flush():
+		await recorder.timed('flush', leaderboard.flush_leaderboard())
+
+	lags = []
+	stop = asyncio.Event()
+	watcher = asyncio.create_task(watch_loop(lags, stop))
+	written_before = written_bytes()
+	size_before = store_size()
+	started = time.monotonic()
+	await asyncio.gather(
+		drive(args.voice_rate, args.duration, voice_event),
+		drive(args.message_rate, args.duration, message_event),
+		drive(args.command_rate, args.duration, command_event),
+		drive(1 / args.poll_interval, args.duration, news_poll),
+		drive(1 / args.flush_interval, args.duration, flush),
+	)
+	elapsed = time.monotonic() - started
+	# let the last voice batch and queued sends drain
+	leaderboard.apply_voice_events()
+	while bot.dispatcher.size and time.monotonic() - started < elapsed + 10:
+		await asyncio.sleep(0.05)
+	stop.set()
+	await watcher
+	written_after = written_bytes()
+	for name in ('Leaderboard', 'Converse'):
+		cog = bot.get_cog(name)
+		if cog is not None:
+			cog.on_shutdown()
+	for name in cogs:
+		await bot.unload_extension(f'cogs.{name}')
+
+	workloads = {}
+	for name, latencies in recorder.latencies.items():
+		workloads[name] = {
+			'count': recorder.counts[name],
+			'throughput': recorder.counts[name] / elapsed,
+			'p50_ms': percentile(latencies, 0.5) * 1000,
+			'p99_ms': percentile(latencies, 0.99) * 1000,
+		}
+	return {
+		'workload': {key: getattr(args, key) for key in ('guilds', 'members', 'voice_channels', 'voice_rate', 'message_rate',
+				'command_rate', 'poll_interval', 'flush_interval', 'duration', 'backend', 'seed')},
+		'elapsed': elapsed,
+		'workloads': workloads,
+		'loop': {
+			'lag_p99_ms': percentile(lags, 0.99) * 1000,
+			'lag_max_ms': max(lags, default=0.0) * 1000,
+			# time the loop was held by one callback for longer than 10ms
+			'blocked_ms': sum(lag for lag in lags if lag > 0.01) * 1000,
+		},
+		'io': {
+			'bytes_written': None if written_before is None else written_after - written_before,
+			'store_growth': store_size() - size_before,
+		},
+		'sends': stats['sends'],
+		'dispatcher': dict(bot.dispatcher.metrics),
+		'command_errors': bot.command_errors,
+	}
+
+# metric path -> True if higher is better
+tracked = {'loop.lag_p99_ms': False, 'loop.blocked_ms': False, 'io.bytes_written': False}
+
+def flatten(result: dict) -> dict[str, float]:
+	metrics = {}
+	for name, values in result['workloads'].items():
+		metrics[f'{name}.throughput'] = values['throughput']
+		metrics[f'{name}.p50_ms'] = values['p50_ms']
+		metrics[f'{name}.p99_ms'] = values['p99_ms']
+	for key in tracked:
+		section, metric = key.split('.')
+		if result[section][metric] is not None:
+			metrics[key] = result[section][metric]
+	return metrics
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+	"""Returns a line for each metric that got worse than the baseline by more than `tolerance`"""
+	regressions = []
+	current, previous = flatten(result), flatten(baseline)
+	for key, value in current.items():
+		before = previous.get(key)
+		if before is None:
+			continue
+		higher_better = tracked.get(key, key.endswith('throughput'))
+		# ignore differences too small to measure reliably
+		if not higher_better and value - before < (0.05 if key.endswith('_ms') else 4096):
+			continue
+		change = (value - before) / before if before else 0.0
+		if (higher_better and change < -tolerance) or (not higher_better and before and change > tolerance):
+			regressions.append(f'{key}: {before:.3f} -> {value:.3f} ({change:+.0%})')
+	return regressions
+
+def report(result: dict):
+	print(f'{"workload":<12} {"count":>8} {"per sec":>9} {"p50 ms":>8} {"p99 ms":>8}')
+	for name, values in sorted(result['workloads'].items()):
+		print(f'{name:<12} {values["count"]:>8} {values["throughput"]:>9.1f} {values["p50_ms"]:>8.3f} {values["p99_ms"]:>8.3f}')
+	loop = result['loop']
+	print(f'event loop: lag p99 {loop["lag_p99_ms"]:.2f}ms, max {loop["lag_max_ms"]:.2f}ms, blocked {loop["blocked_ms"]:.0f}ms over {result["elapsed"]:.1f}s')
+	io = result['io']
+	written = 'n/a' if io['bytes_written'] is None else f'{io["bytes_written"] / 1024:.0f} KiB'
+	print(f'store: {written} written, {io["store_growth"] / 1024:+.0f} KiB on disk')
+	metrics = result['dispatcher']
+	print(f'sends: {result["sends"]} ({metrics["sent"]} dispatched, {metrics["coalesced"]} coalesced, {metrics["dropped"]} dropped), '
+			f'command errors: {result["command_errors"]}')
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--guilds', type=int, default=50)
+	parser.add_argument('--members', type=int, default=10000, help='total, spread evenly over the guilds')
+	parser.add_argument('--voice-channels', type=int, default=3, help='per guild')
+	parser.add_argument('--voice-rate', type=float, default=200, help='voice state events per second')
+	parser.add_argument('--message-rate', type=float, default=100, help='chat messages per second')
+	parser.add_argument('--command-rate', type=float, default=5, help='commands per second')
+	parser.add_argument('--poll-interval', type=float, default=5, help='seconds between news polls')
+	parser.add_argument('--flush-interval', type=float, default=5, help='seconds between leaderboard flushes')
+	parser.add_argument('--duration', type=float, default=20, help='seconds')
+	parser.add_argument('--backend', choices=('json', 'sqlite'), default='json', help='leaderboard store')
+	parser.add_argument('--log-interval', type=float, default=1, help='conversation_log_interval')
+	parser.add_argument('--response-interval', type=float, default=5, help='conversation_response_interval')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--baseline', default=os.path.join(root, 'bench', 'baseline.json'))
+	parser.add_argument('--save-baseline', action='store_true')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional regression')
+	parser.add_argument('--json', action='store_true', help='print the raw result')
+	parser.add_argument('--verbose', action='store_true', help="show the cogs' info logging")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.WARNING)
+	workdir = os.getcwd()
+	with tempfile.TemporaryDirectory(prefix='bench-') as scratch:
+		os.chdir(scratch)
+		os.mkdir('store')
+		sys.path.insert(0, root)
+		try:
+			result = asyncio.run(run(args))
+		finally:
+			os.chdir(workdir)
+	report(result)
+	if args.json:
+		print(json.dumps(result, indent='\t'))
+	if args.save_baseline:
+		with open(args.baseline, 'w') as f:
+			json.dump(result, f, indent='\t')
+		print(f'Saved baseline to {args.baseline}')
+		return
+	try:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	except FileNotFoundError:
+		print('No baseline to compare with (record one with --save-baseline)')
+		return
+	if baseline['workload'] != result['workload']:
+		print('Baseline was recorded with a different workload, not comparing')
+		return
+	regressions = compare(result, baseline, args.tolerance)
+	if regressions:
+		print(f'Regressions against the baseline (tolerance {args.tolerance:.0%}):')
+		for line in regressions:
+			print(f'  {line}')
+		sys.exit(1)
+	print('No regressions against the baseline')
+
+if __name__ == '__main__':
+	main()
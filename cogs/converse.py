@@ -1,28 +1,53 @@
 import discord
 from discord.ext import commands
-import datetime
-import os.path
 import random
 import logging
+import time
+import corpus
+import helpers
+import metrics
+import ratelimit
 
 class Converse(commands.Cog):
-	clog_next_record = {}
-	clog_next_response = {}
-
-	conversation_log_interval: datetime.timedelta # Minimum time between logging a message for conversation
-	conversation_response_interval: datetime.timedelta # Minimum time between conversation responses
-
 	def __init__(self, bot, *args, **kwargs):
 		self.bot = bot
 		self.logger = logging.getLogger(__name__)
 		self.logger.setLevel(logging.INFO)
-		self.conversation_log_interval = datetime.timedelta(seconds=bot.config['conversation_log_interval'])
-		self.conversation_response_interval = datetime.timedelta(seconds=bot.config['conversation_response_interval'])
+		state = helpers.take_over(bot, 'Converse')
+		# per guild: minimum time between logging a message for conversation, and between conversation responses
+		self.record_cooldown = ratelimit.Cooldown(bot.config['conversation_log_interval'], state.get('record_until'))
+		self.response_cooldown = ratelimit.Cooldown(bot.config['conversation_response_interval'], state.get('response_until'))
+		if state:
+			self.corpora = state['corpora']
+			self.corpus_writer = state['corpus_writer']
+			return
+		self.corpora = corpus.GuildCorpora(max_lines=bot.config.get('conversation_max_lines', 20000),
+				relevance=bot.config.get('conversation_relevance', False))
+		self.corpus_writer = corpus.CorpusWriter(self.corpora,
+				max_queue=bot.config.get('conversation_write_queue', 1000),
+				batch_size=bot.config.get('conversation_write_batch', 50),
+				flush_interval=bot.config.get('conversation_write_interval', 5),
+				policy=bot.config.get('conversation_write_policy', 'drop_oldest'))
+
+	async def cog_load(self):
+		self.corpus_writer.start()
+		await self.corpora.load_fallback()
+
+	async def cog_unload(self):
+		if self.bot.reloading:
+			# the writer keeps running for the next instance
+			helpers.hand_over(self.bot, 'Converse', record_until=self.record_cooldown.until, response_until=self.response_cooldown.until,
+					corpora=self.corpora, corpus_writer=self.corpus_writer)
+			return
+		await self.corpus_writer.close()
+
+	def on_shutdown(self):
+		self.corpus_writer.drain()
 	
-	def conversation_catalog(self, message: discord.Message, force: bool = False):
+	async def conversation_catalog(self, message: discord.Message, force: bool = False):
 		"""Record messages ocassionally to randomly respond with"""
-		now = datetime.datetime.now()
-		if force or message.guild.id not in self.clog_next_record or self.clog_next_record[message.guild.id] < now:
+		now = time.monotonic()
+		if force or self.record_cooldown.ready(message.guild.id, now):
 			if self.bot.user in message.mentions:
 				return
 			# uncomment if gay
@@ -37,28 +62,29 @@ class Converse(commands.Cog):
 				msg = message.embeds[0].url
 			else:
 				return
-			with open('store/conversation.txt', 'a', encoding="utf-8") as f:
-				f.write(msg.replace('\n','\\n'))
-				f.write('\n')
-			self.clog_next_record[message.guild.id] = now + self.conversation_log_interval
+			await self.corpus_writer.put(message.guild.id, msg.replace('\n','\\n'))
+			self.record_cooldown.trigger(message.guild.id, now)
 
 	def conversation_response(self, message: discord.Message) -> str | None:
 		"""Chance to respond to this message with a random message (return value)"""
 		res_chance = self.bot.config['conversation_response_chance']
-		now = datetime.datetime.now()
-		if message.guild.id not in self.clog_next_response or self.clog_next_response[message.guild.id] < now or self.bot.user in message.mentions:
-			if (random.random() <= res_chance or self.bot.user in message.mentions) and os.path.exists('store/conversation.txt'):
-				self.clog_next_response[message.guild.id] = now + self.conversation_response_interval
-				with open('store/conversation.txt', 'r', encoding='utf-8') as f:
-					return random.choice(f.readlines()).replace('\\n', '\n')
+		now = time.monotonic()
+		if self.response_cooldown.ready(message.guild.id, now) or self.bot.user in message.mentions:
+			if (random.random() <= res_chance or self.bot.user in message.mentions) and self.corpora.has_lines(message.guild.id):
+				self.response_cooldown.trigger(message.guild.id, now)
+				response = self.corpora.relevant_line(message.guild.id, message.content) or self.corpora.random_line(message.guild.id)
+				return response.replace('\\n', '\n')
 
 	@commands.Cog.listener()
+	@metrics.timed('listener')
 	async def on_message(self, message: discord.Message):
 		if message.author.id == self.bot.user.id:
 			return
 		if not message.content or message.content[0] == '!':
 			return
-		self.conversation_catalog(message)
+		await self.conversation_catalog(message)
+		# loads the guild's corpus off the loop the first time, so conversation_response finds it open
+		await self.corpora.open(message.guild.id)
 		response = self.conversation_response(message)
 		if response:
 			await message.channel.send(response)\
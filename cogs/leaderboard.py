@@ -1,110 +1,264 @@
 import discord
 from discord.ext import commands, tasks
 import helpers
+import lbstore
+import history
+import metrics
+import asyncio
 import datetime
+import zoneinfo
+import heapq
 import json
+import math
+import time
+import typing
+from collections import OrderedDict
+from operator import itemgetter
 import logging
 
+class LeaderboardPages(discord.ui.View):
+	"""Previous/next buttons under a leaderboard embed"""
+	def __init__(self, cog, guild: discord.Guild, category: str, page: int, pages: int):
+		super().__init__(timeout=180)
+		self.cog = cog
+		self.guild = guild
+		self.category = category
+		self.page = page
+		self.pages = pages
+		self.message = None
+		self.update_buttons()
+
+	def update_buttons(self):
+		self.previous_page.disabled = self.page <= 0
+		self.next_page.disabled = self.page >= self.pages - 1
+
+	async def turn(self, interaction: discord.Interaction, step: int):
+		embed, self.page, self.pages = await self.cog.render_leaderboard_page(self.guild, self.category, self.page + step)
+		self.update_buttons()
+		await interaction.response.edit_message(embed=embed, view=self)
+
+	@discord.ui.button(emoji='\N{BLACK LEFT-POINTING TRIANGLE}', style=discord.ButtonStyle.secondary)
+	async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+		await self.turn(interaction, -1)
+
+	@discord.ui.button(emoji='\N{BLACK RIGHT-POINTING TRIANGLE}', style=discord.ButtonStyle.secondary)
+	async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+		await self.turn(interaction, 1)
+
+	async def on_timeout(self):
+		if self.message is not None:
+			try:
+				await self.message.edit(view=None)
+			except discord.HTTPException:
+				pass
+
 class Leaderboard(commands.Cog, name='Leaderboard'):
-	# Tracking user vc join/leave times
-	vc_timelog = {}
-	# last time leaderboard was updated
-	last_lb_update = None
+	# longest the reset scheduler sleeps before re-checking, in case the clock or a timezone database changed
+	max_reset_sleep = 3600
+	page_size = 10
+	# rendered pages (memoized) and display names of members no longer in the member cache
+	page_cache_size = 256
+	name_cache_size = 1024
+	# how long a page that includes ongoing VC sessions is reused, since their time keeps growing
+	live_page_ttl = 30
 	def __init__(self, bot, *args, **kwargs):
 		self.bot = bot
 		self.logger = logging.getLogger(__name__)
 		self.logger.setLevel(logging.INFO)
-		self.check_leaderboard_reset.start()
+		state = helpers.take_over(bot, 'Leaderboard')
+		self.store = state.get('store') or lbstore.open_store(bot.config.get('leaderboard_backend', 'json'), bot.layout)
+		self.snapshot_interval = bot.config.get('leaderboard_snapshot_interval', 600)
+		self.flush_leaderboard.change_interval(seconds=bot.config.get('leaderboard_flush_interval', 30))
+		self.flush_leaderboard.start()
+		self.reset_spread = bot.config.get('leaderboard_reset_spread', 0.1)
+		self.reset_wakeup = asyncio.Event()
+		self.pages = OrderedDict()
+		self.names = state.get('names', OrderedDict())
+		self.archive = state.get('archive') or history.WeeklyHistory()
+		self.weekly_reset.start()
+		# (guild ID, member ID) -> [member, seconds to credit, open session start or None], folded as events arrive
+		self.voice_pending = {}
+		self.voice_pending_events = 0
+		self.voice_batch_started = 0.0
+		self.voice_flush = None
+		self.voice_window = bot.config.get('voice_batch_window', 1.0)
+		self.voice_max_batch = bot.config.get('voice_batch_max', 2000)
+		self.voice_stats = state.get('voice_stats', {'events': 0, 'batches': 0, 'credited': 0, 'largest_batch': 0, 'peak_rate': 0.0})
+		self.voice_stats_since = state.get('voice_stats_since', time.monotonic())
+		# sessions are this process's, so the checkpoint is too
+		self.checkpoint_path = bot.layout.local_path('vcsessions.json')
+		self.checkpoint_empty = False
+		if state:
+			self.vc_timelog = state['vc_timelog']
+			self.restored_sessions = state['restored_sessions']
+		else:
+			# guild ID -> member ID -> VC join time
+			self.vc_timelog = {}
+			# sessions left over from before a restart, reconciled on the first on_ready
+			self.restored_sessions = self.load_checkpoint()
 		
 	
-	def initialize_leaderboard(self, guild: discord.Guild) -> dict:
+	def initialize_leaderboard(self, guild: discord.Guild):
 		announce_channel = 0
 		for channel in guild.text_channels:
 			if channel.name.lower() == 'general':
 				announce_channel = channel.id
-		return {'current': {}, 'top': {}, 'total': {}, 'lb_announce_channel': str(announce_channel)}
+		self.store.add_guild(guild.id, announce_channel)
 
 	def add_leaderboard_time(self, member: discord.Member, duration: datetime.timedelta):
-		jdata = {}
-		try:
-			with open('store/leaderboard.json', 'r') as f:
-				jdata = json.load(f)
-		except FileNotFoundError:
-			jdata = {}
-		except json.JSONDecodeError as e:
-			self.logger.warning(f'ALERT: JSON decode error for leaderboard.json, {e}', exc_info=True)
-			jdata = {}
-		guild_id = str(member.guild.id)
-		if guild_id not in jdata:
-			jdata[guild_id] = self.initialize_leaderboard(member.guild)
-		member_id = str(member.id)
-		for category in ['current', 'total']:
-			if member_id not in jdata[guild_id][category]:
-				jdata[guild_id][category][member_id] = 0
-			jdata[guild_id][category][member_id] += int(duration.total_seconds())
-
-		with open('store/leaderboard.json', 'w') as f:
-			json.dump(jdata, f, indent=4)
-
-	def get_leaderboard(self, guild: discord.Guild, category: str):
-		"""Returns a dictionary of members and their VC time"""
-		jdata = {}
-		guild_id = str(guild.id)
-		try:
-			with open('store/leaderboard.json', 'r') as f:
-				jdata = json.load(f)
-		except FileNotFoundError:
-			self.logger.warning('ALERT: leaderboard file not found')
-			return
-		except json.JSONDecodeError as e:
-			self.logger.warning(f'ALERT: JSON decode error for leaderboard.json, {e}', exc_info=True)
-			return
-		if guild_id not in jdata:
-			return
-		lb = jdata[guild_id][category]
-		if lb is not None:
-			return sorted(lb.items(), key=lambda item: item[1], reverse=True)
+		if not self.store.has_guild(member.guild.id):
+			self.initialize_leaderboard(member.guild)
+		self.store.add_time(member.guild.id, member.id, int(duration.total_seconds()))
+
+	def get_leaderboard(self, guild: discord.Guild, category: str, limit: int | None = None, offset: int = 0) -> list[tuple[int, int]] | None:
+		"""Returns the highest (member ID, VC seconds) pairs of a category"""
+		return self.store.top(guild.id, category, limit, offset)
+
+	def get_live_leaderboard(self, guild: discord.Guild, category: str, limit: int | None = None, offset: int = 0) -> list[tuple[int, int]] | None:
+		"""Like get_leaderboard, but with the time of ongoing VC sessions added in memory (nothing is committed)"""
+		sessions = self.vc_timelog.get(guild.id)
+		if category == 'top' or not sessions:
+			return self.get_leaderboard(guild, category, limit, offset)
+		lb = self.get_leaderboard(guild, category, None if limit is None else offset + limit)
+		# live time only ever adds, so the true top N is within the stored top N plus the members in VC
+		now = datetime.datetime.now()
+		scores = dict(lb or ())
+		for member_id, join_time in sessions.items():
+			if member_id not in scores:
+				scores[member_id] = self.store.score(guild.id, category, member_id)
+			scores[member_id] += int((now - join_time).total_seconds())
+		entries = ((member_id, seconds) for member_id, seconds in scores.items() if seconds > 0)
+		if limit is None:
+			return sorted(entries, key=itemgetter(1), reverse=True)[offset:]
+		return heapq.nlargest(offset + limit, entries, key=itemgetter(1))[offset:]
+
+	def get_live_count(self, guild: discord.Guild, category: str) -> int:
+		"""Number of members with time in a category, counting ongoing VC sessions"""
+		count = self.store.count(guild.id, category)
+		sessions = self.vc_timelog.get(guild.id)
+		if category != 'top' and sessions:
+			count += sum(1 for member_id in sessions if self.store.score(guild.id, category, member_id) == 0)
+		return count
 	
 	def set_leaderboard_channel(self, guild: discord.Guild, channel: discord.TextChannel) -> str:
-		jdata = {}
-		guild_id = str(guild.id)
-		try:
-			with open('store/leaderboard.json', 'r') as f:
-				jdata = json.load(f)
-		except FileNotFoundError:
-			jdata = {guild_id: self.initialize_leaderboard(guild)}
-		except json.JSONDecodeError as e:
-			self.logger.warning(f'ALERT: JSON decode error for leaderboard.json, {e}', exc_info=True)
-			return 'JSON decode error. Contact developer'
-		if guild_id not in jdata:
-			jdata[guild_id] = self.initialize_leaderboard(guild)
-		jdata[guild_id]['lb_announce_channel'] = str(channel.id)
-
-		with open('store/leaderboard.json', 'w') as f:
-			json.dump(jdata, f, indent=4)
+		if not self.store.has_guild(guild.id):
+			self.initialize_leaderboard(guild)
+		self.store.set_announce_channel(guild.id, channel.id)
 		return 'Success'
 	
-	def leaderboard_begin_track(self, member: discord.Member):
+	def leaderboard_begin_track(self, member: discord.Member, when: datetime.datetime | None = None):
 		guild_id = member.guild.id
 		if guild_id not in self.vc_timelog:
 			self.vc_timelog[guild_id] = {}
-		self.vc_timelog[guild_id][member.id] = datetime.datetime.now()
+		self.vc_timelog[guild_id][member.id] = when or datetime.datetime.now()
 	
-	def update_leaderboard(self, member: discord.Member, remove: bool) -> datetime.timedelta | None:
+	def update_leaderboard(self, member: discord.Member, remove: bool, when: datetime.datetime | None = None) -> datetime.timedelta | None:
 		guild_id = member.guild.id
 		if guild_id not in self.vc_timelog or member.id not in self.vc_timelog[guild_id]:
 			self.logger.info(f'{member.display_name} left a voice channel (or had lb status updated), but join time not found (bot might have restarted).')
 			return
+		when = when or datetime.datetime.now()
 		join_time = self.vc_timelog[guild_id].pop(member.id)
-		duration = datetime.datetime.now() - join_time
+		duration = when - join_time
 		self.add_leaderboard_time(member, duration)
 		if not remove:
-			self.leaderboard_begin_track(member)
+			self.leaderboard_begin_track(member, when)
 		return duration
+
+	def queue_voice_event(self, member: discord.Member, was_in_vc: bool, is_in_vc: bool, when: datetime.datetime):
+		"""Fold a voice event into the pending batch, which is applied after a short window"""
+		key = (member.guild.id, member.id)
+		entry = self.voice_pending.get(key)
+		if entry is None:
+			entry = self.voice_pending[key] = [member, 0.0, self.vc_timelog.get(member.guild.id, {}).get(member.id)]
+		entry[0] = member
+		if was_in_vc and not is_in_vc:
+			if entry[2] is None:
+				self.logger.info(f'{member.display_name} left a voice channel, but join time not found (bot might have restarted).')
+			else:
+				entry[1] += (when - entry[2]).total_seconds()
+				entry[2] = None
+		elif is_in_vc and entry[2] is None:
+			# a join, or a move by someone we weren't tracking
+			entry[2] = when
+		if self.voice_pending_events == 0:
+			self.voice_batch_started = time.monotonic()
+			self.voice_flush = asyncio.get_running_loop().call_later(self.voice_window, self.apply_voice_events)
+		self.voice_pending_events += 1
+		if self.voice_pending_events >= self.voice_max_batch:
+			self.apply_voice_events()
+
+	def apply_voice_events(self):
+		"""Apply the pending voice batch: update open sessions and credit finished ones in one store write"""
+		if self.voice_flush is not None:
+			self.voice_flush.cancel()
+			self.voice_flush = None
+		pending, self.voice_pending = self.voice_pending, {}
+		events, self.voice_pending_events = self.voice_pending_events, 0
+		if not pending:
+			return
+		entries = []
+		for (guild_id, member_id), (member, seconds, start) in pending.items():
+			sessions = self.vc_timelog.setdefault(guild_id, {})
+			if start is None:
+				sessions.pop(member_id, None)
+			else:
+				sessions[member_id] = start
+			if seconds >= 1:
+				if not self.store.has_guild(guild_id):
+					self.initialize_leaderboard(member.guild)
+				entries.append((guild_id, member_id, int(seconds)))
+		self.store.add_times(entries)
+		elapsed = max(time.monotonic() - self.voice_batch_started, 0.001)
+		rate = events / elapsed
+		stats = self.voice_stats
+		stats['events'] += events
+		stats['batches'] += 1
+		stats['credited'] += len(entries)
+		stats['largest_batch'] = max(stats['largest_batch'], events)
+		stats['peak_rate'] = max(stats['peak_rate'], rate)
+		message = f'Applied {events} voice events for {len(pending)} members ({len(entries)} credited) at {rate:.0f} events/s'
+		if events >= 100:
+			self.logger.info(message)
+		else:
+			self.logger.debug(message)
 	
-	def get_leaderboard_embed(self, guild: discord.Guild, category: str) -> discord.Embed | None:
-		"""Returns a formatted discord embed of a certain leaderboard category"""
-		timezone = self.bot.config['timezone']
+	async def resolve_names(self, guild: discord.Guild, member_ids: list[int]) -> dict[int, str]:
+		"""Display names for members, from the member cache where possible. Others are fetched once and kept in an LRU"""
+		names = {}
+		missing = []
+		for member_id in member_ids:
+			member = guild.get_member(member_id)
+			if member is not None:
+				names[member_id] = member.display_name
+			elif member_id in self.names:
+				self.names.move_to_end(member_id)
+				names[member_id] = self.names[member_id]
+			else:
+				user = self.bot.get_user(member_id)
+				if user is not None:
+					names[member_id] = user.display_name
+				else:
+					missing.append(member_id)
+		if missing:
+			users = await asyncio.gather(*(self.bot.fetch_user(member_id) for member_id in missing), return_exceptions=True)
+			for member_id, user in zip(missing, users):
+				if isinstance(user, discord.NotFound):
+					name = f'Unknown user ({member_id})'
+				elif isinstance(user, BaseException):
+					# transient failure, not worth remembering
+					names[member_id] = f'Unknown user ({member_id})'
+					continue
+				else:
+					name = user.display_name
+				names[member_id] = self.names[member_id] = name
+				if len(self.names) > self.name_cache_size:
+					self.names.popitem(last=False)
+		return names
+
+	async def render_leaderboard_page(self, guild: discord.Guild, category: str, page: int = 0) -> tuple[discord.Embed | None, int, int]:
+		"""Returns a formatted discord embed of one page of a leaderboard category, the page shown and the page count"""
+		timezone = self.reset_timezone(guild.id)
 
 		desc = ''
 		pretitle = ''
@@ -112,109 +266,259 @@ class Leaderboard(commands.Cog, name='Leaderboard'):
 		category = str.lower(category).replace(' ', '')
 		match category:
 			case 'current' | 'weekly':
+				category = 'current'
 				pretitle = 'Weekly'
 				footer = f'Resets 12AM Monday morning ({timezone}).'
 			case 'top' | 'record':
+				category = 'top'
 				pretitle = 'Highest Weekly'
 				footer = f'Updates 12AM Monday morning ({timezone}).'
 			case 'total' | 'alltime':
+				category = 'total'
 				pretitle = 'Total'
 				footer = 'Total time spent in VC since this bot has joined.'
 			case _:
-				return
-		lb = self.get_leaderboard(guild, category)
-		i = 0
-		if lb is not None:
-			for entry in lb:
-				if entry[1] == 0:
-					continue
-				i += 1
-				user = self.bot.get_user(int(entry[0]))
-				duration = datetime.timedelta(seconds=entry[1])
-				desc += f'**{i}.**\t\t{user.display_name} - {duration}\n'
-			if len(desc) == 0:
-				desc = 'No recorded activity.'
+				return None, 0, 0
+		sessions = self.vc_timelog.get(guild.id)
+		live = category != 'top' and bool(sessions)
+		# any change to the guild's scores, or someone joining VC, makes a memoized page stale
+		state = (self.store.version(guild.id), len(sessions) if live else 0)
+		page = max(page, 0)
+		key = (guild.id, category, page)
+		cached = self.pages.get(key)
+		if cached is not None and cached[0] == state and (not live or time.monotonic() - cached[1] < self.live_page_ttl):
+			self.pages.move_to_end(key)
+			return cached[2:]
+		pages = max(1, math.ceil(self.get_live_count(guild, category) / self.page_size))
+		shown = min(page, pages - 1)
+		lb = self.get_live_leaderboard(guild, category, self.page_size, shown * self.page_size)
+		if lb:
+			names = await self.resolve_names(guild, [member_id for member_id, _ in lb])
+			rank = shown * self.page_size
+			lines = []
+			for member_id, seconds in lb:
+				rank += 1
+				lines.append(f'**{rank}.**\t\t{names[member_id]} - {datetime.timedelta(seconds=seconds)}')
+			desc = '\n'.join(lines)
 		else:
 			desc = 'No recorded activity.'
+		if pages > 1:
+			footer = f'Page {shown + 1}/{pages} - {footer}'
 		embed = discord.Embed(title=f'{pretitle} VC Activity', description=desc)
 		embed.set_footer(text=footer)
-		return embed
+		embed = helpers.truncate_embed(embed)
+		self.pages[key] = (state, time.monotonic(), embed, shown, pages)
+		if len(self.pages) > self.page_cache_size:
+			self.pages.popitem(last=False)
+		return embed, shown, pages
 	
-	def reset_weekly_leaderboard(self):
-		"""Updates the 'personal best' (aka 'top') section on the leaderboard and resets the weekly leaderboard"""
-		self.logger.info('Resetting weekly leaderboard...')
-		jdata = {}
+	def reset_timezone(self, guild_id: int) -> str:
+		"""The timezone a guild's week resets in (its own, or the bot's)"""
+		if self.store.has_guild(guild_id):
+			return self.store.reset_timezone(guild_id) or self.bot.config['timezone']
+		return self.bot.config['timezone']
+
+	@staticmethod
+	def week_start(when: float, zone: zoneinfo.ZoneInfo, weeks: int = 0) -> float:
+		"""Unix time of midnight on the Monday of the week containing `when` in `zone`, moved by `weeks`"""
+		local = datetime.datetime.fromtimestamp(when, zone)
+		monday = local.date() - datetime.timedelta(days=local.weekday()) + datetime.timedelta(weeks=weeks)
+		# built from the local date rather than by adding seconds, so DST changes don't shift it
+		return datetime.datetime.combine(monday, datetime.time(), tzinfo=zone).timestamp()
+
+	def reset_zone(self, guild_id: int) -> datetime.tzinfo:
 		try:
-			with open('store/leaderboard.json', 'r') as f:
-				jdata = json.load(f)
+			return zoneinfo.ZoneInfo(self.reset_timezone(guild_id))
+		except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+			self.logger.warning(f'Unknown reset timezone for guild {guild_id}, using UTC')
+			return datetime.timezone.utc
+
+	def next_reset(self, guild_id: int, now: float) -> float:
+		"""Unix time of the guild's next weekly reset. At or before `now` when one is due, including missed ones"""
+		zone = self.reset_zone(guild_id)
+		last = self.store.last_reset(guild_id)
+		if last is None:
+			# first time this guild is scheduled: its week runs until the next boundary
+			self.store.mark_reset(guild_id, now)
+			last = now
+		start = self.week_start(now, zone)
+		if last < start:
+			return start
+		return self.week_start(now, zone, 1)
+
+	# weekly_reset itself mostly sleeps, so the reset each iteration performs is what gets timed
+	@metrics.timed('loop', 'Leaderboard.weekly_reset')
+	async def reset_weekly_leaderboard(self, guild_id: int, when: float):
+		"""Updates the 'personal best' (aka 'top') section on a guild's leaderboard and resets its weekly leaderboard"""
+		self.logger.info(f'Resetting weekly leaderboard for guild {guild_id}...')
+		# credit ongoing sessions to the week that is ending
+		self.commit_sessions(False, guild_id)
+		channelID = self.store.announce_channel(guild_id)
+		guild = self.bot.get_guild(guild_id)
+		if channelID != 0 and guild is not None:
+			embed, _, _ = await self.render_leaderboard_page(guild, 'current')
+			if embed:
+				helpers.send_message(self.bot, None, channelID, embed=embed)
+		scores = self.store.get_scores(guild_id, 'current')
+		if scores:
+			self.archive.add_week(guild_id, when, scores)
+		self.store.reset_weekly(guild_id, when)
+		if scores:
+			await self.archive.save(guild_id)
+
+	def commit_sessions(self, remove: bool, guild_id: int | None = None):
+		"""Credit the time of every ongoing VC session (in one guild, or all of them) to the leaderboard"""
+		self.apply_voice_events()
+		guild_ids = [guild_id] if guild_id is not None else list(self.vc_timelog)
+		for guild_id in guild_ids:
+			if guild_id not in self.vc_timelog:
+				continue
+			guild = self.bot.get_guild(guild_id)
+			if guild is None:
+				continue
+			member_id_list = list(self.vc_timelog[guild_id].keys())
+			for member_id in member_id_list:
+				member = guild.get_member(member_id)
+				if member:
+					self.update_leaderboard(member, remove)
+
+	def checkpoint_text(self) -> str:
+		sessions = {str(guild_id): {str(member_id): int(start.timestamp()) for member_id, start in members.items()}
+				for guild_id, members in self.vc_timelog.items() if members}
+		return json.dumps({'saved': int(time.time()), 'sessions': sessions}, separators=(',', ':'))
+
+	async def checkpoint_sessions(self, text: str):
+		"""Write the open VC sessions off the event loop. Skipped while there are none and the file already says so"""
+		empty = not any(self.vc_timelog.values())
+		# the old checkpoint is still needed until on_ready has reconciled it
+		if self.restored_sessions is not None or (empty and self.checkpoint_empty):
+			return
+		await asyncio.to_thread(helpers.atomic_write, self.checkpoint_path, text)
+		self.checkpoint_empty = empty
+
+	def load_checkpoint(self) -> tuple[float, dict] | None:
+		try:
+			with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+				data = json.load(f)
 		except FileNotFoundError:
-			self.logger.warning('ALERT: leaderboard file not found')
 			return
 		except json.JSONDecodeError as e:
-			self.logger.warning(f'ALERT: JSON decode error for leaderboard.json, {e}', exc_info=True)
+			self.logger.warning(f'ALERT: JSON decode error for {self.checkpoint_path}, {e}', exc_info=True)
 			return
-		for guild_id in jdata:
-			channelID = int(jdata[guild_id]['lb_announce_channel'])
-			if channelID != 0:
-				guild = self.bot.get_guild(int(guild_id))
-				embed = self.get_leaderboard_embed(guild, 'current')
-				channelID = int(jdata[guild_id]['lb_announce_channel'])
-				if embed:
-					helpers.send_message(None, channelID, embed=embed)
-			for member in jdata[guild_id]['current']:
-				# if we're not in the 'top' leaderboard, add our score. Otherwise we only replace it if this week has a higher score
-				if member not in jdata[guild_id]['top'] or jdata[guild_id]['current'][member] > jdata[guild_id]['top'][member]:
-					jdata[guild_id]['top'][member] = jdata[guild_id]['current'][member]
-				jdata[guild_id]['current'][member] = 0
-		with open('store/leaderboard.json', 'w') as f:
-			json.dump(jdata, f, indent=4)
+		sessions = {int(guild_id): {int(member_id): start for member_id, start in members.items()} for guild_id, members in data['sessions'].items()}
+		return data['saved'], sessions
+
+	def reconcile_sessions(self, saved: float, sessions: dict):
+		"""Resume checkpointed sessions of members still in VC, and credit the rest up to the checkpoint"""
+		now = time.time()
+		# after a long outage nobody can be assumed to have stayed in VC the whole time
+		resume = now - saved <= self.bot.config.get('vc_checkpoint_max_gap', 600)
+		resumed = 0
+		entries = []
+		for guild in self.bot.guilds:
+			members = sessions.pop(guild.id, {})
+			for vc in guild.voice_channels:
+				for member in vc.members:
+					start = members.pop(member.id, None)
+					if start is not None and resume:
+						self.leaderboard_begin_track(member, datetime.datetime.fromtimestamp(start))
+						resumed += 1
+						continue
+					if start is not None and saved > start:
+						entries.append((guild.id, member.id, int(saved - start)))
+					self.leaderboard_begin_track(member)
+			# left while the bot was down: they were there at least until the checkpoint
+			for member_id, start in members.items():
+				if saved > start:
+					entries.append((guild.id, member_id, int(saved - start)))
+		for guild_id in {entry[0] for entry in entries}:
+			if not self.store.has_guild(guild_id):
+				self.initialize_leaderboard(self.bot.get_guild(guild_id))
+		self.store.add_times(entries)
+		self.logger.info(f'Restored VC sessions from checkpoint: {resumed} resumed, {len(entries)} credited up to the checkpoint')
 
 	def on_shutdown(self):
-		for guild_id in self.vc_timelog:
-			member_id_list = list(self.vc_timelog[guild_id].keys())
-			for member_id in member_id_list:
-				member = self.bot.get_guild(guild_id).get_member(member_id)
-				if member:
-					self.update_leaderboard(member, True)
+		self.commit_sessions(True)
+		self.store.close()
+		# every session was just credited, so the restart must not resume any
+		if self.restored_sessions is None:
+			helpers.atomic_write(self.checkpoint_path, self.checkpoint_text())
+
+	async def cog_unload(self):
+		self.apply_voice_events()
+		self.flush_leaderboard.cancel()
+		self.weekly_reset.cancel()
+		if self.bot.reloading:
+			# the store stays open: lbstore itself can't change without a full restart
+			self.store.flush()
+			helpers.hand_over(self.bot, 'Leaderboard', store=self.store, archive=self.archive, vc_timelog=self.vc_timelog,
+					restored_sessions=self.restored_sessions, names=self.names, voice_stats=self.voice_stats, voice_stats_since=self.voice_stats_since)
+			return
+		self.store.close()
 	
 	@commands.Cog.listener()
+	@metrics.timed('listener')
 	async def on_ready(self):
+		self.apply_voice_events()
+		if self.restored_sessions is not None:
+			restored, self.restored_sessions = self.restored_sessions, None
+			self.reconcile_sessions(*restored)
+			return
+		# reconnected: keep sessions that carried on, start ones we missed and end ones whose leave we missed
 		for guild in self.bot.guilds:
+			tracked = self.vc_timelog.get(guild.id, {})
+			in_vc = set()
 			for vc in guild.voice_channels:
 				for member in vc.members:
-					self.leaderboard_begin_track(member)
+					in_vc.add(member.id)
+					if member.id not in tracked:
+						self.leaderboard_begin_track(member)
+			for member_id in [member_id for member_id in tracked if member_id not in in_vc]:
+				member = guild.get_member(member_id)
+				if member is not None:
+					self.update_leaderboard(member, True)
+				else:
+					tracked.pop(member_id)
 
 	@commands.Cog.listener()
+	@metrics.timed('listener')
 	async def on_voice_state_update(self, member, before, after):
-		# leaderboard
-		guild_id = member.guild.id
-		user_id = member.id
-
-		# User joined a voice channel
-		if before.channel is None and after.channel is not None:
-			self.leaderboard_begin_track(member)
-			print(f'{member.display_name} joined {after.channel.name} at {self.vc_timelog[guild_id][user_id]}')
-
-		# User left a voice channel
-		elif before.channel is not None and after.channel is None:
-			self.update_leaderboard(member, True)
-			print(f'{member.display_name} left {before.channel.name}')
+		# mute/deafen/stream changes within the same channel
+		if before.channel == after.channel:
+			return
+		when = datetime.datetime.now()
+		if before.channel is None:
+			self.logger.debug(f'{member.display_name} joined {after.channel.name}')
+		elif after.channel is None:
+			self.logger.debug(f'{member.display_name} left {before.channel.name}')
+		else:
+			self.logger.debug(f'{member.display_name} moved from {before.channel.name} to {after.channel.name}')
+		self.queue_voice_event(member, before.channel is not None, after.channel is not None, when)
 	
 	@commands.command()
-	async def leaderboard(self, ctx: commands.Context, category: str = 'current'):
+	async def leaderboard(self, ctx: commands.Context, category: str = 'current', page: int = 1):
 		"""Displays voice channel activity rankings"""
-		if ctx.guild.id in self.vc_timelog and self.vc_timelog[ctx.guild.id]:
-			member_id_list = list(self.vc_timelog[ctx.guild.id].keys())
-			for member_id in member_id_list:
-				member = ctx.guild.get_member(member_id)
-				if member:
-					self.update_leaderboard(member, False)
-		embed = self.get_leaderboard_embed(ctx.guild, category)
-		if embed:
-			await ctx.send(embed=embed)
+		embed, page, pages = await self.render_leaderboard_page(ctx.guild, category, page - 1)
+		if not embed:
+			return await ctx.send('Unknown category. Choose from current|top|total.')
+		if pages > 1:
+			view = LeaderboardPages(self, ctx.guild, category, page, pages)
+			view.message = await ctx.send(embed=embed, view=view)
 		else:
-			await ctx.send('Unknown category. Choose from current|top|total.')
+			await ctx.send(embed=embed)
 	
+	@commands.command()
+	async def vcstats(self, ctx: commands.Context):
+		"""Shows voice event ingestion statistics"""
+		if ctx.author.id != self.bot.config['dev_user_id']:
+			return await ctx.send('no')
+		stats = self.voice_stats
+		average = stats['events'] / max(time.monotonic() - self.voice_stats_since, 1)
+		mean_batch = stats['events'] / stats['batches'] if stats['batches'] else 0
+		await ctx.send(f'Voice events: {stats['events']} in {stats['batches']} batches (mean {mean_batch:.1f}, largest {stats['largest_batch']}), '
+				f'{stats['credited']} credits, {average:.2f} events/s average, {stats['peak_rate']:.0f} events/s peak, '
+				f'{self.voice_pending_events} pending')
+
 	@commands.command()
 	async def lbchannel(self, ctx: commands.Context, channel: discord.TextChannel):
 		"""Set weekly VC activity leaderboard report channel"""
@@ -222,15 +526,111 @@ class Leaderboard(commands.Cog, name='Leaderboard'):
 			return await ctx.send('Insufficient permissions.')
 		msg = self.set_leaderboard_channel(ctx.guild, channel)
 		await ctx.send(msg)
+
+	def week_label(self, guild_id: int, when: float) -> str:
+		# a week is archived at the reset that ends it, so label it by its last day
+		return (datetime.datetime.fromtimestamp(when, self.reset_zone(guild_id)) - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+
+	@staticmethod
+	def bar(value: int, peak: int, width: int = 16) -> str:
+		return '\N{FULL BLOCK}' * round(width * value / peak) if peak else ''
+
+	@commands.command(name='history', aliases=['vchistory'])
+	async def vchistory_command(self, ctx: commands.Context, member: typing.Optional[discord.Member] = None, weeks: int = 12):
+		"""Shows a member's VC time over their last weeks, with streaks and how they rank"""
+		member = member or ctx.author
+		weeks = min(max(weeks, 1), 52)
+		guild_history = self.archive.get(ctx.guild.id)
+		times, seconds = guild_history.recent(member.id, weeks)
+		if len(times) == 0 or not seconds.any():
+			return await ctx.send(f'No archived weeks for {member.display_name} yet.')
+		peak = int(seconds.max())
+		lines = [f'{self.week_label(ctx.guild.id, when)} {str(datetime.timedelta(seconds=int(s))):>9} {self.bar(int(s), peak)}' for when, s in zip(times, seconds)]
+		desc = '```\n' + '\n'.join(lines) + '\n```'
+		desc += f'\nCurrent streak: {guild_history.streak(member.id)} weeks (longest {guild_history.longest_streak(member.id)}).'
+		percentile = guild_history.percentile(member.id, weeks)
+		if percentile is not None:
+			desc += f'\nMore VC time than {percentile:.0f}% of active members over these weeks.'
+		embed = discord.Embed(title=f'{member.display_name} - last {len(times)} weeks', description=desc)
+		await ctx.send(embed=helpers.truncate_embed(embed))
+
+	@commands.command(aliases=['vctrend'])
+	async def lbtrend(self, ctx: commands.Context, weeks: int = 12):
+		"""Shows the server's total VC time and active members per week"""
+		weeks = min(max(weeks, 1), 52)
+		times, totals, active = self.archive.get(ctx.guild.id).trend(weeks)
+		if len(times) == 0:
+			return await ctx.send('No archived weeks yet.')
+		peak = int(totals.max())
+		lines = [f'{self.week_label(ctx.guild.id, when)} {int(total) // 3600:>5}h {int(count):>4} active {self.bar(int(total), peak, 12)}' for when, total, count in zip(times, totals, active)]
+		desc = '```\n' + '\n'.join(lines) + '\n```'
+		half = len(totals) // 2
+		if half > 0 and totals[:half].sum() > 0:
+			change = (totals[-half:].sum() / totals[:half].sum() - 1) * 100
+			desc += f'\nLast {half} weeks vs the {half} before: {change:+.0f}% VC time.'
+		embed = discord.Embed(title=f'Server VC activity - last {len(times)} weeks', description=desc)
+		await ctx.send(embed=helpers.truncate_embed(embed))
+
+	@commands.command()
+	async def lbtimezone(self, ctx: commands.Context, timezone: str = None):
+		"""Show or set the timezone the weekly leaderboard resets in (e.g. Australia/Sydney, or 'default')"""
+		if timezone is None:
+			return await ctx.send(f'The weekly leaderboard resets at 12AM Monday ({self.reset_timezone(ctx.guild.id)}).')
+		if ctx.author.guild_permissions.manage_channels == False:
+			return await ctx.send('Insufficient permissions.')
+		if timezone.lower() == 'default':
+			timezone = None
+		else:
+			try:
+				zoneinfo.ZoneInfo(timezone)
+			except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+				return await ctx.send('Unknown timezone. Use a name like *Australia/Sydney* or *Europe/London*.')
+		if not self.store.has_guild(ctx.guild.id):
+			self.initialize_leaderboard(ctx.guild)
+		self.store.set_reset_timezone(ctx.guild.id, timezone)
+		self.reset_wakeup.set()
+		await ctx.send(f'The weekly leaderboard will reset at 12AM Monday ({self.reset_timezone(ctx.guild.id)}).')
 	
-	@tasks.loop(seconds=60)
-	async def check_leaderboard_reset(self):
-		now = datetime.datetime.now().astimezone()
-		if now.hour == 0 and now.minute < 2 and now.strftime('%A') == "Monday":
-			# There's definately a better way to do this, but this is quick and handles timezone shifts. 3800 is arbitrary, just needs to be between 3600 and less than 604800.
-			if self.last_lb_update is None or (now - self.last_lb_update).seconds > 3800:
-				self.reset_weekly_leaderboard()
-				self.last_lb_update = now
+	@tasks.loop(seconds=30)
+	@metrics.timed('loop')
+	async def flush_leaderboard(self):
+		self.apply_voice_events()
+		# taken in the same tick as the store flush so the two agree about what has been credited
+		checkpoint = self.checkpoint_text()
+		if time.monotonic() - self.store.last_compact >= self.snapshot_interval:
+			await self.store.compact()
+		else:
+			self.store.flush()
+		await self.checkpoint_sessions(checkpoint)
+
+	@tasks.loop()
+	async def weekly_reset(self):
+		"""Sleeps until the next guild's reset instant, then resets every guild that is due"""
+		now = time.time()
+		due = []
+		wake_at = now + self.max_reset_sleep
+		for guild_id in self.store.guild_ids():
+			at = self.next_reset(guild_id, now)
+			if at <= now:
+				due.append(guild_id)
+			else:
+				wake_at = min(wake_at, at)
+		if due:
+			for i, guild_id in enumerate(due):
+				# spread out so many guilds resetting together don't stall the loop or burst the send queue
+				if i > 0:
+					await asyncio.sleep(self.reset_spread)
+				await self.reset_weekly_leaderboard(guild_id, time.time())
+			return
+		self.reset_wakeup.clear()
+		try:
+			await asyncio.wait_for(self.reset_wakeup.wait(), wake_at - now)
+		except TimeoutError:
+			pass
+
+	@weekly_reset.before_loop
+	async def before_weekly_reset(self):
+		await self.bot.wait_until_ready()
 
 async def setup(client):
 	await client.add_cog(Leaderboard(client))
\ No newline at end of file
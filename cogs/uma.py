@@ -1,10 +1,12 @@
 import discord
 from discord.ext import commands, tasks
 import logging
-import requests
-import os
 import json
+import os
 import helpers
+import webclient
+import dispatch
+import metrics
 
 class Uma(commands.Cog, name='Uma'):
 
@@ -15,98 +17,171 @@ class Uma(commands.Cog, name='Uma'):
 		self.bot = bot
 		self.logger = logging.getLogger(__name__)
 		self.logger.setLevel(logging.INFO)
-		if not os.path.exists('store/uma.json'):
-			with open('store/uma.json', 'w') as f:
-				json.dump({}, f)
+		# serverID -> {'last_news_id': ..., 'news_channel': ...}, mirrored to store/uma.json, or uma.json in each shard's directory
+		layout = bot.layout
+		self.state_paths = {shard: os.path.join(layout.directory(shard), 'uma.json') for shard in layout.shard_ids} if layout.partitioned else {None: 'store/uma.json'}
+		self.news_state = self.load_news_state()
+		self.poll_news.change_interval(minutes=bot.config.get('uma_poll_interval', 15))
+		self.poll_news.start()
+
+	async def cog_unload(self):
+		self.poll_news.cancel()
+
+	def load_news_state(self) -> dict:
+		state = {}
+		for path in self.state_paths.values():
+			try:
+				with open(path, 'r') as f:
+					state.update(json.load(f))
+			except FileNotFoundError:
+				pass
+			except json.JSONDecodeError as e:
+				self.logger.warning(f'ALERT: JSON decode error for {path}, {e}', exc_info=True)
+		return state
+
+	def save_news_state(self):
+		if None in self.state_paths:
+			helpers.atomic_write(self.state_paths[None], json.dumps(self.news_state))
+			return
+		for shard, part in self.bot.layout.split(self.news_state).items():
+			helpers.atomic_write(self.state_paths[shard], json.dumps(part))
 
 	def remember_news(self, serverID: str, news_id: str):
 		"""Remember that we've seen this news ID"""
-		jdata = {}
-		try:
-			with open('store/uma.json', 'r') as f:
-				jdata = json.load(f)
-		except (FileNotFoundError, json.JSONDecodeError):
-			jdata = {}
-		if serverID not in jdata:
-			jdata[serverID] = {}
-		jdata[serverID]['last_news_id'] = news_id
-		with open('store/uma.json', 'w') as f:
-			json.dump(jdata, f)
+		state = self.news_state.setdefault(serverID, {})
+		if state.get('last_news_id') == news_id:
+			return
+		state['last_news_id'] = news_id
+		self.save_news_state()
 	
 	def has_seen_news(self, serverID: str, news_id: str) -> bool:
 		"""Check if we've seen this news ID before"""
-		jdata = {}
-		try:
-			with open('store/uma.json', 'r') as f:
-				jdata = json.load(f)
-		except (FileNotFoundError, json.JSONDecodeError):
-			return False
-		if serverID not in jdata:
-			return False
-		return jdata[serverID]['last_news_id'] == news_id
+		return serverID in self.news_state and self.news_state[serverID].get('last_news_id') == news_id
+
+	def unseen_news(self, serverID: str, entries: list[dict]) -> list[dict]:
+		"""Returns the entries (newest first) announced after the last one this server has seen"""
+		unseen = []
+		for entry in entries:
+			if self.has_seen_news(serverID, str(entry['announce_id'])):
+				break
+			unseen.append(entry)
+		return unseen
+
+	async def fetch_news(self, limit: int, fresh: bool = False) -> list[dict] | None:
+		"""Returns the latest news entries, newest first, or None on a bad API response. Raises webclient.WebError.
+		`fresh` skips the cache (while still refreshing it for !uma), as the poller must not post stale news"""
+		request = {'announce_label': 1, 'limit': limit, 'offset': 0}
+		json = await self.bot.web.request_json('POST', self.url, json_body=request, timeout=4,
+				ttl=self.bot.config.get('uma_cache_ttl', 300), stale_ttl=self.bot.config.get('uma_cache_stale', 3600), fresh=fresh)
+		if not json['response_code'] or json['response_code'] != 1 or not json['information_list']:
+			return
+		return json['information_list']
+
+	def news_embed(self, entry: dict) -> discord.Embed:
+		title = f'**{entry['title'].replace('*', '\\*')}**'
+		message = ''
+		if entry['message']:
+			message = helpers.html_to_discord(entry['message'])
+		embed = discord.Embed(title=title, description=message)
+		if entry['image']:
+			embed.set_image(url=entry['image'])
+		footer = 'No date provided.'
+		if entry['post_at']:
+			footer = f'Announced: {entry['post_at']}'
+		embed.set_footer(text=footer)
+		return helpers.truncate_embed(embed)
+
+	async def send_news(self, destination: discord.abc.Messageable, embeds: list[discord.Embed]) -> int:
+		"""Sends news embeds in as few messages as the limits allow. Returns the number of messages sent"""
+		messages = helpers.pack_embeds(embeds)
+		for chunk in messages:
+			await destination.send(embeds=chunk)
+		return len(messages)
 
 	@commands.command(aliases=['umabanner'])
 	async def uma(self, ctx: commands.Context, force_n: int = 0):
 		"""Displays the current Umamusume news. Provide number to display last x announcements"""
-
-		request = {'announce_label': 1, 'limit': self.news_entry_limit, 'offset': 0}
-		if force_n > 0:
-			request['limit'] = min(force_n, self.news_entry_limit)
-
-		json = {}
+		entries = None
 		try:
-			response = requests.post(self.url, json=request, timeout=4)
-			if not response.ok:
+			entries = await self.fetch_news(self.news_entry_limit)
+		except webclient.WebError as e:
+			if e.status is not None:
 				await ctx.send('Failed to fetch banner information.')
-				return
-			json = response.json()
-		except (requests.RequestException, requests.exceptions.JSONDecodeError) as e:
-			await ctx.send('An error occurred while fetching banner information.')
+			else:
+				await ctx.send('An error occurred while fetching banner information.')
 			self.logger.error(f'Error fetching uma banner info: {e}')
 			return
-		if not json['response_code'] or json['response_code'] != 1 or not json['information_list']:
+		if not entries:
 			await ctx.send('Bad API response - No banner information available.')
 			return
-		embeds = []
-		total_embed_chars = 0
-		segmented = False
-		for entry in json['information_list']:
-			# check if we've seen this news before
-			if force_n == 0 and self.has_seen_news(str(ctx.guild.id), str(entry['announce_id'])):
-				break
-			title = f'**{entry['title'].replace('*', '\\*')}**'
-			if len(title) > 256:
-				title = title[:253] + '...'
-			message = ''
-			if entry['message']:
-				message = helpers.html_to_discord(entry['message'])
-				if len(message) > 4090:
-					message = message[:4090] + '...'
-			embed = discord.Embed(title=title, description=message)
-			if entry['image']:
-				embed.set_image(url=entry['image'])
-			footer = 'No date provided.'
-			if entry['post_at']:
-				footer = f'Announced: {entry['post_at']}'
-			embed.set_footer(text=footer)
-			# total embed length limit is 6000 characters
-			total_embed_chars += len(title) + len(message) + len(footer)
-			if total_embed_chars > 6000:
-				await ctx.send(embeds=embeds)
-				embeds = []
-				total_embed_chars = 0
-				segmented = True
-			else:
-				embeds.append(embed)
-		if len(embeds) > 0:
-			await ctx.send(embeds=embeds)
-		elif not segmented:
+		if force_n > 0:
+			entries = entries[:force_n]
+		else:
+			entries = self.unseen_news(str(ctx.guild.id), entries)
+		sent = await self.send_news(ctx, [self.news_embed(entry) for entry in entries])
+		if sent == 0:
 			if force_n != 0:
 				await ctx.send('No announcements found.')
 			else:
 				await ctx.send('No new announcements.')
-		if len(json['information_list']) > 0:
-			self.remember_news(str(ctx.guild.id), str(json['information_list'][0]['announce_id']))
+		if len(entries) > 0:
+			self.remember_news(str(ctx.guild.id), str(entries[0]['announce_id']))
+
+	@commands.command()
+	async def umachannel(self, ctx: commands.Context, channel: discord.TextChannel = None):
+		"""Set the channel new Umamusume news is posted to automatically. Omit the channel to stop"""
+		if ctx.author.guild_permissions.manage_channels == False:
+			return await ctx.send('Insufficient permissions.')
+		state = self.news_state.setdefault(str(ctx.guild.id), {})
+		if channel is None:
+			state.pop('news_channel', None)
+			msg = 'Umamusume news will no longer be posted automatically.'
+		else:
+			state['news_channel'] = str(channel.id)
+			msg = f'Umamusume news will be posted in {channel.mention}.'
+		self.save_news_state()
+		await ctx.send(msg)
+
+	@tasks.loop(minutes=15)
+	@metrics.timed('loop')
+	async def poll_news(self):
+		"""Fetches the news once and posts what each subscribed server hasn't seen yet"""
+		subscribed = [(serverID, state) for serverID, state in self.news_state.items() if state.get('news_channel')]
+		if not subscribed:
+			return
+		try:
+			entries = await self.fetch_news(self.news_entry_limit, fresh=True)
+		except webclient.WebError as e:
+			self.logger.error(f'Error polling uma news: {e}')
+			return
+		if not entries:
+			return
+		latest = str(entries[0]['announce_id'])
+		# built once per poll and shared by every server
+		embeds = {}
+		changed = False
+		for serverID, state in subscribed:
+			if state.get('last_news_id') == latest:
+				continue
+			# a newly subscribed server starts from the current news instead of getting a backlog
+			if state.get('last_news_id') is not None:
+				channel = self.bot.get_channel(int(state['news_channel']))
+				unseen = self.unseen_news(serverID, entries)
+				if channel is not None and unseen:
+					for entry in unseen:
+						if entry['announce_id'] not in embeds:
+							embeds[entry['announce_id']] = self.news_embed(entry)
+					# queued rather than awaited, so a slow or rate limited channel doesn't hold up the rest
+					for chunk in helpers.pack_embeds([embeds[entry['announce_id']] for entry in unseen]):
+						self.bot.dispatcher.submit(channel, embeds=chunk, priority=dispatch.PRIORITY_LOW)
+			state['last_news_id'] = latest
+			changed = True
+		if changed:
+			self.save_news_state()
+
+	@poll_news.before_loop
+	async def before_poll_news(self):
+		await self.bot.wait_until_ready()
 
 
 async def setup(client):
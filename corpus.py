@@ -0,0 +1,592 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import math
+import os
+import random
+import re
+import struct
+import threading
+from array import array
+import helpers
+import metrics
+
+token_re = re.compile(r'\w{3,}')
+url_re = re.compile(r'https?://\S+')
+
+def tokenize(text: str) -> set[str]:
+	"""Lowercase words of 3+ characters, ignoring URLs"""
+	return set(token_re.findall(url_re.sub(' ', text.lower())))
+
+class InvertedIndex:
+	"""Token -> corpus slot posting lists, for finding lines that share words with a message.
+
+	Posting lists are uint32 arrays capped at `max_postings` (oldest entries dropped first), which bounds both memory
+	and the cost of a lookup for very common words.
+	"""
+	header = struct.Struct('<4sQI')
+	entry = struct.Struct('<HI')
+	magic = b'INV1'
+
+	def __init__(self, max_postings: int = 256):
+		self.max_postings = max_postings
+		self.postings = {}
+
+	def add(self, slot: int, tokens: set[str]):
+		for token in tokens:
+			posting = self.postings.get(token)
+			if posting is None:
+				self.postings[token] = array('I', (slot,))
+				continue
+			if len(posting) >= self.max_postings:
+				del posting[0]
+			posting.append(slot)
+
+	def remove(self, slot: int, tokens: set[str]):
+		for token in tokens:
+			posting = self.postings.get(token)
+			if posting is None:
+				continue
+			try:
+				posting.remove(slot)
+			except ValueError:
+				continue
+			if not posting:
+				del self.postings[token]
+
+	def search(self, tokens: set[str], line_count: int, candidates: int = 5) -> int | None:
+		"""Pick a slot sharing tokens with the query, weighted towards rarer shared words"""
+		scores = {}
+		for token in tokens:
+			posting = self.postings.get(token)
+			if posting is None:
+				continue
+			weight = math.log(1 + line_count / len(posting))
+			for slot in posting:
+				scores[slot] = scores.get(slot, 0) + weight
+		if not scores:
+			return
+		best = heapq.nlargest(candidates, scores.items(), key=lambda item: item[1])
+		return random.choices([slot for slot, _ in best], [score for _, score in best])[0]
+
+	def dumps(self, size: int) -> bytes:
+		"""Serialize, tagged with the corpus size it was built for"""
+		parts = [self.header.pack(self.magic, size, len(self.postings))]
+		for token, posting in self.postings.items():
+			encoded = token.encode('utf-8')
+			parts.append(self.entry.pack(len(encoded), len(posting)))
+			parts.append(encoded)
+			parts.append(posting.tobytes())
+		return b''.join(parts)
+
+	def loads(self, data: bytes, size: int) -> bool:
+		"""Load a serialized index. Returns False if it is damaged or was built for a different corpus size"""
+		try:
+			magic, saved_size, count = self.header.unpack_from(data)
+			if magic != self.magic or saved_size != size:
+				return False
+			postings = {}
+			pos = self.header.size
+			for _ in range(count):
+				token_length, posting_length = self.entry.unpack_from(data, pos)
+				pos += self.entry.size
+				token = data[pos:pos + token_length].decode('utf-8')
+				pos += token_length
+				posting = array('I')
+				posting.frombytes(data[pos:pos + posting_length * posting.itemsize])
+				pos += posting_length * posting.itemsize
+				postings[token] = posting
+		except (struct.error, UnicodeDecodeError, ValueError):
+			return False
+		self.postings = postings
+		return True
+
+class Corpus:
+	"""Line corpus kept as a bounded, uniform sample of every unique line recorded into it.
+
+	Lines live in a text file and a side index maps each slot of the sample to its line's offset, so a random
+	line costs one seek. Once `max_lines` slots are full, new lines replace a random slot with reservoir
+	sampling probability; evicted lines stay in the file as garbage until it is compacted. Lines already in
+	the sample are rejected by hash. With `relevance`, an inverted index of the sample is kept alongside.
+
+	Each batch appends its slot changes to a journal; the index (and inverted index) files are only rewritten
+	when the corpus is compacted or closed, or the journal outgrows the index.
+	"""
+	header = struct.Struct('<4sQQQ')
+	magic = b'CRP1'
+	# (slot, offset, hash, length), or (batch_end, size, seen, garbage) after each batch's slot changes
+	journal_record = struct.Struct('<IQQQ')
+	batch_end = 0xFFFFFFFF
+	chunk_size = 1 << 20
+
+	def __init__(self, path: str, max_lines: int | None = None, relevance: bool = False, read_only: bool = False):
+		self.path = path
+		self.index_path = os.path.splitext(path)[0] + '.idx'
+		self.inverted_path = os.path.splitext(path)[0] + '.inv'
+		self.journal_path = os.path.splitext(path)[0] + '.journal'
+		self.max_lines = max_lines
+		self.relevance = relevance
+		# never writes, saves or truncates anything; an index that doesn't match is built in memory only
+		self.read_only = read_only
+		self.logger = logging.getLogger(__name__)
+		self.write_lock = threading.Lock()
+		# held while the file is rewritten, which moves every line
+		self.compact_lock = threading.Lock()
+		self.load_index()
+
+	def __len__(self) -> int:
+		return len(self.offsets)
+
+	def reset(self):
+		# per slot: line offset, line hash and line length (including the newline)
+		self.offsets = array('Q')
+		self.hashes = array('Q')
+		self.lengths = array('I')
+		self.known = set()
+		# unique lines offered so far, for reservoir sampling
+		self.seen = 0
+		# bytes of the corpus file covered by the index, and how many of them belong to evicted lines
+		self.size = 0
+		self.garbage = 0
+		self.inverted = InvertedIndex() if self.relevance else None
+		# whether place() keeps the inverted index up to date (off while it is going to be rebuilt anyway)
+		self.inverted_live = self.relevance
+		# header of the saved index, which starts the journal so a journal older than the index is ignored,
+		# and the sizes of the saved index and the journal
+		self.saved_header = None
+		self.saved_size = 0
+		self.journal_size = 0
+
+	@staticmethod
+	def line_hash(data: bytes) -> int:
+		return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+	def load_index(self):
+		"""Load the index, feeding lines appended since through the sampler, or rebuild it if it doesn't match the corpus"""
+		self.reset()
+		if not os.path.exists(self.path):
+			return
+		file_size = os.path.getsize(self.path)
+		try:
+			with open(self.index_path, 'rb') as f:
+				data = f.read()
+			magic, self.seen, self.size, self.garbage = self.header.unpack_from(data)
+			count = (len(data) - self.header.size) // 20
+			if magic != self.magic or self.size > file_size or len(data) != self.header.size + count * 20:
+				raise ValueError('index does not match corpus')
+			pos = self.header.size
+			self.offsets.frombytes(data[pos:pos + count * 8])
+			self.hashes.frombytes(data[pos + count * 8:pos + count * 16])
+			self.lengths.frombytes(data[pos + count * 16:])
+			self.known.update(self.hashes)
+			self.saved_header = data[:self.header.size]
+			self.saved_size = len(data)
+			self.replay_journal()
+			if self.size > file_size:
+				raise ValueError('journal does not match corpus')
+		except FileNotFoundError:
+			self.reset()
+		except (struct.error, ValueError):
+			self.logger.warning(f'Index for {self.path} is stale, rebuilding')
+			self.reset()
+		if self.inverted is not None:
+			self.inverted_live = self.load_inverted()
+		changed = self.size < file_size
+		if changed:
+			ingested = self.ingest()
+			self.logger.info(f'Indexed {ingested} lines of {self.path}')
+		if self.inverted is not None and not self.inverted_live:
+			self.rebuild_inverted()
+			changed = True
+		if changed and not self.read_only:
+			self.save_index()
+		self.inverted_live = self.relevance
+
+	def replay_journal(self):
+		"""Apply the slot changes journaled since the index was saved, up to the last complete batch"""
+		try:
+			with open(self.journal_path, 'rb') as f:
+				data = f.read()
+		except FileNotFoundError:
+			return
+		if not data.startswith(self.saved_header):
+			# left over from before the index was last saved
+			return
+		pos = applied = len(self.saved_header)
+		pending = []
+		while pos + self.journal_record.size <= len(data):
+			record = self.journal_record.unpack_from(data, pos)
+			pos += self.journal_record.size
+			if record[0] != self.batch_end:
+				pending.append(record)
+				continue
+			for slot, offset, line_hash, length in pending:
+				if slot > len(self.offsets):
+					raise ValueError('journal does not match index')
+				self.set_slot(slot, offset, line_hash, length)
+			pending = []
+			_, self.size, self.seen, self.garbage = record
+			applied = pos
+		if applied < len(data) and not self.read_only:
+			# torn batch from a crash; its lines are past self.size, so they are ingested again
+			os.truncate(self.journal_path, applied)
+		self.journal_size = applied
+
+	def load_inverted(self) -> bool:
+		try:
+			with open(self.inverted_path, 'rb') as f:
+				return self.inverted.loads(f.read(), self.size)
+		except FileNotFoundError:
+			return False
+
+	def rebuild_inverted(self):
+		self.inverted = InvertedIndex()
+		with open(self.path, 'rb') as f:
+			data = f.read(self.size)
+		for slot, (offset, length) in enumerate(zip(self.offsets, self.lengths)):
+			self.inverted.add(slot, tokenize(data[offset:offset + length].decode('utf-8', 'replace')))
+		self.logger.info(f'Rebuilt inverted index of {self.path} ({len(self.inverted.postings)} tokens)')
+
+	def ingest(self) -> int:
+		"""Sample the complete lines of the file past self.size, which are already on disk"""
+		count = 0
+		with open(self.path, 'rb') as f:
+			f.seek(self.size)
+			buffer = b''
+			while chunk := f.read(self.chunk_size):
+				buffer += chunk
+				start = 0
+				while (end := buffer.find(b'\n', start)) != -1:
+					length = end + 1 - start
+					line_hash = self.line_hash(buffer[start:end])
+					slot = self.choose_slot(line_hash)
+					if slot is None:
+						self.garbage += length
+					else:
+						self.place(slot, self.size, line_hash, length, buffer[start:end])
+					self.size += length
+					start = end + 1
+					count += 1
+				buffer = buffer[start:]
+		if buffer and not self.read_only:
+			# torn write from a crash; drop it so the next append starts on a fresh line
+			self.logger.warning(f'Dropping {len(buffer)} bytes of incomplete line at the end of {self.path}')
+			os.truncate(self.path, self.size)
+		return count
+
+	def choose_slot(self, line_hash: int, pending: set = (), count: int | None = None) -> int | None:
+		"""Reservoir sampling step for a new line. Returns the slot it should take, or None to discard it.
+		`pending` and `count` account for lines chosen but not placed yet"""
+		if line_hash in self.known or line_hash in pending:
+			return
+		self.seen += 1
+		if count is None:
+			count = len(self.offsets)
+		if self.max_lines is None or count < self.max_lines:
+			return count
+		slot = random.randrange(self.seen)
+		if slot < self.max_lines:
+			return slot
+
+	def place(self, slot: int, offset: int, line_hash: int, length: int, line: bytes):
+		evicted = None
+		if slot < len(self.offsets):
+			if self.inverted_live:
+				evicted = tokenize(self.read_slot(slot))
+			self.garbage += self.lengths[slot]
+		self.set_slot(slot, offset, line_hash, length)
+		# only once the slot exists: relevant_line searches from the loop while this runs on the writer thread
+		if self.inverted_live:
+			if evicted is not None:
+				self.inverted.remove(slot, evicted)
+			self.inverted.add(slot, tokenize(line.decode('utf-8', 'replace')))
+
+	def set_slot(self, slot: int, offset: int, line_hash: int, length: int):
+		if slot == len(self.offsets):
+			self.offsets.append(offset)
+			self.hashes.append(line_hash)
+			self.lengths.append(length)
+		else:
+			self.known.discard(self.hashes[slot])
+			self.offsets[slot] = offset
+			self.hashes[slot] = line_hash
+			self.lengths[slot] = length
+		self.known.add(line_hash)
+
+	def save_index(self):
+		"""Write the whole index (and inverted index) and start a new journal"""
+		header = self.header.pack(self.magic, self.seen, self.size, self.garbage)
+		data = header + self.offsets.tobytes() + self.hashes.tobytes() + self.lengths.tobytes()
+		helpers.atomic_write(self.index_path, data)
+		if os.path.exists(self.journal_path):
+			os.remove(self.journal_path)
+		self.saved_header = header
+		self.saved_size = len(data)
+		self.journal_size = 0
+		if self.inverted is not None:
+			helpers.atomic_write(self.inverted_path, self.inverted.dumps(self.size))
+
+	def write_journal(self, placements: list[tuple]):
+		"""Append a batch's slot changes, or save the whole index once the journal would outgrow it"""
+		records = b''.join(self.journal_record.pack(slot, offset, line_hash, length) for slot, offset, line_hash, length, _ in placements)
+		records += self.journal_record.pack(self.batch_end, self.size, self.seen, self.garbage)
+		if self.saved_header is None or self.journal_size + len(records) > self.saved_size:
+			self.save_index()
+			return
+		with open(self.journal_path, 'ab') as f:
+			if self.journal_size == 0:
+				f.write(self.saved_header)
+				self.journal_size = len(self.saved_header)
+			f.write(records)
+		self.journal_size += len(records)
+		metrics.wrote(self.journal_path, len(records))
+
+	def close(self):
+		"""Fold the journal into the index files"""
+		with self.write_lock:
+			if self.journal_size:
+				self.save_index()
+
+	def read_slot(self, slot: int) -> str:
+		with open(self.path, 'rb') as f:
+			f.seek(self.offsets[slot])
+			return f.read(self.lengths[slot]).decode('utf-8', 'replace').rstrip('\n')
+
+	def append(self, line: str):
+		"""Offer a line (must not contain newlines) to the corpus"""
+		self.append_many([line])
+
+	def append_many(self, lines: list[str]):
+		"""Offer lines to the corpus, writing the accepted ones with one write. Safe to call from a worker thread"""
+		with self.write_lock:
+			data = bytearray()
+			placements = []
+			pending = set()
+			count = len(self.offsets)
+			for line in lines:
+				encoded = line.encode('utf-8')
+				line_hash = self.line_hash(encoded)
+				slot = self.choose_slot(line_hash, pending, count)
+				if slot is None:
+					continue
+				if slot == count:
+					count += 1
+				pending.add(line_hash)
+				# a later line in the batch may evict this one again, so placements are applied in order
+				placements.append((slot, self.size + len(data), line_hash, len(encoded) + 1, encoded))
+				data += encoded
+				data += b'\n'
+			if not data:
+				return
+			with open(self.path, 'ab') as f:
+				f.write(data)
+			metrics.wrote(self.path, len(data))
+			for placement in placements:
+				self.place(*placement)
+			self.size += len(data)
+			if self.garbage > max(self.size - self.garbage, self.chunk_size):
+				self.compact()
+			else:
+				self.write_journal(placements)
+
+	def compact(self):
+		"""Rewrite the file with only the sampled lines. Caller holds write_lock"""
+		with open(self.path, 'rb') as f:
+			data = f.read(self.size)
+		out = bytearray()
+		offsets = array('Q')
+		for offset, length in zip(self.offsets, self.lengths):
+			offsets.append(len(out))
+			out += data[offset:offset + length]
+		with self.compact_lock:
+			helpers.atomic_write(self.path, bytes(out))
+			self.offsets = offsets
+			self.size = len(out)
+			self.garbage = 0
+		self.save_index()
+		self.logger.info(f'Compacted {self.path} to {len(self.offsets)} lines')
+
+	def random_line(self) -> str | None:
+		with self.compact_lock:
+			if not self.offsets:
+				return
+			return self.read_slot(random.randrange(len(self.offsets)))
+
+	def relevant_line(self, text: str) -> str | None:
+		"""A line sharing words with `text`, or None if there is none (or relevance is off)"""
+		if self.inverted is None:
+			return
+		tokens = tokenize(text)
+		if not tokens:
+			return
+		slot = self.inverted.search(tokens, len(self.offsets))
+		if slot is None:
+			return
+		with self.compact_lock:
+			return self.read_slot(slot)
+
+
+class GuildCorpora:
+	"""One bounded corpus per guild, opened on first use.
+
+	The old global corpus, if present, is opened read-only by `load_fallback` as a fallback for guilds that have
+	not recorded anything yet. Loading a corpus can mean reading the whole file, so on the loop corpora are
+	opened with `open`, which loads them in a worker thread.
+	"""
+	def __init__(self, directory: str = 'store/conversation', max_lines: int = 20000, relevance: bool = False, fallback: str = 'store/conversation.txt'):
+		self.directory = directory
+		self.max_lines = max_lines
+		self.relevance = relevance
+		self.corpora = {}
+		# guild ID -> task loading its corpus, so concurrent opens share one load
+		self.loading = {}
+		os.makedirs(directory, exist_ok=True)
+		self.fallback_path = fallback
+		self.fallback = None
+
+	async def load_fallback(self):
+		if self.fallback is None and os.path.exists(self.fallback_path):
+			self.fallback = await asyncio.to_thread(Corpus, self.fallback_path, read_only=True)
+
+	def path(self, guild_id: int) -> str:
+		return os.path.join(self.directory, f'{guild_id}.txt')
+
+	def get(self, guild_id: int) -> Corpus:
+		"""The guild's corpus, loaded synchronously if it isn't open yet"""
+		corpus = self.corpora.get(guild_id)
+		if corpus is None:
+			corpus = self.corpora[guild_id] = Corpus(self.path(guild_id), self.max_lines, self.relevance)
+		return corpus
+
+	async def open(self, guild_id: int) -> Corpus:
+		"""The guild's corpus, loaded in a worker thread if it isn't open yet"""
+		corpus = self.corpora.get(guild_id)
+		if corpus is not None:
+			return corpus
+		task = self.loading.get(guild_id)
+		if task is None:
+			task = self.loading[guild_id] = asyncio.ensure_future(asyncio.to_thread(Corpus, self.path(guild_id), self.max_lines, self.relevance))
+			task.add_done_callback(lambda _: self.loading.pop(guild_id, None))
+		corpus = await asyncio.shield(task)
+		return self.corpora.setdefault(guild_id, corpus)
+
+	def has_lines(self, guild_id: int) -> bool:
+		return len(self.get(guild_id)) > 0 or (self.fallback is not None and len(self.fallback) > 0)
+
+	def random_line(self, guild_id: int) -> str | None:
+		corpus = self.get(guild_id)
+		if len(corpus) == 0 and self.fallback is not None:
+			corpus = self.fallback
+		return corpus.random_line()
+
+	def relevant_line(self, guild_id: int, text: str) -> str | None:
+		return self.get(guild_id).relevant_line(text)
+
+	def close(self):
+		for corpus in list(self.corpora.values()):
+			corpus.close()
+
+
+class CorpusWriter:
+	"""Single background task that appends queued (guild ID, line) pairs to the guild corpora in batches.
+
+	A batch is written once it holds `batch_size` lines or `flush_interval` seconds after its first line.
+	When the queue is full, `policy` decides: 'drop_oldest', 'drop_newest' or 'block' (wait for space).
+	"""
+	def __init__(self, corpora: GuildCorpora, max_queue: int = 1000, batch_size: int = 50, flush_interval: float = 5.0, policy: str = 'drop_oldest'):
+		if policy not in ('drop_oldest', 'drop_newest', 'block'):
+			raise ValueError(f'Unknown corpus writer policy {policy!r}')
+		self.corpora = corpora
+		self.queue = asyncio.Queue(max_queue)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.policy = policy
+		self.logger = logging.getLogger(__name__)
+		self.task = None
+		# lines taken off the queue but not yet handed to a write
+		self.batch = []
+		self.written = 0
+		self.dropped = 0
+
+	def start(self):
+		if self.task is None or self.task.done():
+			self.task = asyncio.get_running_loop().create_task(self.run())
+
+	async def put(self, guild_id: int, line: str) -> bool:
+		"""Queue a line for writing. Returns False if it was dropped"""
+		if self.policy == 'block':
+			await self.queue.put((guild_id, line))
+			return True
+		if self.queue.full():
+			self.dropped += 1
+			if self.policy == 'drop_newest':
+				return False
+			self.queue.get_nowait()
+		self.queue.put_nowait((guild_id, line))
+		return True
+
+	def take(self, limit: int) -> list[tuple[int, str]]:
+		lines = []
+		while len(lines) < limit and not self.queue.empty():
+			lines.append(self.queue.get_nowait())
+		return lines
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			self.batch.append(await self.queue.get())
+			deadline = loop.time() + self.flush_interval
+			while len(self.batch) < self.batch_size:
+				self.batch += self.take(self.batch_size - len(self.batch))
+				timeout = deadline - loop.time()
+				if len(self.batch) >= self.batch_size or timeout <= 0:
+					break
+				try:
+					self.batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+				except TimeoutError:
+					break
+			batch, self.batch = self.batch, []
+			await asyncio.to_thread(self.write, await self.open_groups(batch))
+
+	def group(self, batch: list[tuple[int, str]]) -> dict[int, list[str]]:
+		"""Split a batch per guild"""
+		lines = {}
+		for guild_id, line in batch:
+			lines.setdefault(guild_id, []).append(line)
+		return lines
+
+	async def open_groups(self, batch: list[tuple[int, str]]) -> list[tuple[Corpus, list[str]]]:
+		# corpora are opened through GuildCorpora, so only one object ever owns a file
+		return [(await self.corpora.open(guild_id), lines) for guild_id, lines in self.group(batch).items()]
+
+	def write(self, groups: list[tuple[Corpus, list[str]]]):
+		for corpus, lines in groups:
+			try:
+				corpus.append_many(lines)
+				self.written += len(lines)
+			except OSError as e:
+				self.logger.error(f'Failed to write {len(lines)} lines to {corpus.path}: {e}')
+
+	def drain(self):
+		"""Stop the writer and synchronously write everything still queued"""
+		if self.task is not None:
+			self.task.cancel()
+			self.task = None
+		batch, self.batch = self.batch + self.take(self.queue.qsize()), []
+		# at shutdown, so corpora not open yet are loaded right here
+		self.write([(self.corpora.get(guild_id), lines) for guild_id, lines in self.group(batch).items()])
+		self.corpora.close()
+
+	async def close(self):
+		"""Stop the writer after the current batch and write everything still queued"""
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+		batch, self.batch = self.batch + self.take(self.queue.qsize()), []
+		await asyncio.to_thread(self.write, await self.open_groups(batch))
+		await asyncio.to_thread(self.corpora.close)
@@ -0,0 +1,201 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import discord
+import ratelimit
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class QueueFull(Exception):
+	"""The dispatcher is holding as many messages as it is allowed to"""
+
+class Outgoing:
+	__slots__ = ('priority', 'seq', 'channel', 'content', 'embeds', 'future', 'queued_at', 'attempts')
+
+	def __init__(self, priority: int, seq: int, channel, content: str | None, embeds: list[discord.Embed], future: asyncio.Future):
+		self.priority = priority
+		self.seq = seq
+		self.channel = channel
+		self.content = content
+		self.embeds = embeds
+		self.future = future
+		self.queued_at = time.monotonic()
+		self.attempts = 0
+
+	def __lt__(self, other) -> bool:
+		return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Dispatcher:
+	"""Queue for outbound messages that paces sends to Discord's rate limits.
+
+	Each channel has its own queue (priority first, then FIFO) and token bucket, and every send also takes
+	from a global bucket. Channels that are ready are served in priority order; a channel that is rate
+	limited (including after a 429) waits without holding up the others. Consecutive plain-text messages to
+	the same channel are joined into one send while they fit in one message. `submit` returns a future for
+	the sent discord.Message, so callers can await it, poll it or attach a callback.
+	"""
+	coalesce_limit = 2000
+	max_attempts = 5
+
+	def __init__(self, channel_rate: tuple[int, float] = (5, 5.0), global_rate: tuple[int, float] = (50, 1.0), max_queue: int = 1000):
+		self.channel_rate = channel_rate
+		self.global_bucket = ratelimit.TokenBucket(*global_rate)
+		self.max_queue = max_queue
+		self.logger = logging.getLogger(__name__)
+		self.seq = itertools.count()
+		# channel ID -> heap of Outgoing
+		self.queues = {}
+		self.buckets = ratelimit.TokenBuckets(*channel_rate)
+		# (priority, seq, channel ID) of each channel's head message; entries go stale and are skipped
+		self.ready = []
+		# (ready at, channel ID) for channels waiting on their bucket
+		self.waiting = []
+		self.size = 0
+		self.wakeup = asyncio.Event()
+		self.task = None
+		self.metrics = {'queued': 0, 'sent': 0, 'api_calls': 0, 'coalesced': 0, 'retried': 0, 'rate_limited': 0, 'failed': 0, 'dropped': 0, 'delay_total': 0.0}
+
+	def submit(self, channel: discord.abc.Messageable, content: str | None = None, *, embed: discord.Embed | None = None,
+			embeds: list[discord.Embed] | None = None, priority: int = PRIORITY_NORMAL) -> asyncio.Future:
+		"""Queue a message. The returned future resolves to the sent discord.Message, or raises"""
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		if self.size >= self.max_queue:
+			self.metrics['dropped'] += 1
+			future.set_exception(QueueFull(f'{self.size} messages already queued'))
+			# mark retrieved so fire-and-forget callers don't get 'exception never retrieved' warnings
+			future.exception()
+			return future
+		embeds = list(embeds or ())
+		if embed is not None:
+			embeds.append(embed)
+		item = Outgoing(priority, next(self.seq), channel, content, embeds, future)
+		queue = self.queues.setdefault(channel.id, [])
+		heapq.heappush(queue, item)
+		if queue[0] is item:
+			heapq.heappush(self.ready, (item.priority, item.seq, channel.id))
+		self.size += 1
+		self.metrics['queued'] += 1
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run())
+		self.wakeup.set()
+		return future
+
+	def bucket(self, channel_id: int) -> ratelimit.TokenBucket:
+		return self.buckets.bucket(channel_id)
+
+	def schedule(self, channel_id: int):
+		"""Put a channel's current head message back in line"""
+		queue = self.queues.get(channel_id)
+		if queue:
+			heapq.heappush(self.ready, (queue[0].priority, queue[0].seq, channel_id))
+		else:
+			self.queues.pop(channel_id, None)
+
+	def next_channel(self, now: float) -> tuple[int | None, float]:
+		"""Returns a channel that may send now, or None and how long until one might"""
+		while self.waiting and self.waiting[0][0] <= now:
+			self.schedule(heapq.heappop(self.waiting)[1])
+		while self.ready:
+			priority, seq, channel_id = heapq.heappop(self.ready)
+			queue = self.queues.get(channel_id)
+			if not queue or queue[0].seq != seq:
+				continue
+			wait = self.bucket(channel_id).delay(now)
+			if wait > 0:
+				heapq.heappush(self.waiting, (now + wait, channel_id))
+				continue
+			return channel_id, 0.0
+		return None, (self.waiting[0][0] - now) if self.waiting else None
+
+	def take_batch(self, channel_id: int) -> list[Outgoing]:
+		"""Pop the head message, plus following plain-text ones that fit in the same send"""
+		queue = self.queues[channel_id]
+		batch = [heapq.heappop(queue)]
+		while batch[0].future.cancelled() and queue:
+			self.size -= 1
+			batch = [heapq.heappop(queue)]
+		if batch[0].embeds or batch[0].content is None:
+			return batch
+		length = len(batch[0].content)
+		while queue and not queue[0].embeds and queue[0].content is not None and length + 1 + len(queue[0].content) <= self.coalesce_limit:
+			item = heapq.heappop(queue)
+			if item.future.cancelled():
+				self.size -= 1
+				continue
+			length += 1 + len(item.content)
+			batch.append(item)
+		return batch
+
+	async def run(self):
+		while self.size > 0:
+			now = time.monotonic()
+			channel_id, wait = self.next_channel(now)
+			if channel_id is None:
+				self.wakeup.clear()
+				try:
+					await asyncio.wait_for(self.wakeup.wait(), wait)
+				except TimeoutError:
+					pass
+				continue
+			global_wait = self.global_bucket.delay(now)
+			if global_wait > 0:
+				self.schedule(channel_id)
+				await asyncio.sleep(global_wait)
+				continue
+			self.global_bucket.take()
+			self.bucket(channel_id).take()
+			await self.deliver(channel_id, self.take_batch(channel_id))
+
+	async def deliver(self, channel_id: int, batch: list[Outgoing]):
+		head = batch[0]
+		if head.future.cancelled():
+			self.size -= 1
+			self.schedule(channel_id)
+			return
+		content = head.content if len(batch) == 1 else '\n'.join(item.content for item in batch)
+		try:
+			self.metrics['api_calls'] += 1
+			message = await head.channel.send(content, embeds=head.embeds) if head.embeds else await head.channel.send(content)
+		except (discord.RateLimited, discord.HTTPException) as e:
+			status = getattr(e, 'status', 429)
+			if status == 429 and head.attempts + 1 < self.max_attempts:
+				retry_after = getattr(e, 'retry_after', None) or 1.0
+				self.metrics['rate_limited'] += 1
+				self.metrics['retried'] += len(batch)
+				self.bucket(channel_id).block(time.monotonic(), retry_after)
+				queue = self.queues.setdefault(channel_id, [])
+				for item in batch:
+					item.attempts += 1
+					heapq.heappush(queue, item)
+				self.schedule(channel_id)
+				return
+			self.logger.warning(f'Failed to send message to channel {channel_id}: {e}')
+			self.finish(batch, exception=e)
+		except Exception as e:
+			# e.g. aiohttp.ClientOSError once discord.py's own retries run out; must not end the run() task
+			self.logger.error(f'Failed to send message to channel {channel_id}', exc_info=e)
+			self.finish(batch, exception=e)
+		else:
+			self.metrics['sent'] += len(batch)
+			self.metrics['coalesced'] += len(batch) - 1
+			self.finish(batch, message=message)
+		self.schedule(channel_id)
+
+	def finish(self, batch: list[Outgoing], message: discord.Message | None = None, exception: Exception | None = None):
+		now = time.monotonic()
+		for item in batch:
+			self.size -= 1
+			self.metrics['delay_total'] += now - item.queued_at
+			if item.future.done():
+				continue
+			if exception is None:
+				item.future.set_result(message)
+			else:
+				self.metrics['failed'] += 1
+				item.future.set_exception(exception)
+				item.future.exception()
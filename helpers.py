@@ -1,35 +1,217 @@
 import discord
 from discord.ext import commands
+import asyncio
+import functools
+import html
+import os
 import re
+import threading
+import dispatch
+import metrics
 
-def send_message(bot: commands.Bot, message, id: int, embed = None):
-	"""Used to easily send messages from non-async callers"""
+def send_message(bot: commands.Bot, message, id: int, embed = None, priority: int = dispatch.PRIORITY_NORMAL) -> asyncio.Future | None:
+	"""Queues a message through the bot's dispatcher. Returns a future for the sent message, or None if the channel is unknown"""
 	channel = bot.get_channel(id)
 	if not channel:
 		return
-	bot.loop.create_task(channel.send(message, embed=embed))
-
-notag = re.compile(r'<.*?>')
-hdreplacements = {
-	'<b>': '**',
-	'</b>': '**',
-	'<strong>': '**',
-	'</strong>': '**',
-	'<i>': '*',
-	'</i>': '*',
-	'<em>': '*',
-	'</em>': '*',
-	'<u>': '__',
-	'</u>': '__',
-	'<br>': '\n',
-	'<br/>': '\n',
-	'<br />': '\n',
-	'\n ': '\n'
-}
+	return bot.dispatcher.submit(channel, message, embed=embed, priority=priority)
+
+def hand_over(bot: commands.Bot, cog: str, **state):
+	"""Called from a cog's cog_unload during a hot reload, to pass in-memory state to the cog's next instance"""
+	bot.handover[cog] = state
+
+def take_over(bot: commands.Bot, cog: str) -> dict:
+	"""State left by the previous instance of a cog (empty unless it was hot reloaded)"""
+	return bot.handover.pop(cog, {})
+
+def atomic_write(path: str, data: str | bytes):
+	"""Replace a file in one step so a crash never leaves it half written"""
+	# per thread, so a synchronous write racing one in a worker thread doesn't rename the other's file
+	tmp = f'{path}.{threading.get_ident()}.tmp'
+	if isinstance(data, bytes):
+		f = open(tmp, 'wb')
+	else:
+		f = open(tmp, 'w', encoding='utf-8')
+	with f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+		metrics.wrote(path, os.fstat(f.fileno()).st_size)
+	os.replace(tmp, path)
+
+# Discord embed limits
+embed_limits = {'title': 256, 'description': 4096, 'fields': 25, 'field_name': 256, 'field_value': 1024, 'footer': 2048, 'author': 256}
+embed_total_limit = 6000
+embeds_per_message = 10
+
+def truncate_text(text: str, limit: int) -> str:
+	"""Cut text to at most `limit` characters, marking the cut with '...'"""
+	if len(text) <= limit:
+		return text
+	return text[:limit - 3] + '...'
+
+def truncate_embed(embed: discord.Embed) -> discord.Embed:
+	"""Trim an embed in place to fit Discord's limits. Each part is cut to its own limit, then any excess
+	over the total limit is taken from the description and finally by dropping fields from the end"""
+	if embed.title:
+		embed.title = truncate_text(embed.title, embed_limits['title'])
+	if embed.description:
+		embed.description = truncate_text(embed.description, embed_limits['description'])
+	while len(embed.fields) > embed_limits['fields']:
+		embed.remove_field(-1)
+	for i, field in enumerate(embed.fields):
+		name = truncate_text(field.name, embed_limits['field_name'])
+		value = truncate_text(field.value, embed_limits['field_value'])
+		if name != field.name or value != field.value:
+			embed.set_field_at(i, name=name, value=value, inline=field.inline)
+	if embed.footer.text and len(embed.footer.text) > embed_limits['footer']:
+		embed.set_footer(text=truncate_text(embed.footer.text, embed_limits['footer']), icon_url=embed.footer.icon_url)
+	if embed.author.name and len(embed.author.name) > embed_limits['author']:
+		embed.set_author(name=truncate_text(embed.author.name, embed_limits['author']), url=embed.author.url, icon_url=embed.author.icon_url)
+	excess = len(embed) - embed_total_limit
+	if excess > 0 and embed.description:
+		embed.description = truncate_text(embed.description, max(len(embed.description) - excess, 3))
+	while len(embed) > embed_total_limit and embed.fields:
+		embed.remove_field(-1)
+	return embed
+
+def pack_embeds(embeds) -> list[list[discord.Embed]]:
+	"""Group embeds into as few messages as possible under the per-message embed count and total size limits.
+	Order is kept; for an order-preserving split, filling each message before starting the next is optimal"""
+	messages = []
+	current = []
+	size = 0
+	for embed in embeds:
+		truncate_embed(embed)
+		embed_size = len(embed)
+		if current and (len(current) == embeds_per_message or size + embed_size > embed_total_limit):
+			messages.append(current)
+			current = []
+			size = 0
+		current.append(embed)
+		size += embed_size
+	if current:
+		messages.append(current)
+	return messages
+
+# one token per match: a tag (closing slash, name, attributes), a comment or declaration, text, or a stray '<'
+html_token = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>|<[!?][^>]*>|([^<]+)|<')
+html_href = re.compile(r'''href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+
+class DiscordMarkdown:
+	"""Translates HTML to Discord markdown in one pass over the input, a token at a time.
+
+	Entities are decoded, links become masked links, lists are indented by nesting depth with ordered lists
+	numbered, and the contents of tags with no markdown equivalent are kept as plain text.
+	"""
+	inline = {'b': '**', 'strong': '**', 'i': '*', 'em': '*', 'u': '__', 's': '~~', 'strike': '~~', 'del': '~~', 'code': '`'}
+	headings = {'h1': '# ', 'h2': '## ', 'h3': '### '}
+	blocks = {'p', 'div', 'h4', 'h5', 'h6', 'blockquote', 'table', 'tr'}
+	skipped = {'script', 'style', 'head', 'title'}
+
+	def __init__(self):
+		self.parts = []
+		# consecutive newlines at the end of the output
+		self.newlines = 1
+		# [ordered, next number] per open list
+		self.lists = []
+		# (index into parts, href) per open link
+		self.links = []
+		self.skipping = 0
+
+	def feed(self, html: str):
+		for match in html_token.finditer(html):
+			closing, tag, attrs, text = match.groups()
+			if tag is not None:
+				tag = tag.lower()
+				if closing:
+					self.end(tag)
+				else:
+					self.start(tag, attrs)
+			elif text is not None:
+				self.text(text)
+			elif match.group() == '<':
+				self.text('<')
+
+	def write(self, text: str):
+		if not text:
+			return
+		self.parts.append(text)
+		stripped = text.rstrip('\n')
+		self.newlines = len(text) - len(stripped) + (self.newlines if not stripped else 0)
+
+	def line_break(self, count: int = 1):
+		"""End the current line, leaving at most `count` newlines in a row"""
+		if self.parts and self.newlines < count:
+			self.write('\n' * (count - self.newlines))
+
+	def start(self, tag: str, attrs: str):
+		if tag in self.inline:
+			self.write(self.inline[tag])
+		elif tag == 'br':
+			self.write('\n')
+		elif tag == 'a':
+			href = html_href.search(attrs)
+			self.links.append((len(self.parts), html.unescape(next(filter(None, href.groups()), '')) if href else None))
+		elif tag in ('ul', 'ol'):
+			self.line_break()
+			self.lists.append([tag == 'ol', 1])
+		elif tag == 'li':
+			self.line_break()
+			indent = '  ' * (len(self.lists) - 1)
+			if self.lists and self.lists[-1][0]:
+				self.write(f'{indent}{self.lists[-1][1]}. ')
+				self.lists[-1][1] += 1
+			else:
+				self.write(f'{indent}- ')
+		elif tag in self.headings:
+			self.line_break(2)
+			self.write(self.headings[tag])
+		elif tag in self.blocks:
+			self.line_break()
+		elif tag in self.skipped and not attrs.rstrip().endswith('/'):
+			self.skipping += 1
+
+	def end(self, tag: str):
+		if tag in self.inline:
+			self.write(self.inline[tag])
+		elif tag == 'a' and self.links:
+			start, href = self.links.pop()
+			if not href or href.startswith(('#', 'javascript:')):
+				return
+			text = ''.join(self.parts[start:]).strip()
+			del self.parts[start:]
+			self.newlines = 0
+			self.write(href if not text or text == href else f'[{text}]({href})')
+		elif tag == 'p' or tag in self.headings:
+			self.line_break(2)
+		elif tag in ('ul', 'ol', 'li') or tag in self.blocks:
+			if tag in ('ul', 'ol') and self.lists:
+				self.lists.pop()
+			self.line_break()
+		elif tag in self.skipped:
+			self.skipping = max(self.skipping - 1, 0)
+
+	def text(self, text: str):
+		if self.skipping:
+			return
+		if '&' in text:
+			text = html.unescape(text)
+		# drop indentation from the HTML source at the start of each line
+		if '\n ' in text:
+			text = text.replace('\n ', '\n')
+		if self.newlines:
+			# source formatting between blocks
+			text = text.lstrip(' \t\n')
+		self.write(text)
+
+	def result(self, trim: bool) -> str:
+		text = ''.join(self.parts)
+		return text.strip() if trim else text
+
+@functools.lru_cache(maxsize=256)
 def html_to_discord(html: str, trim: bool = True) -> str:
-	"""Convert basic HTML tags to Discord markdown"""
-	for html_tag, discord_md in hdreplacements.items():
-		html = html.replace(html_tag, discord_md)
-	# Remove any remaining HTML tags
-	html = re.sub(notag, '', html)
-	return html
\ No newline at end of file
+	"""Convert HTML to Discord markdown. Memoized, since the same announcements are converted for every guild"""
+	parser = DiscordMarkdown()
+	parser.feed(html)
+	return parser.result(trim)
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import logging
+import os
+import numpy as np
+import helpers
+
+class GuildHistory:
+	"""One guild's weekly VC seconds as a (week, member) matrix.
+
+	`members` maps column to member ID and `weeks` holds the unix time each week was archived. Queries
+	slice and reduce the matrix with NumPy, so they stay fast however many weeks are stored.
+	"""
+	max_seconds = np.iinfo(np.uint32).max
+
+	def __init__(self, members: np.ndarray | None = None, weeks: np.ndarray | None = None, seconds: np.ndarray | None = None):
+		self.members = members if members is not None else np.empty(0, dtype=np.int64)
+		self.weeks = weeks if weeks is not None else np.empty(0, dtype=np.float64)
+		self.seconds = seconds if seconds is not None else np.empty((0, 0), dtype=np.uint32)
+		self.index = {int(member_id): i for i, member_id in enumerate(self.members)}
+
+	def add_week(self, when: float, scores: dict):
+		"""Append a week from a member ID -> seconds mapping"""
+		scores = {int(member_id): seconds for member_id, seconds in scores.items() if seconds > 0}
+		new = [member_id for member_id in scores if member_id not in self.index]
+		if new:
+			for member_id in new:
+				self.index[member_id] = len(self.index)
+			self.members = np.concatenate([self.members, np.array(new, dtype=np.int64)])
+			self.seconds = np.pad(self.seconds, ((0, 0), (0, len(new))))
+		row = np.zeros(len(self.members), dtype=np.uint32)
+		if scores:
+			columns = np.fromiter((self.index[member_id] for member_id in scores), dtype=np.intp, count=len(scores))
+			row[columns] = np.minimum(np.fromiter(scores.values(), dtype=np.int64, count=len(scores)), self.max_seconds)
+		self.weeks = np.append(self.weeks, when)
+		self.seconds = np.vstack([self.seconds, row])
+
+	def member_column(self, member_id: int) -> np.ndarray:
+		"""A member's seconds for every stored week (zeros if they have none)"""
+		i = self.index.get(member_id)
+		if i is None:
+			return np.zeros(len(self.weeks), dtype=np.uint32)
+		return self.seconds[:, i]
+
+	def recent(self, member_id: int, weeks: int) -> tuple[np.ndarray, np.ndarray]:
+		"""(week times, seconds) of a member's last `weeks` weeks, oldest first"""
+		return self.weeks[-weeks:], self.member_column(member_id)[-weeks:]
+
+	def streak(self, member_id: int, minimum: int = 1) -> int:
+		"""Number of most recent consecutive weeks with at least `minimum` seconds"""
+		missed = np.flatnonzero(self.member_column(member_id)[::-1] < minimum)
+		return int(missed[0]) if len(missed) else len(self.weeks)
+
+	def longest_streak(self, member_id: int, minimum: int = 1) -> int:
+		active = np.concatenate([[False], self.member_column(member_id) >= minimum, [False]])
+		edges = np.flatnonzero(np.diff(active.astype(np.int8)))
+		# edges alternate start, end
+		return int((edges[1::2] - edges[::2]).max()) if len(edges) else 0
+
+	def percentile(self, member_id: int, weeks: int) -> float | None:
+		"""Percentage of the guild's active members with less time than this member over the last `weeks` weeks"""
+		totals = self.seconds[-weeks:].sum(axis=0, dtype=np.int64)
+		i = self.index.get(member_id)
+		if i is None or totals[i] == 0:
+			return
+		active = totals[totals > 0]
+		return float((active < totals[i]).sum() * 100 / len(active))
+
+	def trend(self, weeks: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""(week times, total seconds, active members) for the guild's last `weeks` weeks"""
+		recent = self.seconds[-weeks:]
+		return self.weeks[-weeks:], recent.sum(axis=1, dtype=np.int64), np.count_nonzero(recent, axis=1)
+
+	def arrays(self) -> dict[str, np.ndarray]:
+		# add_week replaces the arrays rather than changing them, so this is a consistent snapshot
+		return {'members': self.members, 'weeks': self.weeks, 'seconds': self.seconds}
+
+	@classmethod
+	def loads(cls, data) -> 'GuildHistory':
+		with np.load(data) as arrays:
+			return cls(arrays['members'], arrays['weeks'], arrays['seconds'])
+
+class WeeklyHistory:
+	"""Archive of every guild's finished weeks, one compressed .npz per guild, loaded on first use"""
+	def __init__(self, directory: str = 'store/history'):
+		self.directory = directory
+		self.logger = logging.getLogger(__name__)
+		self.guilds = {}
+		os.makedirs(directory, exist_ok=True)
+
+	def path(self, guild_id: int) -> str:
+		return os.path.join(self.directory, f'{guild_id}.npz')
+
+	def get(self, guild_id: int) -> GuildHistory:
+		history = self.guilds.get(guild_id)
+		if history is None:
+			try:
+				history = GuildHistory.loads(self.path(guild_id))
+			except FileNotFoundError:
+				history = GuildHistory()
+			except (OSError, ValueError, KeyError) as e:
+				self.logger.warning(f'ALERT: unreadable VC history {self.path(guild_id)}, starting over: {e}', exc_info=True)
+				os.replace(self.path(guild_id), self.path(guild_id) + '.bad')
+				history = GuildHistory()
+			self.guilds[guild_id] = history
+		return history
+
+	def add_week(self, guild_id: int, when: float, scores: dict):
+		self.get(guild_id).add_week(when, scores)
+
+	async def save(self, guild_id: int):
+		"""Write a guild's history off the event loop (compression included)"""
+		await asyncio.to_thread(self.write, guild_id, self.get(guild_id).arrays())
+
+	def write(self, guild_id: int, arrays: dict[str, np.ndarray]):
+		buffer = io.BytesIO()
+		np.savez_compressed(buffer, **arrays)
+		helpers.atomic_write(self.path(guild_id), buffer.getvalue())
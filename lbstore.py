@@ -0,0 +1,584 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from operator import itemgetter
+import helpers
+import metrics
+
+CATEGORIES = ('current', 'top', 'total')
+
+def check_category(category: str):
+	if category not in CATEGORIES:
+		raise ValueError(f'Unknown leaderboard category {category!r}')
+
+def open_store(backend: str = 'json', layout = None):
+	"""Returns the leaderboard store for the configured backend. With a partitioned sharding.ShardLayout,
+	one store per shard the process runs, behind a ShardedStore"""
+	if layout is not None and layout.partitioned:
+		return ShardedStore({shard: open_store_in(backend, layout.directory(shard)) for shard in layout.shard_ids}, layout.shard_of)
+	return open_store_in(backend, 'store')
+
+def open_store_in(backend: str, directory: str):
+	match backend:
+		case 'json':
+			return JsonLeaderboardStore(os.path.join(directory, 'leaderboard.json'))
+		case 'sqlite':
+			store = SqliteLeaderboardStore(os.path.join(directory, 'leaderboard.db'))
+			store.migrate_json(os.path.join(directory, 'leaderboard.json'))
+			return store
+		case _:
+			raise ValueError(f'Unknown leaderboard backend {backend!r}')
+
+class JsonLeaderboardStore:
+	"""In-memory leaderboard kept on disk as a compacted JSON snapshot plus an append-only journal.
+
+	Every change is applied to memory and queued as a journal record; `flush` appends queued
+	records to the journal and `compact` rewrites the snapshot and trims the journal. Each record
+	carries a sequence number and the snapshot remembers the last one it contains, so a crash
+	between the two steps never replays a record twice.
+	"""
+	seq_key = '_seq'
+
+	def __init__(self, path: str = 'store/leaderboard.json'):
+		self.path = path
+		self.journal_path = os.path.splitext(path)[0] + '.journal'
+		self.logger = logging.getLogger(__name__)
+		self.data = {}
+		self.seq = 0
+		self.pending = []
+		# guild ID -> change counter, for callers caching anything derived from the scores
+		self.versions = {}
+		self.last_compact = time.monotonic()
+		self.io_lock = threading.Lock()
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.path, 'r', encoding='utf-8') as f:
+				self.data = json.load(f)
+		except FileNotFoundError:
+			self.data = {}
+		except json.JSONDecodeError as e:
+			self.logger.warning(f'ALERT: JSON decode error for {self.path}, {e}', exc_info=True)
+			self.data = {}
+		self.seq = self.data.pop(self.seq_key, 0)
+		replayed = 0
+		try:
+			with open(self.journal_path, 'r', encoding='utf-8') as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except json.JSONDecodeError:
+						# torn final line from a crash mid-append
+						continue
+					if record[0] <= self.seq:
+						continue
+					self.seq = record[0]
+					self.apply(record[1:])
+					replayed += 1
+		except FileNotFoundError:
+			pass
+		if replayed:
+			self.logger.info(f'Replayed {replayed} leaderboard journal records')
+
+	def apply(self, record: list):
+		match record:
+			case ['guild', guild_id, channel_id]:
+				if guild_id not in self.data:
+					self.data[guild_id] = {'current': {}, 'top': {}, 'total': {}, 'lb_announce_channel': channel_id}
+			case ['add', guild_id, member_id, seconds]:
+				lb = self.data[guild_id]
+				for category in ('current', 'total'):
+					lb[category][member_id] = lb[category].get(member_id, 0) + seconds
+			case ['adds', entries]:
+				for guild_id, member_id, seconds in entries:
+					self.apply(['add', guild_id, member_id, seconds])
+			case ['channel', guild_id, channel_id]:
+				self.data[guild_id]['lb_announce_channel'] = channel_id
+			case ['timezone', guild_id, timezone]:
+				self.data[guild_id]['reset_timezone'] = timezone
+			case ['mark', guild_id, when]:
+				self.data[guild_id]['last_reset'] = when
+			case ['reset']:
+				# every guild at once (older journals)
+				for lb in self.data.values():
+					self.reset_scores(lb)
+			case ['reset', guild_id, when]:
+				self.reset_scores(self.data[guild_id])
+				self.data[guild_id]['last_reset'] = when
+
+	def reset_scores(self, lb: dict):
+		current, top = lb['current'], lb['top']
+		for member_id, seconds in current.items():
+			# if we're not in the 'top' leaderboard, add our score. Otherwise we only replace it if this week has a higher score
+			if member_id not in top or seconds > top[member_id]:
+				top[member_id] = seconds
+			current[member_id] = 0
+
+	def record(self, *record):
+		"""Apply a change in memory and queue it for the journal"""
+		self.apply(list(record))
+		self.seq += 1
+		match record:
+			case ('reset',):
+				touched = list(self.data)
+			case ('adds', entries):
+				touched = {entry[0] for entry in entries}
+			case _:
+				touched = [record[1]]
+		for guild_id in touched:
+			self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+		self.pending.append(json.dumps([self.seq, *record], separators=(',', ':')))
+
+	def has_guild(self, guild_id: int) -> bool:
+		return str(guild_id) in self.data
+
+	def add_guild(self, guild_id: int, announce_channel: int):
+		self.record('guild', str(guild_id), str(announce_channel))
+
+	def guild_ids(self) -> list[int]:
+		return [int(guild_id) for guild_id in self.data]
+
+	def add_time(self, guild_id: int, member_id: int, seconds: int):
+		self.record('add', str(guild_id), str(member_id), seconds)
+
+	def add_times(self, entries: list[tuple[int, int, int]]):
+		"""Add many (guild ID, member ID, seconds) at once, as a single journal record"""
+		if entries:
+			self.record('adds', [[str(guild_id), str(member_id), seconds] for guild_id, member_id, seconds in entries])
+
+	def get_scores(self, guild_id: int, category: str) -> dict | None:
+		"""Returns the raw member -> seconds mapping of a category"""
+		check_category(category)
+		lb = self.data.get(str(guild_id))
+		if lb is None:
+			return
+		return lb[category]
+
+	def top(self, guild_id: int, category: str, limit: int | None = None, offset: int = 0) -> list[tuple[int, int]] | None:
+		"""Returns up to `limit` (member ID, seconds) pairs with non-zero time, highest first, skipping the first `offset`"""
+		lb = self.get_scores(guild_id, category)
+		if lb is None:
+			return
+		entries = ((int(member_id), seconds) for member_id, seconds in lb.items() if seconds > 0)
+		if limit is None:
+			return sorted(entries, key=itemgetter(1), reverse=True)[offset:]
+		return heapq.nlargest(offset + limit, entries, key=itemgetter(1))[offset:]
+
+	def count(self, guild_id: int, category: str) -> int:
+		"""Number of members with non-zero time in a category"""
+		lb = self.get_scores(guild_id, category)
+		if lb is None:
+			return 0
+		return sum(1 for seconds in lb.values() if seconds > 0)
+
+	def version(self, guild_id: int) -> int:
+		"""Counter that changes whenever the guild's leaderboard does"""
+		return self.versions.get(str(guild_id), 0)
+
+	def score(self, guild_id: int, category: str, member_id: int) -> int:
+		lb = self.get_scores(guild_id, category)
+		if lb is None:
+			return 0
+		return lb.get(str(member_id), 0)
+
+	def rank(self, guild_id: int, category: str, member_id: int) -> int | None:
+		"""Returns the 1-based rank of a member, or None if they have no time"""
+		seconds = self.score(guild_id, category, member_id)
+		if seconds == 0:
+			return
+		return 1 + sum(1 for other in self.data[str(guild_id)][category].values() if other > seconds)
+
+	def announce_channel(self, guild_id: int) -> int:
+		return int(self.data[str(guild_id)]['lb_announce_channel'])
+
+	def set_announce_channel(self, guild_id: int, channel_id: int):
+		self.record('channel', str(guild_id), str(channel_id))
+
+	def reset_timezone(self, guild_id: int) -> str | None:
+		"""The guild's weekly reset timezone, or None to use the bot's"""
+		return self.data[str(guild_id)].get('reset_timezone')
+
+	def set_reset_timezone(self, guild_id: int, timezone: str | None):
+		self.record('timezone', str(guild_id), timezone)
+
+	def last_reset(self, guild_id: int) -> float | None:
+		"""Unix time of the guild's last weekly reset, if one has been recorded"""
+		return self.data[str(guild_id)].get('last_reset')
+
+	def mark_reset(self, guild_id: int, when: float):
+		"""Record a reset time without touching the scores"""
+		self.record('mark', str(guild_id), when)
+
+	def reset_weekly(self, guild_id: int | None = None, when: float | None = None):
+		"""Fold 'current' into 'top' and zero it, for one guild or (with no guild) all of them"""
+		if when is None:
+			when = time.time()
+		for gid in [guild_id] if guild_id is not None else self.guild_ids():
+			self.record('reset', str(gid), when)
+
+	def flush(self) -> bool:
+		"""Append queued records to the journal. Skipped (returns False) while a compaction holds the files"""
+		if not self.pending:
+			return True
+		if not self.io_lock.acquire(blocking=False):
+			return False
+		try:
+			self.write_journal()
+		finally:
+			self.io_lock.release()
+		return True
+
+	def write_journal(self):
+		lines, self.pending = self.pending, []
+		text = '\n'.join(lines) + '\n'
+		with open(self.journal_path, 'a', encoding='utf-8') as f:
+			f.write(text)
+		# records are ASCII JSON, so characters are bytes
+		metrics.wrote(self.journal_path, len(text))
+
+	def snapshot(self) -> tuple[str, int]:
+		self.data[self.seq_key] = self.seq
+		try:
+			return json.dumps(self.data, separators=(',', ':')), self.seq
+		finally:
+			del self.data[self.seq_key]
+
+	def write_snapshot(self, text: str, seq: int):
+		helpers.atomic_write(self.path, text)
+		# keep only records newer than the snapshot
+		newer = []
+		try:
+			with open(self.journal_path, 'r', encoding='utf-8') as f:
+				for line in f:
+					try:
+						if json.loads(line)[0] > seq:
+							newer.append(line)
+					except json.JSONDecodeError:
+						continue
+		except FileNotFoundError:
+			return
+		helpers.atomic_write(self.journal_path, ''.join(newer))
+
+	def write_snapshot_and_release(self, text: str, seq: int):
+		try:
+			self.write_snapshot(text, seq)
+		finally:
+			self.io_lock.release()
+
+	async def compact(self):
+		"""Write a fresh snapshot off the event loop. Serialization happens here so the snapshot is consistent"""
+		if not self.io_lock.acquire(blocking=False):
+			return
+		try:
+			if self.pending:
+				self.write_journal()
+			text, seq = self.snapshot()
+		except BaseException:
+			self.io_lock.release()
+			raise
+		self.last_compact = time.monotonic()
+		# the worker thread owns the lock from here, so a shutdown on the loop can wait for it
+		await asyncio.to_thread(self.write_snapshot_and_release, text, seq)
+
+	def close(self):
+		"""Synchronously persist everything. Waits for any in-flight compaction first"""
+		with self.io_lock:
+			if self.pending:
+				self.write_journal()
+			self.write_snapshot(*self.snapshot())
+
+
+class SqliteLeaderboardStore:
+	"""Leaderboard in SQLite with a (guild, score) index per category.
+
+	Changes are written straight into an open transaction and committed by `flush`, so voice
+	events stay cheap while top-N and rank queries are answered from the indexes.
+	"""
+	add_sql = """
+		INSERT INTO scores (guild_id, member_id, current, total) VALUES (?1, ?2, ?3, ?3)
+		ON CONFLICT (guild_id, member_id) DO UPDATE SET current = current + ?3, total = total + ?3
+	"""
+
+	def __init__(self, path: str = 'store/leaderboard.db'):
+		self.path = path
+		self.logger = logging.getLogger(__name__)
+		self.last_compact = time.monotonic()
+		self.db = sqlite3.connect(path)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		with self.db:
+			self.db.executescript("""
+				CREATE TABLE IF NOT EXISTS guilds (
+					guild_id INTEGER PRIMARY KEY,
+					lb_announce_channel INTEGER NOT NULL DEFAULT 0,
+					reset_timezone TEXT,
+					last_reset REAL
+				);
+				CREATE TABLE IF NOT EXISTS scores (
+					guild_id INTEGER NOT NULL,
+					member_id INTEGER NOT NULL,
+					current INTEGER NOT NULL DEFAULT 0,
+					top INTEGER NOT NULL DEFAULT 0,
+					total INTEGER NOT NULL DEFAULT 0,
+					PRIMARY KEY (guild_id, member_id)
+				) WITHOUT ROWID;
+				CREATE INDEX IF NOT EXISTS scores_current ON scores (guild_id, current DESC);
+				CREATE INDEX IF NOT EXISTS scores_top ON scores (guild_id, top DESC);
+				CREATE INDEX IF NOT EXISTS scores_total ON scores (guild_id, total DESC);
+			""")
+			columns = {row[1] for row in self.db.execute('PRAGMA table_info(guilds)')}
+			# databases created before per-guild reset scheduling
+			if 'reset_timezone' not in columns:
+				self.db.execute('ALTER TABLE guilds ADD COLUMN reset_timezone TEXT')
+				self.db.execute('ALTER TABLE guilds ADD COLUMN last_reset REAL')
+		self.guilds = {}
+		# guild ID -> [reset timezone, last reset]
+		self.resets = {}
+		# guild ID -> change counter, for callers caching anything derived from the scores
+		self.versions = {}
+		for guild_id, channel_id, timezone, last_reset in self.db.execute('SELECT guild_id, lb_announce_channel, reset_timezone, last_reset FROM guilds'):
+			self.guilds[guild_id] = channel_id
+			self.resets[guild_id] = [timezone, last_reset]
+
+	def migrate_json(self, path: str = 'store/leaderboard.json'):
+		"""One-shot import of the JSON store (snapshot and journal). The old files are renamed afterwards"""
+		if self.guilds:
+			return
+		source = JsonLeaderboardStore(path)
+		if not source.data:
+			return
+		rows = []
+		for guild_id, lb in source.data.items():
+			members = set(lb['current']) | set(lb['top']) | set(lb['total'])
+			for member_id in members:
+				rows.append((int(guild_id), int(member_id), lb['current'].get(member_id, 0), lb['top'].get(member_id, 0), lb['total'].get(member_id, 0)))
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?)',
+					[(int(guild_id), int(lb['lb_announce_channel']), lb.get('reset_timezone'), lb.get('last_reset')) for guild_id, lb in source.data.items()])
+			self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)', rows)
+		self.guilds = {int(guild_id): int(lb['lb_announce_channel']) for guild_id, lb in source.data.items()}
+		self.resets = {int(guild_id): [lb.get('reset_timezone'), lb.get('last_reset')] for guild_id, lb in source.data.items()}
+		for old in (source.path, source.journal_path):
+			if os.path.exists(old):
+				os.replace(old, old + '.migrated')
+		self.logger.info(f'Migrated {len(rows)} leaderboard rows from {path}')
+
+	def has_guild(self, guild_id: int) -> bool:
+		return guild_id in self.guilds
+
+	def add_guild(self, guild_id: int, announce_channel: int):
+		if guild_id in self.guilds:
+			return
+		self.guilds[guild_id] = announce_channel
+		self.resets[guild_id] = [None, None]
+		self.bump(guild_id)
+		self.db.execute('INSERT OR IGNORE INTO guilds (guild_id, lb_announce_channel) VALUES (?, ?)', (guild_id, announce_channel))
+
+	def guild_ids(self) -> list[int]:
+		return list(self.guilds)
+
+	def bump(self, guild_id: int):
+		self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+
+	def add_time(self, guild_id: int, member_id: int, seconds: int):
+		self.bump(guild_id)
+		self.db.execute(self.add_sql, (guild_id, member_id, seconds))
+
+	def add_times(self, entries: list[tuple[int, int, int]]):
+		"""Add many (guild ID, member ID, seconds) at once, committed as one transaction"""
+		for guild_id in {entry[0] for entry in entries}:
+			self.bump(guild_id)
+		with self.db:
+			self.db.executemany(self.add_sql, entries)
+
+	def get_scores(self, guild_id: int, category: str) -> dict | None:
+		"""Returns the raw member -> seconds mapping of a category"""
+		check_category(category)
+		if guild_id not in self.guilds:
+			return
+		return {str(member_id): seconds for member_id, seconds in
+				self.db.execute(f'SELECT member_id, {category} FROM scores WHERE guild_id = ?', (guild_id,))}
+
+	def top(self, guild_id: int, category: str, limit: int | None = None, offset: int = 0) -> list[tuple[int, int]] | None:
+		"""Returns up to `limit` (member ID, seconds) pairs with non-zero time, highest first, skipping the first `offset`"""
+		check_category(category)
+		if guild_id not in self.guilds:
+			return
+		return self.db.execute(f"""
+			SELECT member_id, {category} FROM scores INDEXED BY scores_{category}
+			WHERE guild_id = ? AND {category} > 0 ORDER BY {category} DESC LIMIT ? OFFSET ?
+		""", (guild_id, -1 if limit is None else limit, offset)).fetchall()
+
+	def count(self, guild_id: int, category: str) -> int:
+		"""Number of members with non-zero time in a category"""
+		check_category(category)
+		return self.db.execute(f'SELECT COUNT(*) FROM scores INDEXED BY scores_{category} WHERE guild_id = ? AND {category} > 0',
+				(guild_id,)).fetchone()[0]
+
+	def version(self, guild_id: int) -> int:
+		"""Counter that changes whenever the guild's leaderboard does"""
+		return self.versions.get(guild_id, 0)
+
+	def score(self, guild_id: int, category: str, member_id: int) -> int:
+		check_category(category)
+		row = self.db.execute(f'SELECT {category} FROM scores WHERE guild_id = ? AND member_id = ?', (guild_id, member_id)).fetchone()
+		return row[0] if row else 0
+
+	def rank(self, guild_id: int, category: str, member_id: int) -> int | None:
+		"""Returns the 1-based rank of a member, or None if they have no time"""
+		seconds = self.score(guild_id, category, member_id)
+		if seconds == 0:
+			return
+		return 1 + self.db.execute(f'SELECT COUNT(*) FROM scores INDEXED BY scores_{category} WHERE guild_id = ? AND {category} > ?',
+				(guild_id, seconds)).fetchone()[0]
+
+	def announce_channel(self, guild_id: int) -> int:
+		return self.guilds[guild_id]
+
+	def set_announce_channel(self, guild_id: int, channel_id: int):
+		self.bump(guild_id)
+		self.guilds[guild_id] = channel_id
+		self.db.execute('UPDATE guilds SET lb_announce_channel = ? WHERE guild_id = ?', (channel_id, guild_id))
+
+	def reset_timezone(self, guild_id: int) -> str | None:
+		"""The guild's weekly reset timezone, or None to use the bot's"""
+		return self.resets[guild_id][0]
+
+	def set_reset_timezone(self, guild_id: int, timezone: str | None):
+		self.bump(guild_id)
+		self.resets[guild_id][0] = timezone
+		self.db.execute('UPDATE guilds SET reset_timezone = ? WHERE guild_id = ?', (timezone, guild_id))
+
+	def last_reset(self, guild_id: int) -> float | None:
+		"""Unix time of the guild's last weekly reset, if one has been recorded"""
+		return self.resets[guild_id][1]
+
+	def mark_reset(self, guild_id: int, when: float):
+		"""Record a reset time without touching the scores"""
+		self.resets[guild_id][1] = when
+		self.db.execute('UPDATE guilds SET last_reset = ? WHERE guild_id = ?', (when, guild_id))
+
+	def reset_weekly(self, guild_id: int | None = None, when: float | None = None):
+		"""Fold 'current' into 'top' and zero it, for one guild or (with no guild) all of them"""
+		if when is None:
+			when = time.time()
+		with self.db:
+			if guild_id is None:
+				self.db.execute('UPDATE scores SET top = MAX(top, current), current = 0 WHERE current > 0')
+				self.db.execute('UPDATE guilds SET last_reset = ?', (when,))
+				for state in self.resets.values():
+					state[1] = when
+				for gid in self.guilds:
+					self.bump(gid)
+			else:
+				self.bump(guild_id)
+				self.db.execute('UPDATE scores SET top = MAX(top, current), current = 0 WHERE guild_id = ? AND current > 0', (guild_id,))
+				self.mark_reset(guild_id, when)
+
+	def flush(self) -> bool:
+		self.db.commit()
+		return True
+
+	async def compact(self):
+		self.db.commit()
+		self.last_compact = time.monotonic()
+		self.db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+	def close(self):
+		self.db.commit()
+
+
+class ShardedStore:
+	"""One leaderboard store per shard, behind the same interface as a single store.
+
+	Calls about a guild go to the store of the guild's shard, and calls about every guild go to all of them,
+	so each shard's files are only ever written by the process running that shard.
+	"""
+	def __init__(self, stores: dict, shard_of):
+		self.stores = stores
+		self.shard_of = shard_of
+
+	def store(self, guild_id: int):
+		return self.stores[self.shard_of(int(guild_id))]
+
+	@property
+	def last_compact(self) -> float:
+		return min(store.last_compact for store in self.stores.values())
+
+	def has_guild(self, guild_id: int) -> bool:
+		return self.store(guild_id).has_guild(guild_id)
+
+	def add_guild(self, guild_id: int, announce_channel: int):
+		self.store(guild_id).add_guild(guild_id, announce_channel)
+
+	def guild_ids(self) -> list[int]:
+		return [guild_id for store in self.stores.values() for guild_id in store.guild_ids()]
+
+	def add_time(self, guild_id: int, member_id: int, seconds: int):
+		self.store(guild_id).add_time(guild_id, member_id, seconds)
+
+	def add_times(self, entries: list[tuple[int, int, int]]):
+		groups = {}
+		for entry in entries:
+			groups.setdefault(self.shard_of(entry[0]), []).append(entry)
+		for shard, group in groups.items():
+			self.stores[shard].add_times(group)
+
+	def get_scores(self, guild_id: int, category: str) -> dict | None:
+		return self.store(guild_id).get_scores(guild_id, category)
+
+	def top(self, guild_id: int, category: str, limit: int | None = None, offset: int = 0) -> list[tuple[int, int]] | None:
+		return self.store(guild_id).top(guild_id, category, limit, offset)
+
+	def count(self, guild_id: int, category: str) -> int:
+		return self.store(guild_id).count(guild_id, category)
+
+	def version(self, guild_id: int) -> int:
+		return self.store(guild_id).version(guild_id)
+
+	def score(self, guild_id: int, category: str, member_id: int) -> int:
+		return self.store(guild_id).score(guild_id, category, member_id)
+
+	def rank(self, guild_id: int, category: str, member_id: int) -> int | None:
+		return self.store(guild_id).rank(guild_id, category, member_id)
+
+	def announce_channel(self, guild_id: int) -> int:
+		return self.store(guild_id).announce_channel(guild_id)
+
+	def set_announce_channel(self, guild_id: int, channel_id: int):
+		self.store(guild_id).set_announce_channel(guild_id, channel_id)
+
+	def reset_timezone(self, guild_id: int) -> str | None:
+		return self.store(guild_id).reset_timezone(guild_id)
+
+	def set_reset_timezone(self, guild_id: int, timezone: str | None):
+		self.store(guild_id).set_reset_timezone(guild_id, timezone)
+
+	def last_reset(self, guild_id: int) -> float | None:
+		return self.store(guild_id).last_reset(guild_id)
+
+	def mark_reset(self, guild_id: int, when: float):
+		self.store(guild_id).mark_reset(guild_id, when)
+
+	def reset_weekly(self, guild_id: int | None = None, when: float | None = None):
+		if guild_id is not None:
+			return self.store(guild_id).reset_weekly(guild_id, when)
+		for store in self.stores.values():
+			store.reset_weekly(None, when)
+
+	def flush(self) -> bool:
+		# every store is flushed, even after one reports it is busy
+		return all([store.flush() for store in self.stores.values()])
+
+	async def compact(self):
+		await asyncio.gather(*(store.compact() for store in self.stores.values()))
+
+	def close(self):
+		for store in self.stores.values():
+			store.close()
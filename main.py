@@ -1,34 +1,45 @@
+import time
+startup_began = time.perf_counter()
 import os
 import sys
 import json
+import asyncio
 import discord
 import logging
 import datetime
-import requests
 import re
 import random
-import schedule
-import pytz
-import lavalink
 from discord.ext import commands, tasks
 import helpers
+import webclient
+import dispatch
+import reminders
+import metrics
+import sharding
 
 if not os.path.isdir('store'):
 	os.mkdir('store')
 
 log = logging.getLogger(__name__)
 
+# (phase, seconds) in the order they ran, reported once the bot is ready
+startup_phases = [('imports', time.perf_counter() - startup_began)]
+profile_startup = '--profile-startup' in sys.argv
+
+def startup_phase(name: str, since: float) -> float:
+	now = time.perf_counter()
+	startup_phases.append((name, now - since))
+	return now
+
+phase_began = time.perf_counter()
 config = {}
 with open('store/config.json', 'r') as f:
 	config = json.load(f)
+phase_began = startup_phase('config', phase_began)
 
 # Courtesy of https://stackoverflow.com/a/51916936
 tdregex = re.compile(r'^((?P<days>[\.\d]+?)d)?((?P<hours>[\.\d]+?)h)?((?P<minutes>[\.\d]+?)m)?((?P<seconds>[\.\d]+?)s)?$')
 
-reminders = {}
-
-timezone = pytz.timezone(config['timezone'])
-
 intents = discord.Intents.default()
 intents.message_content = True
 intents.dm_messages = True
@@ -38,33 +49,53 @@ intents.voice_states = True
 intents.guild_messages = True
 intents.guild_reactions = True
 
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=commands.DefaultHelpCommand(width = 100, no_category='Commands'))
+# which shards this process runs (all of them, unless started by the supervisor) and where their files go
+layout = sharding.ShardLayout.from_config(config, sys.argv)
+try:
+	layout.check()
+except ValueError as e:
+	sys.exit(str(e))
+help_command = commands.DefaultHelpCommand(width = 100, no_category='Commands')
+if layout.partitioned or config.get('sharded', False):
+	bot = commands.AutoShardedBot(command_prefix='!', intents=intents, help_command=help_command, shard_count=layout.shard_count, shard_ids=layout.shard_ids)
+else:
+	bot = commands.Bot(command_prefix='!', intents=intents, help_command=help_command)
 bot.config = config
+bot.layout = layout
+bot.web = webclient.WebClient(cache_path=layout.local_path('webcache.json') if config.get('web_cache_persist', True) else None)
+bot.dispatcher = dispatch.Dispatcher(max_queue=config.get('dispatch_max_queue', 1000))
+# set while cogs are hot reloaded, so their cog_unload hands state over instead of shutting down
+bot.reloading = False
+bot.handover = {}
+bot.lag_monitor = metrics.LagMonitor(metrics.registry, threshold=config.get('loop_lag_threshold', 0.25))
 
 ### METHODS ###
 
-def remind(memberID: int, channelID: int, message):
-	helpers.send_message(f'<@{memberID}> {message}', channelID)
-	return schedule.CancelJob()
+def send_reminder(reminder: reminders.Reminder):
+	helpers.send_message(bot, f'<@{reminder.member_id}> {reminder.message}', reminder.channel_id, priority=dispatch.PRIORITY_HIGH)
 
-def add_reminder(memberID: int, channelID: int, message, td: datetime.timedelta):
-	schedule.every(int(td.total_seconds())).seconds.do(remind, memberID, channelID, message)
+bot.reminders = reminders.ReminderScheduler(send_reminder, layout.local_path('reminders.json'))
+phase_began = startup_phase('bot and stores', phase_began)
 
 def graceful_shutdown():
 	lb = bot.get_cog('Leaderboard')
 	if lb is not None:
 		lb.on_shutdown()
-	schedule.clear()
+	converse = bot.get_cog('Converse')
+	if converse is not None:
+		converse.on_shutdown()
+	bot.reminders.close()
+	bot.lag_monitor.stop()
 
 def restart_bot(channel: discord.TextChannel = None):
 	log.info('Restarting...')
 	graceful_shutdown()
 	update_cmd = 'git pull'
 	if channel:
-		with open('store/update.log', 'w') as f:
+		with open(layout.local_path('update.log'), 'w') as f:
 			f.write(str(channel.id))
 			f.write('\n')
-		update_cmd += ' >> store/update.log'
+		update_cmd += f' >> {layout.local_path('update.log')}'
 	if os.system(update_cmd) != 0:
 		return
 	quit(0) # combine with systemd 'Restart=on-success'
@@ -72,53 +103,111 @@ def restart_bot(channel: discord.TextChannel = None):
 	#python = sys.executable
 	#os.execv(python, [python] + sys.argv)
 
-def get_aurora_status() -> discord.Embed | None:
+async def run_git(*args) -> tuple[int, str]:
+	process = await asyncio.create_subprocess_exec('git', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+	output, _ = await process.communicate()
+	return process.returncode, output.decode(errors='replace').strip()
+
+def reload_config():
+	"""Re-read store/config.json into the existing dict, which bot.config also refers to"""
+	with open('store/config.json', 'r') as f:
+		new_config = json.load(f)
+	config.clear()
+	config.update(new_config)
+
+async def reload_cogs(names: list[str]) -> list[str]:
+	"""Reload (or load/unload, for added/removed files) the given cogs in place. Returns a line per cog"""
+	report = []
+	bot.reloading = True
+	try:
+		for name in names:
+			extension = f'cogs.{name}'
+			start = time.perf_counter()
+			try:
+				if not os.path.exists(f'cogs/{name}.py'):
+					await bot.unload_extension(extension)
+					action = 'unloaded'
+				elif extension in bot.extensions:
+					await bot.reload_extension(extension)
+					action = 'reloaded'
+				else:
+					await bot.load_extension(extension)
+					action = 'loaded'
+			except commands.ExtensionError as e:
+				log.error(f'Failed to reload {extension}', exc_info=e)
+				report.append(f'{name}: failed ({e})')
+				continue
+			report.append(f'{name}: {action} in {(time.perf_counter() - start) * 1000:.0f}ms')
+	finally:
+		bot.reloading = False
+		bot.handover.clear()
+	return report
+
+async def get_aurora_status() -> list[discord.Embed] | None:
+	"""Returns one embed per active aurora alert (or a single 'no alerts' embed)"""
 	tzinfo = datetime.datetime.now().astimezone().tzinfo
 	api = 'https://sws-data.sws.bom.gov.au/api/v1/get-aurora-alert'
 	time_format = '%Y-%m-%d %H:%M:%S'
 	try:
-		response = requests.post(api, json={'api_key': config['bom_spaceweather_apikey']})
-		response.raise_for_status()
-		data = response.json()['data']
-		desc = ''
-		i = 0
-		if len(data) == 0:
-			desc = 'No active alerts.'
-		else:
-			for alert in data:
-				i += 1
-				start_time = datetime.datetime.strptime(alert['start_time'], time_format)
-				desc += f'\tStart time: {start_time.astimezone(tzinfo)}\n'
-				valid_until = datetime.datetime.strptime(alert['valid_until'], time_format)
-				desc += f'\tValid until: {valid_until.astimezone(tzinfo)}\n'
-				desc += f'\tAlert level: {alert['k_aus']}\n'
-				desc += f'\tLatitude band: {alert['lat_band']}\n'
-				desc += f'\tDescription: {alert['description'].replace('\n', '\n\t')}\n'
-				if i < len(data):
-					desc += '\n\n'
+		response = await bot.web.request_json('POST', api, json_body={'api_key': config['bom_spaceweather_apikey']},
+				ttl=config.get('aurora_cache_ttl', 120), stale_ttl=config.get('aurora_cache_stale', 600))
+		data = response['data']
+	except webclient.WebError as e:
+		log.error(f'Error occured while fetching aurora status.\n{e}')
+		if isinstance(e.body, dict) and 'errors' in e.body:
+			log.error(e.body['errors'])
+		return
+	descs = []
+	if len(data) == 0:
+		descs.append('No active alerts.')
+	else:
+		for alert in data:
+			desc = ''
+			start_time = datetime.datetime.strptime(alert['start_time'], time_format)
+			desc += f'\tStart time: {start_time.astimezone(tzinfo)}\n'
+			valid_until = datetime.datetime.strptime(alert['valid_until'], time_format)
+			desc += f'\tValid until: {valid_until.astimezone(tzinfo)}\n'
+			desc += f'\tAlert level: {alert['k_aus']}\n'
+			desc += f'\tLatitude band: {alert['lat_band']}\n'
+			desc += f'\tDescription: {alert['description'].replace('\n', '\n\t')}\n'
+			descs.append(desc)
 
+	embeds = []
+	for desc in descs:
 		embed = discord.Embed(title='Aurora Alert', description=desc)
 		embed.set_footer(text='Information provided by sws-data.sws.bom.gov.au')
-		return embed
-	except requests.HTTPError as e:
-		log.error(f'HTTP error occured while fetching aurora status.\n{e}')
-		try:
-			rjson = response.json()
-			if 'errors' in rjson:
-				log.error(rjson['errors'])
-		except requests.exceptions.JSONDecodeError:
-			pass
-	except requests.ConnectionError as e:
-		log.error(f'Connection error while fetching aurora status.\n{e}')
-	except requests.RequestException as e:
-		log.error(f'Request exception occured while fetching aurora status.\n{e}')
-	except requests.Timeout:
-		log.error(f'Timeout occured while fetching aurora status.')
-	except requests.exceptions.JSONDecodeError as e:
-		log.error(f'Unable to decode JSON from aurora status response.\n{e}')
+		embeds.append(embed)
+	return embeds
 
 	
 
+def setup_lavalink():
+	# only imported when music is enabled
+	import lavalink
+	bot.lavalink = lavalink.Client(bot.user.id)
+	bot.lavalink.add_node(config['lavalink_host'],
+					config['lavalink_port'],
+					config['lavalink_password'],
+					config['lavalink_region'],
+					config['lavalink_name'])
+
+async def load_cog(name: str):
+	began = time.perf_counter()
+	await bot.load_extension(f'cogs.{name}')
+	startup_phases.append((f'cog {name}', time.perf_counter() - began))
+
+def report_startup():
+	total = time.perf_counter() - startup_began
+	log.info(f'Started in {total:.2f}s: ' + ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in startup_phases))
+	if not profile_startup:
+		return
+	width = max(len(name) for name, _ in startup_phases)
+	print('\n'.join(f'{name:<{width}} {seconds * 1000:>8.1f} ms' for name, seconds in startup_phases))
+	print(f'{"total":<{width}} {total * 1000:>8.1f} ms')
+	# one line per profiled start, to compare cold starts over time
+	with open(layout.local_path('startup_profile.jsonl'), 'a') as f:
+		f.write(json.dumps({'time': int(time.time()), 'total': total, 'phases': dict(startup_phases)}) + '\n')
+
 ### BOT EVENTS ###
 #@bot.event
 #async def on_voice_state_update(self, member, before, after):
@@ -129,28 +218,53 @@ def get_aurora_status() -> discord.Embed | None:
 #		if player:
 #			await player.destroy()
 
+async def setup_hook():
+	"""Runs once, after authenticating and before connecting to the gateway: loads every cog concurrently"""
+	global phase_began
+	phase_began = startup_phase('commands and login', phase_began)
+	names = [file[:-3] for file in os.listdir('cogs') if file.endswith('.py')]
+	results = await asyncio.gather(*(load_cog(name) for name in names), return_exceptions=True)
+	for name, result in zip(names, results):
+		if isinstance(result, BaseException):
+			log.error(f'Failed to load cog {name}', exc_info=result)
+	phase_began = startup_phase('cogs', phase_began)
+	bot.lag_monitor.start()
+	write_metrics.change_interval(seconds=config.get('metrics_interval', 60))
+	write_metrics.start()
+
+bot.setup_hook = setup_hook
+
+@bot.before_invoke
+async def start_command_timer(ctx: commands.Context):
+	ctx.started = time.perf_counter()
+
+@bot.after_invoke
+async def record_command(ctx: commands.Context):
+	metrics.observe('command', ctx.command.qualified_name, time.perf_counter() - ctx.started, ctx.command_failed)
+
 @bot.event
+@metrics.timed('listener')
 async def on_ready():
+	global phase_began
 	log.info(f'Logged in as {bot.user}')
-	if os.path.exists('store/update.log'):
+	if phase_began is not None:
+		startup_phase('gateway and ready', phase_began)
+		phase_began = None
+		report_startup()
+		if profile_startup:
+			return await bot.close()
+	bot.reminders.start()
+	if os.path.exists(layout.local_path('update.log')):
 		try: 
-			with open('store/update.log', 'r') as f:
+			with open(layout.local_path('update.log'), 'r') as f:
 				channel = bot.get_channel(int(f.readline()))
 				await channel.send(f'```{'\n'.join(f.readlines())}```')
 		except Exception as e:
 			log.error(e)
 		finally:
-			os.remove('store/update.log')
-	for file in os.listdir('cogs'):
-		if file.endswith('.py'):
-			await bot.load_extension(f'cogs.{file[:-3]}')
+			os.remove(layout.local_path('update.log'))
 	if config['lavalink_enable'] and not hasattr(bot, 'lavalink'):
-		bot.lavalink = lavalink.Client(bot.user.id)
-		bot.lavalink.add_node(config['lavalink_host'],
-						config['lavalink_port'],
-						config['lavalink_password'],
-						config['lavalink_region'],
-						config['lavalink_name'])
+		setup_lavalink()
 
 @bot.command()
 async def update(ctx: commands.Context):
@@ -165,15 +279,67 @@ async def update(ctx: commands.Context):
 	await ctx.send('Update failed.')
 
 @bot.command()
-async def remind(ctx: commands.Context, message):
-	substrs = tdregex.match(message)
+async def reload(ctx: commands.Context, *force: str):
+	"""Updates bot from github and reloads changed cogs and the config without restarting. Name cogs to reload them regardless"""
+	if ctx.author.id != config['dev_user_id']:
+		return await ctx.send('no')
+	_, before = await run_git('rev-parse', 'HEAD')
+	code, output = await run_git('pull')
+	if code != 0:
+		return await ctx.send(f'Update failed.```{output}```')
+	_, after = await run_git('rev-parse', 'HEAD')
+	changed = []
+	if before != after:
+		_, diff = await run_git('diff', '--name-only', before, after)
+		changed = diff.splitlines()
+	# only cogs can be swapped in place; anything else the running process imported needs a restart
+	if any(path.endswith('.py') and not path.startswith('cogs/') for path in changed) or 'requirements.txt' in changed:
+		await ctx.send('Changes outside cogs, restarting instead...')
+		restart_bot(ctx.channel)
+		return await ctx.send('Update failed.')
+	try:
+		reload_config()
+	except (OSError, json.JSONDecodeError) as e:
+		return await ctx.send(f'Config not reloaded, fix it and try again: {e}')
+	names = {os.path.basename(path)[:-3] for path in changed if path.startswith('cogs/') and path.endswith('.py')}
+	names.update(force)
+	report = await reload_cogs(sorted(names))
+	summary = '\n'.join(report) if report else 'No cogs changed.'
+	await ctx.send(f'```{output}\n\nConfig reloaded.\n{summary}```')
+
+@bot.command()
+async def remind(ctx: commands.Context, duration, *, message = 'Reminder!'):
+	"""Pings you here after a delay, e.g. !remind 1d6h20m take the bins out"""
+	substrs = tdregex.match(duration)
 	if not substrs:
 		return await ctx.send('Invalid format. Examples of valid formats: *2d* / *1d6h20m* / *30m20s*')
 	param_dict = {name: float(param)
 				for name, param in substrs.groupdict().items() if param}
 	td = datetime.timedelta(**param_dict)
-	add_reminder(td)
-	await ctx.send('ok :)')
+	if td.total_seconds() <= 0:
+		return await ctx.send('Invalid format. Examples of valid formats: *2d* / *1d6h20m* / *30m20s*')
+	reminder = bot.reminders.add(time.time() + td.total_seconds(), ctx.author.id, ctx.channel.id, message)
+	await ctx.send(f'ok :) (reminder #{reminder.id}, <t:{int(reminder.due)}:R>)')
+
+@bot.command(name='reminders')
+async def list_reminders(ctx: commands.Context):
+	"""Lists your pending reminders"""
+	pending = bot.reminders.for_member(ctx.author.id)
+	if not pending:
+		return await ctx.send('You have no pending reminders.')
+	lines = [f'#{reminder.id} <t:{int(reminder.due)}:R> - {helpers.truncate_text(reminder.message, 100)}' for reminder in pending[:15]]
+	if len(pending) > 15:
+		lines.append(f'...and {len(pending) - 15} more')
+	await ctx.send('\n'.join(lines))
+
+@bot.command(aliases=['unremind'])
+async def cancelreminder(ctx: commands.Context, id: int):
+	"""Cancels one of your reminders by its number"""
+	reminder = bot.reminders.reminders.get(id)
+	if reminder is None or reminder.member_id != ctx.author.id:
+		return await ctx.send('No such reminder.')
+	bot.reminders.cancel(id)
+	await ctx.send(f'Cancelled reminder #{id}.')
 
 @bot.command()
 async def play(ctx: commands.Context, *, query):
@@ -187,6 +353,7 @@ async def play(ctx: commands.Context, *, query):
 		if not ctx.author.voice:
 			return await ctx.send("You are not in a voice channel")
 		channel = ctx.author.voice.channel
+		import lavalink
 		await channel.connect(cls=lavalink.discord.VoiceClient)
 		player.store('channel', channel.id)
 	elif player.channel_id == ctx.channel.id:
@@ -211,14 +378,65 @@ async def weather(ctx: commands.Context, message):
 
 @bot.command(aliases=['aurora', 'magstorm', 'sweather'])
 async def spaceweather(ctx: commands.Context):
-	res = get_aurora_status()
+	res = await get_aurora_status()
 	if res is None:
 		await ctx.send('Error occurred, sorry :(')
 		return
-	await ctx.send(embed=res)
+	for embeds in helpers.pack_embeds(res):
+		await ctx.send(embeds=embeds)
+
+@bot.command()
+async def webstats(ctx: commands.Context):
+	"""Shows outbound API response cache statistics"""
+	if ctx.author.id != config['dev_user_id']:
+		return await ctx.send('no')
+	stats = ', '.join(f'{name}: {count}' for name, count in bot.web.cache_stats.items())
+	await ctx.send(f'Response cache ({len(bot.web.cache)} entries) - {stats}')
+
+@bot.command()
+async def sendstats(ctx: commands.Context):
+	"""Shows outbound message queue statistics"""
+	if ctx.author.id != config['dev_user_id']:
+		return await ctx.send('no')
+	metrics = bot.dispatcher.metrics
+	finished = metrics['sent'] + metrics['failed']
+	average = metrics['delay_total'] / finished if finished else 0
+	stats = ', '.join(f'{name}: {count}' for name, count in metrics.items() if name != 'delay_total')
+	await ctx.send(f'Message queue ({bot.dispatcher.size} pending) - {stats}, average delay: {average:.2f}s')
+
+@bot.command()
+async def stats(ctx: commands.Context):
+	"""Shows handler latencies, event loop stalls and I/O"""
+	if ctx.author.id != config['dev_user_id']:
+		return await ctx.send('no')
+	registry = metrics.registry
+	handlers = sorted(registry.handlers.items(), key=lambda item: item[1].sum, reverse=True)[:12]
+	width = max((len(name) for (_, name), _ in handlers), default=4)
+	lines = [f'{"kind":<8} {"name":<{width}} {"calls":>7} {"errors":>6} {"p50 ms":>7} {"p99 ms":>7} {"max ms":>8}']
+	for (kind, name), histogram in handlers:
+		lines.append(f'{kind:<8} {name:<{width}} {histogram.count:>7} {histogram.errors:>6} {histogram.quantile(0.5) * 1000:>7.1f} '
+				f'{histogram.quantile(0.99) * 1000:>7.1f} {histogram.max * 1000:>8.1f}')
+	lag = registry.lag
+	lines.append(f'\nEvent loop lag: p99 {lag.quantile(0.99) * 1000:.0f}ms, max {lag.max * 1000:.0f}ms, '
+			f'{registry.stall_count} stalls over {bot.lag_monitor.threshold * 1000:.0f}ms')
+	if registry.stalls:
+		when, seconds, stack = registry.stalls[-1]
+		lines.append(f'Last stall {time.time() - when:.0f}s ago, {seconds * 1000:.0f}ms, in:')
+		lines.extend((stack or 'stack not captured\n').splitlines()[-6:])
+	io = metrics.process_io()
+	lines.append(f'\nDisk: {registry.total("disk_written_bytes") / 1024:.0f} KiB written to store/, '
+			f'network: {registry.total("net_bytes", direction="received") / 1024:.0f} KiB received'
+			+ (f', process: {io["wchar"] / 1024:.0f} KiB written, {io["rchar"] / 1024:.0f} KiB read' if io else ''))
+	await ctx.send(f'```{helpers.truncate_text('\n'.join(lines), 1990)}```')
 
 @tasks.loop(hours=12)
+@metrics.timed('loop')
 async def weatherupdate():
 	return
 
+@tasks.loop(seconds=60)
+async def write_metrics():
+	"""Writes every metric to store/metrics.prom (metrics.<shards>.prom when sharded), for Prometheus' node exporter textfile collector or similar"""
+	await asyncio.to_thread(helpers.atomic_write, layout.local_path('metrics.prom'), metrics.registry.render())
+
 bot.run(config['token'])
\ No newline at end of file
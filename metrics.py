@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+# histogram bucket upper bounds, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+	"""Latencies counted into fixed buckets, so recording is O(1) and memory doesn't grow with traffic"""
+	__slots__ = ('counts', 'count', 'sum', 'max', 'errors')
+
+	def __init__(self):
+		self.counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+		self.errors = 0
+
+	def observe(self, seconds: float, error: bool = False):
+		i = 0
+		while i < len(buckets) and seconds > buckets[i]:
+			i += 1
+		self.counts[i] += 1
+		self.count += 1
+		self.sum += seconds
+		if seconds > self.max:
+			self.max = seconds
+		if error:
+			self.errors += 1
+
+	def quantile(self, q: float) -> float:
+		"""Upper bound of the bucket holding the q-quantile (the maximum, for the overflow bucket)"""
+		target = q * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= target:
+				return min(buckets[i], self.max) if i < len(buckets) else self.max
+		return 0.0
+
+def label_text(labels: dict) -> str:
+	if not labels:
+		return ''
+	escaped = (f'{key}="{str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')}"' for key, value in labels.items())
+	return '{' + ','.join(escaped) + '}'
+
+class Registry:
+	"""Handler latency histograms and I/O counters for the whole process, rendered for `!stats` and Prometheus"""
+	def __init__(self):
+		# (kind, name) -> Histogram, kind being command, listener or loop
+		self.handlers = {}
+		# (metric, sorted label items) -> count
+		self.counters = {}
+		# counts also come from writer threads
+		self.counters_lock = threading.Lock()
+		self.lag = Histogram()
+		# (unix time, seconds, stack) of recent event loop stalls, newest last
+		self.stalls = deque(maxlen=20)
+		self.stall_count = 0
+		self.started = time.time()
+
+	def observe(self, kind: str, name: str, seconds: float, error: bool = False):
+		histogram = self.handlers.get((kind, name))
+		if histogram is None:
+			histogram = self.handlers[(kind, name)] = Histogram()
+		histogram.observe(seconds, error)
+
+	def count(self, metric: str, amount: int = 1, **labels):
+		key = (metric, tuple(sorted(labels.items())))
+		with self.counters_lock:
+			self.counters[key] = self.counters.get(key, 0) + amount
+
+	def total(self, metric: str, **labels) -> int:
+		"""Sum of a counter over every label set that includes `labels`"""
+		return sum(count for (name, items), count in self.counter_items() if name == metric and labels.items() <= set(items))
+
+	def counter_items(self) -> list[tuple[tuple, int]]:
+		# a copy: writer threads add keys while the loop iterates
+		with self.counters_lock:
+			return list(self.counters.items())
+
+	def render(self) -> str:
+		"""All metrics in the Prometheus text exposition format"""
+		lines = ['# HELP bot_handler_seconds Time spent in commands, listeners and task loop iterations',
+				'# TYPE bot_handler_seconds histogram']
+		for (kind, name), histogram in sorted(self.handlers.items()):
+			lines.extend(histogram_lines('bot_handler_seconds', histogram, {'kind': kind, 'name': name}))
+		lines += ['# HELP bot_handler_errors_total Handler calls that raised', '# TYPE bot_handler_errors_total counter']
+		for (kind, name), histogram in sorted(self.handlers.items()):
+			lines.append(f'bot_handler_errors_total{label_text({'kind': kind, 'name': name})} {histogram.errors}')
+		lines += ['# HELP bot_loop_lag_seconds How late the event loop ran a sleeping task', '# TYPE bot_loop_lag_seconds histogram']
+		lines.extend(histogram_lines('bot_loop_lag_seconds', self.lag, {}))
+		lines += ['# HELP bot_loop_stalls_total Event loop stalls over the threshold', '# TYPE bot_loop_stalls_total counter',
+				f'bot_loop_stalls_total {self.stall_count}']
+		counters = sorted(self.counter_items())
+		metrics = sorted({metric for (metric, _), _ in counters})
+		for metric in metrics:
+			lines.append(f'# TYPE bot_{metric}_total counter')
+			for (name, labels), count in counters:
+				if name == metric:
+					lines.append(f'bot_{metric}_total{label_text(dict(labels))} {count}')
+		io = process_io()
+		if io:
+			lines += ['# HELP bot_process_io_bytes Bytes read and written by the process (/proc/self/io)', '# TYPE bot_process_io_bytes counter']
+			lines.extend(f'bot_process_io_bytes{label_text({'kind': kind})} {count}' for kind, count in io.items())
+		lines += ['# TYPE bot_start_time_seconds gauge', f'bot_start_time_seconds {self.started:.0f}']
+		return '\n'.join(lines) + '\n'
+
+def histogram_lines(metric: str, histogram: Histogram, labels: dict) -> list[str]:
+	lines = []
+	cumulative = 0
+	for bound, count in zip((*buckets, '+Inf'), histogram.counts):
+		cumulative += count
+		lines.append(f'{metric}_bucket{label_text({**labels, 'le': bound})} {cumulative}')
+	lines.append(f'{metric}_sum{label_text(labels)} {histogram.sum:.6f}')
+	lines.append(f'{metric}_count{label_text(labels)} {histogram.count}')
+	return lines
+
+def process_io() -> dict[str, int]:
+	"""rchar/wchar (all reads and writes, sockets included) and read_bytes/write_bytes (storage), where available"""
+	try:
+		with open('/proc/self/io') as f:
+			return {key: int(value) for key, value in (line.split(': ') for line in f)
+					if key in ('rchar', 'wchar', 'read_bytes', 'write_bytes')}
+	except (OSError, ValueError):
+		return {}
+
+registry = Registry()
+
+def observe(kind: str, name: str, seconds: float, error: bool = False):
+	registry.observe(kind, name, seconds, error)
+
+def count(metric: str, amount: int = 1, **labels):
+	registry.count(metric, amount, **labels)
+
+def file_kind(path: str) -> str:
+	"""The file's name, except for per-guild files (named by guild ID), which share one label per directory and
+	type, e.g. conversation/*.txt, so the number of series doesn't grow with the guild count"""
+	directory, name = os.path.split(path)
+	stem, ext = os.path.splitext(name)
+	if stem.isdigit():
+		return f'{os.path.basename(directory)}/*{ext}'
+	return name
+
+def wrote(path: str, amount: int):
+	"""Count bytes written to a file under store/"""
+	registry.count('disk_written_bytes', amount, file=file_kind(path))
+
+def timed(kind: str, name: str | None = None):
+	"""Decorator recording a coroutine function's latency and errors. Goes under @commands.Cog.listener() or @tasks.loop()"""
+	def decorator(function):
+		label = name or function.__qualname__
+		@functools.wraps(function)
+		async def wrapper(*args, **kwargs):
+			started = time.perf_counter()
+			error = True
+			try:
+				result = await function(*args, **kwargs)
+				error = False
+				return result
+			finally:
+				registry.observe(kind, label, time.perf_counter() - started, error)
+		return wrapper
+	return decorator
+
+class LagMonitor:
+	"""Measures event loop lag with a task that sleeps `interval` at a time, and catches stalls as they happen.
+
+	A watchdog thread checks the task's heartbeat. If the loop has not run it for `threshold` seconds, the
+	thread captures the loop thread's stack, which shows the code that is blocking it. The stall is logged
+	with that stack, and kept in the registry for `!stats`, once the loop runs again and its length is known.
+	"""
+	def __init__(self, registry: Registry, interval: float = 0.1, threshold: float = 0.25):
+		self.registry = registry
+		self.interval = interval
+		self.threshold = threshold
+		self.logger = logging.getLogger(__name__)
+		self.heartbeat = time.perf_counter()
+		self.stack = None
+		self.task = None
+		self.thread = None
+		self.loop_thread = None
+		self.stopped = threading.Event()
+
+	def start(self):
+		if self.task is not None and not self.task.done():
+			return
+		self.loop_thread = threading.get_ident()
+		self.heartbeat = time.perf_counter()
+		self.stopped.clear()
+		self.task = asyncio.ensure_future(self.beat())
+		self.thread = threading.Thread(target=self.watch, name='loop-lag-watchdog', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.task is not None:
+			self.task.cancel()
+
+	async def beat(self):
+		while True:
+			started = time.perf_counter()
+			await asyncio.sleep(self.interval)
+			now = time.perf_counter()
+			lag = max(now - started - self.interval, 0.0)
+			self.heartbeat = now
+			self.registry.lag.observe(lag)
+			stack, self.stack = self.stack, None
+			if lag >= self.threshold:
+				self.registry.stall_count += 1
+				self.registry.stalls.append((time.time(), lag, stack))
+				self.logger.warning(f'Event loop blocked for {lag * 1000:.0f}ms' + (f', blocked in:\n{stack}' if stack else ''))
+
+	def watch(self):
+		while not self.stopped.wait(self.threshold / 2):
+			if self.stack is None and time.perf_counter() - self.heartbeat > self.interval + self.threshold:
+				frame = sys._current_frames().get(self.loop_thread)
+				if frame is not None:
+					self.stack = ''.join(traceback.format_stack(frame))
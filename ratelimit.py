@@ -0,0 +1,120 @@
+import time
+
+class TokenBucket:
+	"""`rate` events per `per` seconds, with bursts of up to `rate`. Times are time.monotonic() seconds"""
+	__slots__ = ('rate', 'per', 'tokens', 'updated', 'blocked_until')
+
+	def __init__(self, rate: int, per: float, now: float | None = None):
+		self.rate = rate
+		self.per = per
+		self.tokens = float(rate)
+		self.updated = time.monotonic() if now is None else now
+		self.blocked_until = 0.0
+
+	def delay(self, now: float) -> float:
+		"""Seconds until an event is allowed (0 if it is allowed now)"""
+		self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+		self.updated = now
+		wait = self.blocked_until - now
+		if self.tokens < 1:
+			wait = max(wait, (1 - self.tokens) * self.per / self.rate)
+		return max(wait, 0.0)
+
+	def take(self):
+		self.tokens -= 1
+
+	def block(self, now: float, seconds: float):
+		self.blocked_until = max(self.blocked_until, now + seconds)
+
+	def idle(self, now: float) -> bool:
+		"""Refilled and not blocked, so no different from a new bucket"""
+		return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate / self.per >= self.rate
+
+class Cooldown:
+	"""At most one event per `interval` seconds for each key (a guild, user, channel...).
+
+	A key costs one dict entry holding the monotonic time it is next allowed. Keys whose time has passed
+	are the same as keys never seen, so they are swept out whenever the dict has doubled since the last
+	sweep: memory follows the keys active in the last `interval`, not every key ever seen.
+	"""
+	__slots__ = ('interval', 'until', 'sweep_size')
+	min_sweep_size = 1024
+
+	def __init__(self, interval: float, until: dict | None = None):
+		self.interval = interval
+		# key -> monotonic time the key is next allowed
+		self.until = {} if until is None else until
+		self.sweep_size = max(self.min_sweep_size, 2 * len(self.until))
+
+	def __len__(self) -> int:
+		return len(self.until)
+
+	def ready(self, key, now: float | None = None) -> bool:
+		until = self.until.get(key)
+		return until is None or until <= (time.monotonic() if now is None else now)
+
+	def remaining(self, key, now: float | None = None) -> float:
+		"""Seconds until the key is allowed again (0 if it is allowed now)"""
+		return max(self.until.get(key, 0.0) - (time.monotonic() if now is None else now), 0.0)
+
+	def trigger(self, key, now: float | None = None):
+		"""Start the key's cooldown"""
+		if now is None:
+			now = time.monotonic()
+		self.until[key] = now + self.interval
+		if len(self.until) >= self.sweep_size:
+			self.sweep(now)
+
+	def hit(self, key, now: float | None = None) -> bool:
+		"""If the key is allowed now, start its cooldown and return True"""
+		if now is None:
+			now = time.monotonic()
+		if not self.ready(key, now):
+			return False
+		self.trigger(key, now)
+		return True
+
+	def sweep(self, now: float):
+		# a new dict, since a dict never shrinks as keys are deleted
+		self.until = {key: until for key, until in self.until.items() if until > now}
+		self.sweep_size = max(self.min_sweep_size, 2 * len(self.until))
+
+class TokenBuckets:
+	"""A TokenBucket per key, created on first use. Idle buckets are swept out the way Cooldown sweeps keys"""
+	__slots__ = ('rate', 'per', 'buckets', 'sweep_size')
+	min_sweep_size = 1024
+
+	def __init__(self, rate: int, per: float):
+		self.rate = rate
+		self.per = per
+		# key -> TokenBucket
+		self.buckets = {}
+		self.sweep_size = self.min_sweep_size
+
+	def __len__(self) -> int:
+		return len(self.buckets)
+
+	def bucket(self, key, now: float | None = None) -> TokenBucket:
+		"""The key's bucket. Look it up again rather than keeping it: a refilled bucket may be swept and replaced"""
+		bucket = self.buckets.get(key)
+		if bucket is None:
+			if now is None:
+				now = time.monotonic()
+			if len(self.buckets) >= self.sweep_size:
+				self.sweep(now)
+			bucket = self.buckets[key] = TokenBucket(self.rate, self.per, now)
+		return bucket
+
+	def hit(self, key, now: float | None = None) -> bool:
+		"""If the key has a token now, take it and return True"""
+		if now is None:
+			now = time.monotonic()
+		bucket = self.bucket(key, now)
+		if bucket.delay(now) > 0:
+			return False
+		bucket.take()
+		return True
+
+	def sweep(self, now: float):
+		self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.idle(now)}
+		self.sweep_size = max(self.min_sweep_size, 2 * len(self.buckets))
@@ -0,0 +1,206 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+import helpers
+import metrics
+
+class Reminder:
+	__slots__ = ('id', 'due', 'member_id', 'channel_id', 'message')
+
+	def __init__(self, id: int, due: float, member_id: int, channel_id: int, message: str):
+		self.id = id
+		self.due = due
+		self.member_id = member_id
+		self.channel_id = channel_id
+		self.message = message
+
+	def to_list(self) -> list:
+		return [self.id, self.due, self.member_id, self.channel_id, self.message]
+
+class ReminderScheduler:
+	"""Pending reminders in a min-heap of deadlines, fired by one task that sleeps until the earliest.
+
+	Cancelling only removes the reminder from `reminders`; its heap entry is skipped when it reaches the
+	top, and the heap is rebuilt once stale entries outnumber live ones. Changes are appended to a journal
+	as they happen and folded into a JSON snapshot once the journal outgrows it, following the same
+	snapshot + sequence-numbered journal layout as the leaderboard store.
+	"""
+	seq_key = '_seq'
+	# upper bound on a single sleep so wall clock changes are noticed
+	max_sleep = 300
+
+	def __init__(self, fire, path: str = 'store/reminders.json'):
+		self.fire = fire
+		self.path = path
+		self.journal_path = os.path.splitext(path)[0] + '.journal'
+		self.logger = logging.getLogger(__name__)
+		self.reminders = {}
+		self.by_member = {}
+		self.heap = []
+		self.next_id = 1
+		self.seq = 0
+		self.journal_records = 0
+		# journal lines held back while a compaction is rewriting the journal
+		self.pending = []
+		self.changed = asyncio.Event()
+		self.task = None
+		self.compacting = None
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.path, 'r', encoding='utf-8') as f:
+				data = json.load(f)
+		except FileNotFoundError:
+			data = {}
+		except json.JSONDecodeError as e:
+			self.logger.warning(f'ALERT: JSON decode error for {self.path}, {e}', exc_info=True)
+			data = {}
+		self.seq = data.get(self.seq_key, 0)
+		self.next_id = data.get('next_id', 1)
+		for entry in data.get('reminders', ()):
+			self.apply(['add', *entry])
+		try:
+			with open(self.journal_path, 'r', encoding='utf-8') as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except json.JSONDecodeError:
+						# torn final line from a crash mid-append
+						continue
+					if record[0] <= self.seq:
+						continue
+					self.seq = record[0]
+					self.apply(record[1:])
+					self.journal_records += 1
+		except FileNotFoundError:
+			pass
+		self.heap = [(reminder.due, reminder.id) for reminder in self.reminders.values()]
+		heapq.heapify(self.heap)
+		self.logger.info(f'Loaded {len(self.reminders)} pending reminders')
+
+	def apply(self, record: list):
+		match record:
+			case ['add', id, due, member_id, channel_id, message]:
+				self.reminders[id] = Reminder(id, due, member_id, channel_id, message)
+				self.by_member.setdefault(member_id, set()).add(id)
+				self.next_id = max(self.next_id, id + 1)
+			case ['del', id]:
+				reminder = self.reminders.pop(id, None)
+				if reminder is not None:
+					ids = self.by_member[reminder.member_id]
+					ids.discard(id)
+					if not ids:
+						del self.by_member[reminder.member_id]
+
+	def record(self, *record):
+		"""Apply a change in memory and append it to the journal"""
+		self.apply(list(record))
+		self.seq += 1
+		self.pending.append(json.dumps([self.seq, *record], separators=(',', ':')))
+		if self.compacting is None:
+			self.write_journal()
+		self.journal_records += 1
+		if self.journal_records > max(1000, len(self.reminders)) and self.compacting is None:
+			self.compacting = asyncio.ensure_future(self.compact())
+
+	def write_journal(self):
+		lines, self.pending = self.pending, []
+		text = '\n'.join(lines) + '\n'
+		with open(self.journal_path, 'a', encoding='utf-8') as f:
+			f.write(text)
+		# records are ASCII JSON, so characters are bytes
+		metrics.wrote(self.journal_path, len(text))
+
+	def add(self, due: float, member_id: int, channel_id: int, message: str) -> Reminder:
+		"""Schedule a reminder for `due` (unix time)"""
+		id = self.next_id
+		self.record('add', id, due, member_id, channel_id, message)
+		heapq.heappush(self.heap, (due, id))
+		if self.heap[0][1] == id:
+			self.changed.set()
+		return self.reminders[id]
+
+	def cancel(self, id: int) -> Reminder | None:
+		"""Remove a pending reminder. Returns it, or None if there was no such reminder"""
+		reminder = self.reminders.get(id)
+		if reminder is None:
+			return
+		self.record('del', id)
+		if len(self.heap) > 64 and len(self.heap) > 2 * len(self.reminders):
+			self.heap = [(reminder.due, reminder.id) for reminder in self.reminders.values()]
+			heapq.heapify(self.heap)
+		return reminder
+
+	def for_member(self, member_id: int) -> list[Reminder]:
+		"""Returns a member's pending reminders, soonest first"""
+		return sorted((self.reminders[id] for id in self.by_member.get(member_id, ())), key=lambda reminder: reminder.due)
+
+	def start(self):
+		if self.task is None or self.task.done():
+			self.task = asyncio.ensure_future(self.run())
+
+	async def run(self):
+		while True:
+			self.changed.clear()
+			# drop entries for cancelled reminders
+			while self.heap and self.heap[0][1] not in self.reminders:
+				heapq.heappop(self.heap)
+			if not self.heap:
+				await self.changed.wait()
+				continue
+			delay = self.heap[0][0] - time.time()
+			if delay > 0:
+				try:
+					await asyncio.wait_for(self.changed.wait(), min(delay, self.max_sleep))
+				except TimeoutError:
+					pass
+				continue
+			reminder = self.reminders[heapq.heappop(self.heap)[1]]
+			self.record('del', reminder.id)
+			try:
+				self.fire(reminder)
+			except Exception as e:
+				self.logger.error(f'Failed to deliver reminder {reminder.id}: {e}', exc_info=True)
+
+	def snapshot(self) -> tuple[str, int]:
+		data = {self.seq_key: self.seq, 'next_id': self.next_id, 'reminders': [reminder.to_list() for reminder in self.reminders.values()]}
+		return json.dumps(data, separators=(',', ':')), self.seq
+
+	def write_snapshot(self, text: str, seq: int):
+		helpers.atomic_write(self.path, text)
+		# keep only records newer than the snapshot
+		newer = []
+		try:
+			with open(self.journal_path, 'r', encoding='utf-8') as f:
+				for line in f:
+					try:
+						if json.loads(line)[0] > seq:
+							newer.append(line)
+					except json.JSONDecodeError:
+						continue
+		except FileNotFoundError:
+			return
+		helpers.atomic_write(self.journal_path, ''.join(newer))
+
+	async def compact(self):
+		"""Fold the journal into a fresh snapshot, written off the event loop"""
+		try:
+			if self.pending:
+				self.write_journal()
+			text, seq = self.snapshot()
+			await asyncio.to_thread(self.write_snapshot, text, seq)
+			self.journal_records = self.seq - seq
+		finally:
+			self.compacting = None
+			if self.pending:
+				self.write_journal()
+
+	def close(self):
+		if self.task is not None:
+			self.task.cancel()
+		if self.pending:
+			self.write_journal()
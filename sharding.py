@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import helpers
+import lbstore
+
+logger = logging.getLogger(__name__)
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+	"""The shard Discord delivers a guild's events on"""
+	return (guild_id >> 22) % shard_count
+
+def parse_shards(text: str) -> list[int]:
+	"""'0-3' or '0,2,5' (or a mix) as a sorted list of shard IDs"""
+	shards = set()
+	for part in text.split(','):
+		first, _, last = part.strip().partition('-')
+		shards.update(range(int(first), int(last or first) + 1))
+	return sorted(shards)
+
+def shards_label(shards: list[int]) -> str:
+	if shards == list(range(shards[0], shards[-1] + 1)):
+		return f'{shards[0]}-{shards[-1]}'
+	return ','.join(map(str, shards))
+
+def argument(argv: list[str], name: str) -> str | None:
+	if name in argv and argv.index(name) + 1 < len(argv):
+		return argv[argv.index(name) + 1]
+
+class ShardLayout:
+	"""Which shards this process runs and where their files live.
+
+	Unpartitioned (no shard count configured) is the single process layout: everything stays directly under
+	store/ as before. Partitioned, each shard keeps its guild-keyed files in store/shards/<shard>/, so
+	processes running different shards never write the same file, and files that belong to the process
+	rather than to guilds (reminders, caches) get the process's shard range in their name.
+	"""
+	def __init__(self, shard_count: int | None = None, shard_ids: list[int] | None = None, root: str = 'store'):
+		if shard_ids is not None and shard_count is None:
+			raise ValueError('A shard count is needed to run a subset of the shards')
+		if shard_ids is not None and any(shard >= shard_count for shard in shard_ids):
+			raise ValueError(f'Shards {shard_ids} are not all below the shard count {shard_count}')
+		self.shard_count = shard_count
+		self.shard_ids = shard_ids if shard_ids is not None or shard_count is None else list(range(shard_count))
+		self.root = root
+
+	@classmethod
+	def from_config(cls, config: dict, argv: list[str]) -> 'ShardLayout':
+		"""--shard-count/--shards on the command line (as the supervisor passes them), else the config"""
+		count = argument(argv, '--shard-count') or config.get('shard_count')
+		shards = argument(argv, '--shards') or config.get('shards')
+		return cls(int(count) if count is not None else None, parse_shards(str(shards)) if shards is not None else None)
+
+	@property
+	def partitioned(self) -> bool:
+		return self.shard_count is not None
+
+	@property
+	def label(self) -> str:
+		return shards_label(self.shard_ids) if self.partitioned else ''
+
+	def shard_of(self, guild_id: int) -> int:
+		return shard_of(guild_id, self.shard_count)
+
+	def directory(self, shard_id: int) -> str:
+		directory = os.path.join(self.root, 'shards', str(shard_id))
+		os.makedirs(directory, exist_ok=True)
+		return directory
+
+	def local_path(self, name: str) -> str:
+		"""Path of a file belonging to this process, e.g. reminders.json -> store/reminders.0-3.json"""
+		if not self.partitioned:
+			return os.path.join(self.root, name)
+		stem, ext = os.path.splitext(name)
+		return os.path.join(self.root, f'{stem}.{self.label}{ext}')
+
+	def split(self, mapping: dict) -> dict[int, dict]:
+		"""Guild ID (int or str) -> value, grouped into one dict per shard this process runs"""
+		parts = {shard: {} for shard in self.shard_ids}
+		for guild_id, value in mapping.items():
+			parts.setdefault(self.shard_of(int(guild_id)), {})[guild_id] = value
+		return parts
+
+	def meta_path(self) -> str:
+		return os.path.join(self.root, 'shards', 'meta.json')
+
+	def stored_shard_count(self) -> int | None:
+		try:
+			with open(self.meta_path(), 'r') as f:
+				return json.load(f)['shard_count']
+		except FileNotFoundError:
+			return
+
+	def write_meta(self):
+		os.makedirs(os.path.dirname(self.meta_path()), exist_ok=True)
+		helpers.atomic_write(self.meta_path(), json.dumps({'shard_count': self.shard_count}))
+
+	def check(self):
+		"""Raises ValueError if store/ is partitioned for a different shard count than this process runs with (or for any, when unpartitioned).
+		A store with nothing in it yet is claimed for this shard count"""
+		stored = self.stored_shard_count()
+		if not self.partitioned:
+			if stored is not None:
+				# the unpartitioned files were renamed away, so this would start from an empty leaderboard
+				raise ValueError(f'store/ is partitioned for {stored} shards; pass `--shard-count {stored}` (or set shard_count in the config) '
+						'or run `python supervisor.py`')
+			return
+		if stored is None:
+			if has_unpartitioned_data(self.root):
+				raise ValueError(f'store/ is not partitioned yet; run `python supervisor.py --shard-count {self.shard_count} --repartition-only` first')
+			self.write_meta()
+		elif stored != self.shard_count:
+			raise ValueError(f'store/ is partitioned for {stored} shards, not {self.shard_count}; '
+					f'run `python supervisor.py --shard-count {self.shard_count} --repartition-only` first')
+
+def has_unpartitioned_data(root: str = 'store') -> bool:
+	return any(os.path.exists(os.path.join(root, name)) for name in ('leaderboard.json', 'leaderboard.journal', 'leaderboard.db', 'uma.json'))
+
+def repartition(shard_count: int, backend: str, root: str = 'store'):
+	"""Move the guild-keyed files (leaderboard and news state) into `shard_count` shard directories.
+
+	The source is the unpartitioned files, or the shard directories of a different shard count. The new
+	layout is built in store/shards.new and swapped in at the end, so an interrupted run leaves the old data
+	in place. Must not run while the bot does.
+	"""
+	layout = ShardLayout(shard_count, root=root)
+	stored = layout.stored_shard_count()
+	if stored == shard_count or (stored is None and not has_unpartitioned_data(root)):
+		layout.write_meta()
+		return
+	sources = [root] if stored is None else [os.path.join(root, 'shards', str(shard)) for shard in range(stored)]
+	staging = ShardLayout(shard_count, root=os.path.join(root, 'shards.new'))
+	shutil.rmtree(staging.root, ignore_errors=True)
+	if backend == 'sqlite':
+		repartition_sqlite(sources, staging)
+	else:
+		repartition_json(sources, staging)
+	news = {}
+	for source in sources:
+		try:
+			with open(os.path.join(source, 'uma.json'), 'r') as f:
+				news.update(json.load(f))
+		except FileNotFoundError:
+			pass
+	for shard, part in staging.split(news).items():
+		helpers.atomic_write(os.path.join(staging.directory(shard), 'uma.json'), json.dumps(part))
+	# swap in the new layout, keeping the old files next to it
+	if os.path.isdir(os.path.join(root, 'shards')):
+		old = os.path.join(root, f'shards.old-{stored}')
+		shutil.rmtree(old, ignore_errors=True)
+		os.replace(os.path.join(root, 'shards'), old)
+	if stored is None:
+		moved = ('leaderboard.db', 'leaderboard.db-wal', 'leaderboard.db-shm') if backend == 'sqlite' else ('leaderboard.json', 'leaderboard.journal')
+		for name in (*moved, 'uma.json'):
+			path = os.path.join(root, name)
+			if os.path.exists(path):
+				os.replace(path, path + '.repartitioned')
+	os.replace(os.path.join(staging.root, 'shards'), os.path.join(root, 'shards'))
+	shutil.rmtree(staging.root, ignore_errors=True)
+	layout.write_meta()
+	logger.info(f'Repartitioned {len(sources)} store(s) into {shard_count} shards')
+
+def repartition_json(sources: list[str], staging: ShardLayout):
+	targets = {shard: lbstore.JsonLeaderboardStore(os.path.join(staging.directory(shard), 'leaderboard.json')) for shard in staging.shard_ids}
+	for source in sources:
+		store = lbstore.JsonLeaderboardStore(os.path.join(source, 'leaderboard.json'))
+		for guild_id, lb in store.data.items():
+			targets[staging.shard_of(int(guild_id))].data[guild_id] = lb
+	for target in targets.values():
+		target.close()
+
+def repartition_sqlite(sources: list[str], staging: ShardLayout):
+	for source in sources:
+		if not os.path.exists(os.path.join(source, 'leaderboard.db')) and not os.path.exists(os.path.join(source, 'leaderboard.json')):
+			continue
+		# brings older databases up to the current schema, and imports a JSON store never opened with this backend
+		store = lbstore.SqliteLeaderboardStore(os.path.join(source, 'leaderboard.db'))
+		store.migrate_json(os.path.join(source, 'leaderboard.json'))
+		store.close()
+		store.db.close()
+	for shard in staging.shard_ids:
+		path = os.path.join(staging.directory(shard), 'leaderboard.db')
+		# creates the schema
+		store = lbstore.SqliteLeaderboardStore(path)
+		store.close()
+		store.db.close()
+		db = sqlite3.connect(path)
+		for source in sources:
+			if not os.path.exists(os.path.join(source, 'leaderboard.db')):
+				continue
+			# outside any transaction, which ATTACH and DETACH require
+			db.execute('ATTACH DATABASE ? AS source', (os.path.join(source, 'leaderboard.db'),))
+			for table in ('guilds', 'scores'):
+				db.execute(f'INSERT OR REPLACE INTO {table} SELECT * FROM source.{table} WHERE (guild_id >> 22) % ? = ?', (staging.shard_count, shard))
+			db.commit()
+			db.execute('DETACH DATABASE source')
+		db.close()
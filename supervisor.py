@@ -0,0 +1,146 @@
+"""Runs the bot as several processes, each connected to a contiguous range of shards.
+
+	python supervisor.py --processes 4
+	python supervisor.py --shard-count 16 --repartition-only
+
+Before starting, store/ is repartitioned for the shard count if it isn't already, so switching from a single
+process or changing the shard count is just a restart of the supervisor. Children that exit are restarted:
+straight away after `!update` (exit code 0), with a growing delay after a crash.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+import sharding
+
+log = logging.getLogger('supervisor')
+
+# seconds a child must stay up for its restart delay to reset
+stable_after = 60
+max_backoff = 300
+
+def recommended_shards(token: str) -> int:
+	"""Discord's recommended shard count for the bot, which grows with its guild count"""
+	request = urllib.request.Request('https://discord.com/api/v10/gateway/bot',
+			headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (supervisor, 1.0)'})
+	with urllib.request.urlopen(request, timeout=10) as response:
+		return json.load(response)['shards']
+
+def ranges(shard_count: int, processes: int) -> list[list[int]]:
+	"""Shard IDs split into at most `processes` contiguous ranges of near equal size"""
+	processes = min(processes, shard_count)
+	size, extra = divmod(shard_count, processes)
+	result = []
+	first = 0
+	for i in range(processes):
+		last = first + size + (i < extra)
+		result.append(list(range(first, last)))
+		first = last
+	return result
+
+class Child:
+	"""One bot process and its restart state"""
+	def __init__(self, shard_count: int, shards: list[int]):
+		self.args = [sys.executable, 'main.py', '--shard-count', str(shard_count), '--shards', sharding.shards_label(shards)]
+		self.label = sharding.shards_label(shards)
+		self.process = None
+		self.started = 0.0
+		self.backoff = 1
+		# when to start it again after it exited
+		self.due = 0.0
+
+	def start(self):
+		log.info(f'Starting shards {self.label}')
+		self.process = subprocess.Popen(self.args)
+		self.started = time.monotonic()
+
+	def exited(self, code: int):
+		now = time.monotonic()
+		if code == 0:
+			# !update pulled new code and exited for a restart
+			log.info(f'Shards {self.label} exited, restarting')
+			self.due = now
+			return
+		if now - self.started >= stable_after:
+			self.backoff = 1
+		log.warning(f'Shards {self.label} exited with code {code}, restarting in {self.backoff}s')
+		self.due = now + self.backoff
+		self.backoff = min(self.backoff * 2, max_backoff)
+
+class Supervisor:
+	def __init__(self, shard_count: int, processes: int, stagger: float):
+		self.children = [Child(shard_count, shards) for shards in ranges(shard_count, processes)]
+		# Discord allows one identify per 5 seconds (per bucket of max_concurrency), so processes start apart
+		self.stagger = stagger * shard_count / len(self.children)
+		self.stopping = False
+
+	def stop(self, signum, frame):
+		self.stopping = True
+
+	def run(self):
+		signal.signal(signal.SIGINT, self.stop)
+		signal.signal(signal.SIGTERM, self.stop)
+		for i, child in enumerate(self.children):
+			if i and not self.sleep(self.stagger):
+				break
+			child.start()
+		while not self.stopping:
+			for child in self.children:
+				if child.process is None:
+					if time.monotonic() >= child.due:
+						child.start()
+				elif child.process.poll() is not None:
+					child.exited(child.process.returncode)
+					child.process = None
+			self.sleep(1)
+		self.shutdown()
+
+	def sleep(self, seconds: float) -> bool:
+		"""False if a stop was requested meanwhile"""
+		deadline = time.monotonic() + seconds
+		while not self.stopping and time.monotonic() < deadline:
+			time.sleep(min(0.5, deadline - time.monotonic()))
+		return not self.stopping
+
+	def shutdown(self, timeout: float = 30):
+		"""SIGINT to every child so they save their state as on Ctrl+C, then kill what is left after `timeout`"""
+		running = [child.process for child in self.children if child.process is not None and child.process.poll() is None]
+		log.info(f'Stopping {len(running)} processes')
+		for process in running:
+			process.send_signal(signal.SIGINT)
+		deadline = time.monotonic() + timeout
+		for process in running:
+			try:
+				process.wait(max(deadline - time.monotonic(), 0))
+			except subprocess.TimeoutExpired:
+				log.warning(f'Killing {' '.join(process.args[2:])}')
+				process.kill()
+				process.wait()
+
+def main():
+	parser = argparse.ArgumentParser(description='Run the bot as several processes, each running a range of shards')
+	parser.add_argument('--processes', type=int, help='number of bot processes (default: config supervisor_processes, else 1)')
+	parser.add_argument('--shard-count', type=int, help="total shards (default: config shard_count, else Discord's recommendation)")
+	parser.add_argument('--stagger', type=float, default=5, help='seconds between process starts, per shard the process runs')
+	parser.add_argument('--repartition-only', action='store_true', help='repartition store/ for the shard count and exit')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format='[{asctime}] [{levelname:<8}] {name}: {message}', style='{', datefmt='%Y-%m-%d %H:%M:%S')
+
+	with open('store/config.json', 'r') as f:
+		config = json.load(f)
+	shard_count = args.shard_count or config.get('shard_count')
+	if shard_count is None:
+		shard_count = recommended_shards(config['token'])
+		log.info(f'Discord recommends {shard_count} shards')
+	sharding.repartition(shard_count, config.get('leaderboard_backend', 'json'))
+	if args.repartition_only:
+		return
+	Supervisor(shard_count, args.processes or config.get('supervisor_processes', 1), args.stagger).run()
+
+if __name__ == '__main__':
+	main()
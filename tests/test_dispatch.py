@@ -0,0 +1,95 @@
+import asyncio
+import time
+import unittest
+import discord
+import dispatch
+
+class FakeResponse:
+	def __init__(self, status: int, reason: str):
+		self.status = status
+		self.reason = reason
+
+def http_error(status: int, retry_after: float | None = None) -> discord.HTTPException:
+	error = discord.HTTPException(FakeResponse(status, 'Too Many Requests' if status == 429 else 'Forbidden'), 'error')
+	if retry_after is not None:
+		error.retry_after = retry_after
+	return error
+
+class FakeChannel:
+	"""Records sends, raising the queued failures first"""
+	def __init__(self, id: int = 1):
+		self.id = id
+		self.sent = []
+		self.failures = []
+
+	async def send(self, content: str | None = None, embeds: list | None = None):
+		if self.failures:
+			raise self.failures.pop(0)
+		self.sent.append((content, embeds))
+		return ('message', len(self.sent))
+
+class DispatcherTest(unittest.IsolatedAsyncioTestCase):
+	def setUp(self):
+		self.dispatcher = dispatch.Dispatcher(channel_rate=(5, 5.0), global_rate=(50, 1.0), max_queue=10)
+		self.channel = FakeChannel()
+
+	async def test_plain_messages_are_coalesced(self):
+		futures = [self.dispatcher.submit(self.channel, text) for text in ('one', 'two', 'three')]
+		messages = await asyncio.gather(*futures)
+		self.assertEqual(self.channel.sent, [('one\ntwo\nthree', None)])
+		self.assertEqual(messages, [('message', 1)] * 3)
+		self.assertEqual(self.dispatcher.metrics['coalesced'], 2)
+		self.assertEqual(self.dispatcher.size, 0)
+
+	async def test_higher_priority_is_sent_first(self):
+		futures = [self.dispatcher.submit(self.channel, embed=discord.Embed(title=title), priority=priority)
+				for title, priority in (('low', dispatch.PRIORITY_LOW), ('normal', dispatch.PRIORITY_NORMAL), ('high', dispatch.PRIORITY_HIGH))]
+		await asyncio.gather(*futures)
+		self.assertEqual([embeds[0].title for _, embeds in self.channel.sent], ['high', 'normal', 'low'])
+
+	async def test_429_requeues_after_retry_after(self):
+		self.channel.failures = [http_error(429, retry_after=0.05)]
+		started = time.monotonic()
+		futures = [self.dispatcher.submit(self.channel, 'a'), self.dispatcher.submit(self.channel, 'b')]
+		self.assertEqual(await asyncio.gather(*futures), [('message', 1)] * 2)
+		self.assertGreaterEqual(time.monotonic() - started, 0.05)
+		# the whole coalesced batch went back in line, in order
+		self.assertEqual(self.channel.sent, [('a\nb', None)])
+		self.assertEqual(self.dispatcher.metrics['rate_limited'], 1)
+		self.assertEqual(self.dispatcher.metrics['retried'], 2)
+
+	async def test_429_gives_up_after_max_attempts(self):
+		self.channel.failures = [http_error(429, retry_after=0.01) for _ in range(dispatch.Dispatcher.max_attempts)]
+		with self.assertRaises(discord.HTTPException):
+			await self.dispatcher.submit(self.channel, 'a')
+		self.assertEqual(self.dispatcher.size, 0)
+
+	async def test_http_error_fails_the_batch(self):
+		self.channel.failures = [http_error(403)]
+		with self.assertRaises(discord.HTTPException):
+			await self.dispatcher.submit(self.channel, 'a')
+		self.assertEqual(self.dispatcher.metrics['failed'], 1)
+		self.assertEqual(await self.dispatcher.submit(self.channel, 'b'), ('message', 1))
+
+	async def test_non_http_error_fails_the_batch_and_keeps_running(self):
+		self.channel.failures = [ValueError('connection reset')]
+		with self.assertLogs('dispatch', 'ERROR'):
+			with self.assertRaises(ValueError):
+				# times out if the error escaped run() and left the future pending
+				await asyncio.wait_for(self.dispatcher.submit(self.channel, 'a'), 1)
+		self.assertEqual(self.dispatcher.size, 0)
+		# run() ends once the queue is empty, but must not have died with the error
+		await asyncio.sleep(0)
+		self.assertTrue(self.dispatcher.task.done() and self.dispatcher.task.exception() is None)
+		self.assertEqual(await self.dispatcher.submit(self.channel, 'b'), ('message', 1))
+
+	async def test_queue_full(self):
+		self.dispatcher.max_queue = 2
+		futures = [self.dispatcher.submit(self.channel, text) for text in ('a', 'b', 'c')]
+		self.assertIsInstance(futures[2].exception(), dispatch.QueueFull)
+		self.assertEqual(self.dispatcher.metrics['dropped'], 1)
+		await asyncio.gather(*futures[:2])
+		self.assertEqual(self.dispatcher.size, 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import webclient
+
+class WebClientTest(unittest.IsolatedAsyncioTestCase):
+	"""WebClient against a stub server on localhost"""
+	async def asyncSetUp(self):
+		# path -> number of requests the stub has served for it
+		self.hits = {}
+		# statuses the next requests to /flaky get, before it answers 200
+		self.flaky_statuses = []
+		app = web.Application()
+		app.router.add_get('/slow', self.slow)
+		app.router.add_get('/flaky', self.flaky)
+		app.router.add_get('/hang', self.hang)
+		app.router.add_get('/missing', self.missing)
+		app.router.add_get('/broken', self.broken)
+		app.router.add_get('/count', self.count)
+		app.router.add_post('/count', self.count)
+		self.server = TestServer(app, host='127.0.0.1')
+		await self.server.start_server()
+		self.client = webclient.WebClient(timeout=2, retries=2, backoff=0.01)
+
+	async def asyncTearDown(self):
+		await self.client.close()
+		await self.server.close()
+
+	def url(self, path: str) -> str:
+		return str(self.server.make_url(path))
+
+	def hit(self, request: web.Request) -> int:
+		self.hits[request.path] = self.hits.get(request.path, 0) + 1
+		return self.hits[request.path]
+
+	async def slow(self, request: web.Request):
+		count = self.hit(request)
+		await asyncio.sleep(0.1)
+		return web.json_response({'n': count})
+
+	async def flaky(self, request: web.Request):
+		self.hit(request)
+		if self.flaky_statuses:
+			return web.json_response({'error': 'busy'}, status=self.flaky_statuses.pop(0))
+		return web.json_response({'ok': True})
+
+	async def hang(self, request: web.Request):
+		self.hit(request)
+		await asyncio.sleep(5)
+		return web.json_response({})
+
+	async def missing(self, request: web.Request):
+		self.hit(request)
+		return web.json_response({'error': 'no such thing'}, status=404)
+
+	async def broken(self, request: web.Request):
+		self.hit(request)
+		return web.Response(text='<html>bad request</html>', status=400)
+
+	async def count(self, request: web.Request):
+		return web.json_response({'n': self.hit(request)})
+
+	async def test_identical_requests_share_one_upstream_call(self):
+		results = await asyncio.gather(*(self.client.request_json('GET', self.url('/slow')) for _ in range(5)))
+		self.assertEqual(self.hits['/slow'], 1)
+		self.assertEqual(results, [{'n': 1}] * 5)
+		self.assertEqual(self.client.inflight, {})
+
+	async def test_503_is_retried_with_backoff(self):
+		self.flaky_statuses = [503, 503]
+		started = time.monotonic()
+		self.assertEqual(await self.client.request_json('GET', self.url('/flaky')), {'ok': True})
+		self.assertEqual(self.hits['/flaky'], 3)
+		# 0.01 then 0.02 seconds, each jittered by at least half
+		self.assertGreaterEqual(time.monotonic() - started, 0.015)
+
+	async def test_503_after_last_retry_raises(self):
+		self.flaky_statuses = [503, 503, 503]
+		with self.assertRaises(webclient.WebError) as raised:
+			await self.client.request_json('GET', self.url('/flaky'))
+		self.assertEqual(raised.exception.status, 503)
+		self.assertEqual(raised.exception.body, {'error': 'busy'})
+
+	async def test_timeout_becomes_web_error(self):
+		with self.assertRaises(webclient.WebError) as raised:
+			await self.client.request_json('GET', self.url('/hang'), timeout=0.1, retries=0)
+		self.assertIsNone(raised.exception.status)
+		self.assertIsInstance(raised.exception.__cause__, TimeoutError)
+
+	async def test_4xx_keeps_error_body(self):
+		with self.assertRaises(webclient.WebError) as raised:
+			await self.client.request_json('GET', self.url('/missing'))
+		self.assertEqual(raised.exception.status, 404)
+		self.assertEqual(raised.exception.body, {'error': 'no such thing'})
+		# not retried
+		self.assertEqual(self.hits['/missing'], 1)
+
+	async def test_4xx_keeps_undecodable_body(self):
+		with self.assertRaises(webclient.WebError) as raised:
+			await self.client.request_json('GET', self.url('/broken'))
+		self.assertEqual(raised.exception.status, 400)
+		self.assertEqual(raised.exception.body, b'<html>bad request</html>')
+
+	def age_cache(self, seconds: float):
+		for entry in self.client.cache.values():
+			entry[0] -= seconds
+
+	async def test_fresh_cache_hit_skips_upstream(self):
+		url = self.url('/count')
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60), {'n': 1})
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60), {'n': 1})
+		self.assertEqual(self.hits['/count'], 1)
+		self.assertEqual(self.client.cache_stats['hits'], 1)
+		self.assertEqual(self.client.cache_stats['misses'], 1)
+
+	async def test_stale_cache_hit_refreshes_in_background(self):
+		url = self.url('/count')
+		await self.client.request_json('GET', url, ttl=60, stale_ttl=60)
+		self.age_cache(90)
+		# the stale body comes back straight away, and a refresh fetches the new one
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60, stale_ttl=60), {'n': 1})
+		self.assertEqual(self.client.cache_stats['stale_hits'], 1)
+		await asyncio.gather(*self.client.background)
+		self.assertEqual(self.hits['/count'], 2)
+		self.assertEqual(self.client.cache_stats['refreshes'], 1)
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60, stale_ttl=60), {'n': 2})
+		self.assertEqual(self.hits['/count'], 2)
+
+	async def test_fresh_request_skips_cache_but_updates_it(self):
+		url = self.url('/count')
+		await self.client.request_json('GET', url, ttl=60, stale_ttl=60)
+		self.age_cache(90)
+		# a poller must not get the stale body, and its result serves later cached requests
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60, stale_ttl=60, fresh=True), {'n': 2})
+		self.assertEqual(self.client.cache_stats['stale_hits'], 0)
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60, stale_ttl=60), {'n': 2})
+		self.assertEqual(self.hits['/count'], 2)
+
+	async def test_expired_cache_entry_is_fetched_again(self):
+		url = self.url('/count')
+		await self.client.request_json('GET', url, ttl=60, stale_ttl=60)
+		self.age_cache(150)
+		self.assertEqual(await self.client.request_json('GET', url, ttl=60, stale_ttl=60), {'n': 2})
+		self.assertEqual(self.client.cache_stats['misses'], 2)
+		self.assertEqual(self.client.cache_stats['stale_hits'], 0)
+
+	async def test_saved_cache_has_no_request_bodies(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'webcache.json')
+			with open(path, 'w') as f:
+				json.dump({json.dumps(['POST', 'http://old', {'api_key': 'old-secret'}]): [0, {}]}, f)
+			client = webclient.WebClient(backoff=0.01, cache_path=path)
+			await client.request_json('POST', self.url('/count'), json_body={'api_key': 'secret'}, ttl=60)
+			await client.save_cache()
+			await client.close()
+			with open(path) as f:
+				saved = f.read()
+			self.assertNotIn('secret', saved)
+			self.assertEqual(len(json.loads(saved)), 1)
+
+if __name__ == '__main__':
+	unittest.main()
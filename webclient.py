@@ -0,0 +1,168 @@
+import aiohttp
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+import helpers
+import metrics
+
+class WebError(Exception):
+	"""An outbound request failed (after retries). `status` and `body` are set when the server answered"""
+	def __init__(self, message: str, status: int | None = None, body = None):
+		super().__init__(message)
+		self.status = status
+		self.body = body
+
+class WebClient:
+	"""Shared HTTP client for outbound API calls.
+
+	One pooled keep-alive session for the whole bot, a per-host connection limit, a timeout on every request,
+	retries with jittered exponential backoff, and single-flight: identical requests made while one is already
+	in flight share its result instead of going upstream again.
+
+	Requests made with a `ttl` are cached by method, URL and body. Within `ttl` the cached body is returned;
+	for `stale_ttl` seconds after that it is still returned while a background refresh runs. With `fresh`,
+	the cache is skipped but still updated, for pollers that must see the latest response. The cache is
+	saved to `cache_path`, if given, so a restart starts warm.
+	"""
+	retry_statuses = {429, 500, 502, 503, 504}
+
+	def __init__(self, timeout: float = 10, retries: int = 2, backoff: float = 0.5, limit: int = 100, limit_per_host: int = 4, cache_path: str | None = None):
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.limit = limit
+		self.limit_per_host = limit_per_host
+		self.logger = logging.getLogger(__name__)
+		self.session = None
+		self.inflight = {}
+		# cache key -> [stored at (unix time), body]
+		self.cache = {}
+		self.cache_path = cache_path
+		self.cache_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0}
+		self.background = set()
+		self.save_pending = False
+		if cache_path is not None:
+			self.load_cache()
+
+	def get_session(self) -> aiohttp.ClientSession:
+		# created lazily so it binds to the running loop
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=300, keepalive_timeout=60)
+			self.session = aiohttp.ClientSession(connector=connector)
+		return self.session
+
+	async def close(self):
+		if self.session is not None and not self.session.closed:
+			await self.session.close()
+
+	async def request_json(self, method: str, url: str, *, json_body = None, timeout: float | None = None, retries: int | None = None,
+			ttl: float = 0, stale_ttl: float = 0, fresh: bool = False):
+		"""Make a request and return its decoded JSON body, from the cache when `ttl` allows. Raises WebError"""
+		# hashed, since bodies can hold secrets (API keys) and the cache is saved to disk
+		key = hashlib.sha256(json.dumps([method, url, json_body], sort_keys=True).encode()).hexdigest()
+		if ttl > 0 and not fresh:
+			entry = self.cache.get(key)
+			if entry is not None:
+				age = time.time() - entry[0]
+				if age < ttl:
+					self.cache_stats['hits'] += 1
+					return entry[1]
+				if age < ttl + stale_ttl:
+					self.cache_stats['stale_hits'] += 1
+					self.spawn(self.refresh(key, method, url, json_body, timeout, retries))
+					return entry[1]
+			self.cache_stats['misses'] += 1
+		body = await self.single_flight(key, method, url, json_body, timeout, retries)
+		if ttl > 0:
+			self.store(key, body)
+		return body
+
+	def single_flight(self, key: str, method: str, url: str, json_body, timeout: float | None, retries: int | None):
+		task = self.inflight.get(key)
+		if task is None:
+			task = asyncio.ensure_future(self.fetch(method, url, json_body,
+					self.timeout if timeout is None else timeout,
+					self.retries if retries is None else retries))
+			self.inflight[key] = task
+			task.add_done_callback(lambda _: self.inflight.pop(key, None))
+		# shielded so one caller giving up doesn't cancel the request for everyone sharing it
+		return asyncio.shield(task)
+
+	def spawn(self, coro):
+		task = asyncio.ensure_future(coro)
+		self.background.add(task)
+		task.add_done_callback(self.background.discard)
+
+	async def refresh(self, key: str, method: str, url: str, json_body, timeout: float | None, retries: int | None):
+		if key in self.inflight:
+			return
+		self.cache_stats['refreshes'] += 1
+		try:
+			self.store(key, await self.single_flight(key, method, url, json_body, timeout, retries))
+		except WebError as e:
+			self.cache_stats['refresh_errors'] += 1
+			self.logger.warning(f'Background refresh failed, keeping stale response: {e}')
+
+	def store(self, key: str, body):
+		self.cache[key] = [time.time(), body]
+		if self.cache_path is not None and not self.save_pending:
+			self.save_pending = True
+			self.spawn(self.save_cache())
+
+	def load_cache(self):
+		try:
+			with open(self.cache_path, 'r', encoding='utf-8') as f:
+				self.cache = json.load(f)
+		except FileNotFoundError:
+			return
+		except json.JSONDecodeError as e:
+			self.logger.warning(f'Discarding unreadable response cache {self.cache_path}: {e}')
+			return
+		# entries from before keys were hashed have the request body, secrets included, as their key
+		plain = [key for key in self.cache if key.startswith('[')]
+		if plain:
+			for key in plain:
+				del self.cache[key]
+			helpers.atomic_write(self.cache_path, json.dumps(self.cache))
+
+	async def save_cache(self):
+		# coalesce bursts of stores into one write
+		await asyncio.sleep(1)
+		self.save_pending = False
+		await asyncio.to_thread(helpers.atomic_write, self.cache_path, json.dumps(self.cache))
+
+	async def fetch(self, method: str, url: str, json_body, timeout: float, retries: int):
+		session = self.get_session()
+		for attempt in range(retries + 1):
+			delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+			try:
+				async with session.request(method, url, json=json_body, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+					data = await response.read()
+					host = response.url.host
+					if json_body is not None:
+						metrics.count('net_bytes', len(json.dumps(json_body)), direction='sent', host=host)
+					metrics.count('net_bytes', len(data), direction='received', host=host)
+					if response.status in self.retry_statuses and attempt < retries:
+						retry_after = response.headers.get('Retry-After')
+						if retry_after is not None and retry_after.isdigit():
+							delay = max(delay, int(retry_after))
+						self.logger.info(f'{method} {url} returned {response.status}, retrying in {delay:.1f}s')
+						await asyncio.sleep(delay)
+						continue
+					try:
+						body = json.loads(data) if data else None
+					except ValueError as e:
+						if response.status >= 400:
+							raise WebError(f'{method} {url} returned {response.status}', response.status, data) from e
+						raise WebError(f'Unable to decode JSON from {url}: {e}', response.status, data) from e
+					if response.status >= 400:
+						raise WebError(f'{method} {url} returned {response.status}', response.status, body)
+					return body
+			except (aiohttp.ClientError, TimeoutError) as e:
+				if attempt == retries:
+					raise WebError(f'{method} {url} failed: {e!r}') from e
+				self.logger.info(f'{method} {url} failed ({e!r}), retrying in {delay:.1f}s')
+				await asyncio.sleep(delay)